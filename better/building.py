@@ -18,6 +18,7 @@ import pandas as pd
 import numpy as np
 import geocoder
 import copy
+import time
 
 
 class Building:
@@ -110,18 +111,27 @@ class Building:
             self.annual_eui_fossil_fuel = round(
                 self.eui_daily_all_periods_fossil_fuel * constants.Constants.days_in_year, 2)
 
-    def fit_inverse_model(self):
+    def fit_inverse_model(self, registry=None, fit_options=None, fit_vbdd=False):
+        # fit_options: keyword arguments of InverseModel, e.g. fit_method, max_nfev, time_budget or the
+        # curve_fit window search options warm_start, n_jobs and patience
+        # fit_vbdd: also fit variable-base degree-day models (im_*.vbdd) from the weather degree-day tables
+        fit_options = {} if fit_options is None else fit_options
 
         # Pre-processing
         self.pre_process()
+        if fit_options.get('time_budget') is not None and fit_options.get('deadline') is None:
+            # One time budget for all the fuels of the building rather than one per model
+            fit_options = dict(fit_options, deadline=time.perf_counter() + fit_options['time_budget'])
         has_fit_e = has_fit_f = False
         # Fit change-point model for electricity consumption
         print('Fitting electricity model...')
         if (hasattr(self, "weather_electricity")):
             self.im_electricity = model.InverseModel(self.weather_electricity.v_T_C,
                                                      self.eui_daily_electricity,
-                                                     'Electricity')
-            has_fit_e = self.im_electricity.fit_model()
+                                                     'Electricity', **fit_options)
+            has_fit_e = self.im_electricity.fit_or_load(registry)
+            if fit_vbdd:
+                self.im_electricity.fit_vbdd_model(*self.weather_electricity.degree_days())
             if (has_fit_e):
                 self.im_electricity.plot_IM(self)
         # Fit change-point model for fossil fuel consumption
@@ -129,8 +139,10 @@ class Building:
         if (hasattr(self, "weather_fossil_fuel")):
             self.im_fossil_fuel = model.InverseModel(self.weather_fossil_fuel.v_T_C,
                                                      self.eui_daily_fossil_fuel,
-                                                     'Fossil Fuel')
-            has_fit_f = self.im_fossil_fuel.fit_model()
+                                                     'Fossil Fuel', **fit_options)
+            has_fit_f = self.im_fossil_fuel.fit_or_load(registry)
+            if fit_vbdd:
+                self.im_fossil_fuel.fit_vbdd_model(*self.weather_fossil_fuel.degree_days())
             if (has_fit_f): self.im_fossil_fuel.plot_IM(self)
         return (has_fit_e or has_fit_f)
 
@@ -322,8 +334,8 @@ class Building:
             print("No saving model found for electricity consumption!")
         else:
             # Calculate electricity savings (all and most recent year)
-            self.v_old_daily_eui_all_e = model.InverseModel.piecewise_linear(self.weather_electricity.v_T_C, *self.im_electricity.model_p)
-            self.v_new_daily_eui_all_e = model.InverseModel.piecewise_linear(self.weather_electricity.v_T_C, *self.p_new_e)
+            self.v_old_daily_eui_all_e, self.v_new_daily_eui_all_e = model.InverseModel.predict(
+                [self.im_electricity.model_p, self.p_new_e], self.weather_electricity.v_T_C)
             self.v_old_consumption_all_e = np.round(self.bldg_area * np.multiply(self.v_old_daily_eui_all_e, self.utility_electricity.days), 1)
             self.v_new_consumption_all_e = np.round(self.bldg_area * np.multiply(self.v_new_daily_eui_all_e, self.utility_electricity.days), 1)
             self.v_old_consumption_last_year_e = self.v_old_consumption_all_e[-12:]
@@ -343,8 +355,8 @@ class Building:
             print("No saving model found for fossil fuel consumption!")
         else:
             # Calculate fossil_fuel savings (all and most recent year)
-            self.v_old_daily_eui_all_f = model.InverseModel.piecewise_linear(self.weather_fossil_fuel.v_T_C, *self.im_fossil_fuel.model_p)
-            self.v_new_daily_eui_all_f = model.InverseModel.piecewise_linear(self.weather_fossil_fuel.v_T_C, *self.p_new_f)
+            self.v_old_daily_eui_all_f, self.v_new_daily_eui_all_f = model.InverseModel.predict(
+                [self.im_fossil_fuel.model_p, self.p_new_f], self.weather_fossil_fuel.v_T_C)
             self.v_old_consumption_all_f = np.round(self.bldg_area * np.multiply(self.v_old_daily_eui_all_f, self.utility_fossil_fuel.days), 1)
             self.v_new_consumption_all_f = np.round(self.bldg_area * np.multiply(self.v_new_daily_eui_all_f, self.utility_fossil_fuel.days), 1)
             self.v_old_consumption_last_year_f = self.v_old_consumption_all_f[-12:]
@@ -372,6 +384,28 @@ class Building:
             self.total_cost_savings += self.total_cost_savings_f
         self.total_energy_savings_pct = np.round(self.total_energy_savings / self.total_energy_consumption_old * 100, 1)
         self.total_cost_savings = np.round(self.total_cost_savings, 0)
+        self.calculate_uncertainty()
+
+    def guideline14_inputs(self):
+        # (fuel, fit residuals, eui, days, model type, fractional savings) of each fitted model
+        v_inputs = []
+        for fuel, s in (('electricity', 'e'), ('fossil_fuel', 'f')):
+            im = getattr(self, 'im_' + fuel, None)
+            if (im is not None and getattr(im, 'has_fit', False) and
+                    getattr(im, 'model_type_str', None) in model.InverseModel.n_parameters):
+                v_inputs.append((s, im.fit_result.residuals, im.eui, getattr(self, 'utility_' + fuel).days,
+                                 im.model_type_str,
+                                 getattr(self, 'total_energy_savings_pct_last_year_' + s, np.nan) / 100))
+        return v_inputs
+
+    def calculate_uncertainty(self, confidence=0.9):
+        # ASHRAE Guideline 14 metrics of the models and the fractional uncertainty of the savings
+        v_inputs = self.guideline14_inputs()
+        if v_inputs:
+            v_fuels, *args = zip(*v_inputs)
+            metrics = model.InverseModel.guideline14_metrics(*args, confidence=confidence)
+            for i, s in enumerate(v_fuels):
+                setattr(self, 'guideline14_' + s, {k: v[i] for k, v in metrics.items()})
 
     def assemble_saving_dataframe(self):
         # Create a dataframe of savings per billing period for plotting
@@ -485,27 +519,28 @@ class Building:
 
     @staticmethod
     def disaggregate_consumption(v_T, v_days, model_p, area):
-        # Get model coefficients
-        hcp, ccp, base, hsl, csl = model_p
-        # Mask the temperature and number of days vectors
-        v_T_heating = v_T[v_T < hcp] if (not np.isnan(hcp)) else [-1]
-        v_T_cooling = v_T[v_T > ccp] if (not np.isnan(ccp)) else [-1]
-        v_days_heating = v_days[v_T < hcp] if (not np.isnan(hcp)) else [-1]
-        v_days_cooling = v_days[v_T > ccp] if (not np.isnan(ccp)) else [-1]
-        # Calculate the disaggregated energy consumption
-        v_base_consumption = base * v_days * area
+        v_base, v_heating, v_cooling = Building.disaggregate_consumption_batch(v_T, v_days, [model_p], area)
+        return v_base[0], v_heating[0], v_cooling[0]
 
-        if(len(v_T_heating) > 1):
-            v_heating_consumption = (model.InverseModel.piecewise_linear(v_T_heating,
-                                                                         *model_p) - base) * v_days_heating * area
-        else:
-            v_heating_consumption = [0]
-        if(len(v_T_cooling) > 1):
-            v_cooling_consumption = (model.InverseModel.piecewise_linear(v_T_cooling,
-                                                                         *model_p) - base) * v_days_cooling * area
-        else:
-            v_cooling_consumption = [0]
-        return sum(v_base_consumption), sum(v_heating_consumption), sum(v_cooling_consumption)
+    @staticmethod
+    def disaggregate_consumption_batch(v_T, v_days, m_p, area):
+        # Disaggregate the consumption of several models (rows of [hcp, ccp, base, hsl, csl]) at once
+        m_p = np.asarray(m_p, dtype=float)
+        v_T = np.asarray(v_T, dtype=float)
+        v_days = np.asarray(v_days, dtype=float)
+        hcp, ccp, base = m_p[:, [0]], m_p[:, [1]], m_p[:, [2]]
+        # Mask the heating and cooling periods (a NaN change-point masks nothing)
+        m_heating = v_T < hcp
+        m_cooling = v_T > ccp
+        # Calculate the disaggregated energy consumption
+        m_consumption = (model.InverseModel.predict(m_p, v_T) - base) * v_days * area
+        v_base_consumption = np.sum(base * v_days * area, axis=1)
+        # Heating and cooling are only counted when more than one period falls in the mode
+        v_heating_consumption = np.where(np.sum(m_heating, axis=1) > 1,
+                                         np.sum(np.where(m_heating, m_consumption, 0), axis=1), 0)
+        v_cooling_consumption = np.where(np.sum(m_cooling, axis=1) > 1,
+                                         np.sum(np.where(m_cooling, m_consumption, 0), axis=1), 0)
+        return v_base_consumption, v_heating_consumption, v_cooling_consumption
 
     def disaggregate_consumption_wrapper(self):
         # All the consumption terms are in kWh in this function
@@ -535,24 +570,15 @@ class Building:
         # Calculate the diaggregated consumption
         if (hasattr(self, "v_new_consumption_last_year_e")):
             unit_price_e = self.utility_electricity.utility_unit_price
-            base_old_e, heating_old_e, cooling_old_e = self.disaggregate_consumption(
-                self.weather_electricity.v_T_C[-12:],
-                self.utility_electricity.days[-12:],
-                self.im_electricity.model_p,
-                self.bldg_area
-            )
-            base_typical_e, heating_typical_e, cooling_typical_e = self.disaggregate_consumption(
-                self.weather_electricity.v_T_C[-12:],
-                self.utility_electricity.days[-12:],
-                self.p_typical_e,
-                self.bldg_area
-            )
-            base_new_e, heating_new_e, cooling_new_e = self.disaggregate_consumption(
-                self.weather_electricity.v_T_C[-12:],
-                self.utility_electricity.days[-12:],
-                self.p_new_e,
-                self.bldg_area
-            )
+            # Old, typical and new models in one call
+            (base_old_e, base_typical_e, base_new_e), \
+                (heating_old_e, heating_typical_e, heating_new_e), \
+                (cooling_old_e, cooling_typical_e, cooling_new_e) = self.disaggregate_consumption_batch(
+                    self.weather_electricity.v_T_C[-12:],
+                    self.utility_electricity.days[-12:],
+                    [self.im_electricity.model_p, self.p_typical_e, self.p_new_e],
+                    self.bldg_area
+                )
 
             self.base_old += base_old_e
             self.base_typical += base_typical_e
@@ -577,26 +603,14 @@ class Building:
 
         if (hasattr(self, "v_new_consumption_last_year_f")):
             unit_price_f = self.utility_fossil_fuel.utility_unit_price
-            base_old_f, heating_old_f, cooling_old_f = self.disaggregate_consumption(
-                self.weather_fossil_fuel.v_T_C[-12:],
-                self.utility_fossil_fuel.days[-12:],
-                self.im_fossil_fuel.model_p,
-                self.bldg_area
-            )
-
-            base_typical_f, heating_typical_f, cooling_typical_f = self.disaggregate_consumption(
-                self.weather_fossil_fuel.v_T_C[-12:],
-                self.utility_fossil_fuel.days[-12:],
-                self.p_typical_f,
-                self.bldg_area
-            )
-
-            base_new_f, heating_new_f, cooling_new_f = self.disaggregate_consumption(
-                self.weather_fossil_fuel.v_T_C[-12:],
-                self.utility_fossil_fuel.days[-12:],
-                self.p_new_f,
-                self.bldg_area
-            )
+            (base_old_f, base_typical_f, base_new_f), \
+                (heating_old_f, heating_typical_f, heating_new_f), \
+                (cooling_old_f, cooling_typical_f, cooling_new_f) = self.disaggregate_consumption_batch(
+                    self.weather_fossil_fuel.v_T_C[-12:],
+                    self.utility_fossil_fuel.days[-12:],
+                    [self.im_fossil_fuel.model_p, self.p_typical_f, self.p_new_f],
+                    self.bldg_area
+                )
             self.base_old += base_old_f
             self.base_typical += base_typical_f
             self.base_new += base_new_f
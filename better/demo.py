@@ -13,9 +13,25 @@ import weather
 import building
 import portfolio
 import report
+import registry
 
 import os
 
+def load_building(p, building_id, saving_target=2):
+    # Create a building instance with its utility data from the portfolio, None if the building is not found
+    building_info = p.get_building_info_by_id(building_id)
+    if(building_info == None):
+        return None
+    building_test = building.Building(building_id, *building_info, saving_target)
+    # Get utility data from portfolio
+    df_raw_utility_e = p.get_utility_by_building_id_and_energy_type(building_ID=building_id, energy_type=1)
+    df_raw_utility_f = p.get_utility_by_building_id_and_energy_type(building_ID=building_id, energy_type=2)
+    utility_test_e = utility.Utility('electricity', df_raw_utility_e)
+    utility_test_f = utility.Utility('fossil fuel', df_raw_utility_f)
+    building_test.add_utility(utility_test_e, utility_test_f)
+    return building_test
+
+
 def run_single(
     bldg_id = 1, 
     saving_target = 2, 
@@ -26,8 +42,15 @@ def run_single(
     return_data=False,
     use_default_benchmark_data=True,
     df_user_bench_stats_e=None,
-    df_user_bench_stats_f=None
+    df_user_bench_stats_f=None,
+    use_model_registry=True,
+    fit_options=None,
+    prepared_building=None,
+    weather_source='isd'
     ):
+    # prepared_building: building from load_building, e.g. after its weather was prefetched by run_batch
+    # weather_source: 'isd', 'isd-lite', 'gsod' or 'service' (weather_service.py), used when cached_weather is False
+    weather.Weather.set_weather_source(weather_source)
     # Set paths
     s_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
     data_path = s_path + '/Data/'
@@ -41,72 +64,69 @@ def run_single(
     # p.read_raw_data_from_xlsx(data_path + 'portfolio.xlsx')
     p.read_raw_data_from_xlsx(data_path + 'portfolio.xlsx')
 
-    # Get building data from the portfolio
-    building_id = bldg_id
-    building_info = p.get_building_info_by_id(building_id)
-    if(building_info == None):
-        return False, None
-    else:
-        # Initialize a building instance
-        building_test = building.Building(building_id, *building_info, saving_target)
-        # Get utility data from portfolio
-        df_raw_electricity = p.get_utility_by_building_id_and_energy_type(building_ID=building_id, energy_type=1)
-        df_raw_fossil_fuel = p.get_utility_by_building_id_and_energy_type(building_ID=building_id, energy_type=2)
-        df_raw_utility_e = df_raw_electricity
-        df_raw_utility_f = df_raw_fossil_fuel
-        utility_test_e = utility.Utility('electricity', df_raw_utility_e)
-        utility_test_f = utility.Utility('fossil fuel', df_raw_utility_f)
-        building_test.add_utility(utility_test_e, utility_test_f)
-        weather_test_e = weather.Weather(building_test.coord)
-        weather_test_f = weather.Weather(building_test.coord)
-        building_test.add_weather(cached_weather, weather_test_e, weather_test_f)
+    # Reuse stored change-point model fits when the utility and weather data have not changed
+    model_registry = registry.ModelRegistry(report_path + 'model_registry.sqlite') if use_model_registry else None
+    try:
+        # Get building data from the portfolio
+        building_test = prepared_building if prepared_building is not None else load_building(p, bldg_id, saving_target)
+        if(building_test == None):
+            return False, None
+        else:
+            weather_test_e = weather.Weather(building_test.coord)
+            weather_test_f = weather.Weather(building_test.coord)
+            building_test.add_weather(cached_weather, weather_test_e, weather_test_f)
     
-        # Fit inverse model and benchmark
-        has_fit = building_test.fit_inverse_model()
-        # Continue only if there is at least one change-point model fit.
-        if has_fit:
-            if (use_default_benchmark_data):
-                building_test.benchmark()
-                building_test.ee_assess()
-            else:
-                # Note: the benchmark data sets are generated from the portfolio spreadsheet.
-                # 1 ~ electricity; 2 ~ fossil fuel
-                dict_raw_electricity = p.get_portfolio_raw_data_by_spaceType_and_utilityType(space_type, utility_type=1)
-                dict_raw_fossil_fuel = p.get_portfolio_raw_data_by_spaceType_and_utilityType(space_type, utility_type=2)
+            # Fit inverse model and benchmark
+            has_fit = building_test.fit_inverse_model(model_registry, fit_options)
+            # Continue only if there is at least one change-point model fit.
+            if has_fit:
+                if (use_default_benchmark_data):
+                    building_test.benchmark()
+                    building_test.ee_assess()
+                else:
+                    # Note: the benchmark data sets are generated from the portfolio spreadsheet.
+                    # 1 ~ electricity; 2 ~ fossil fuel
+                    dict_raw_electricity = p.get_portfolio_raw_data_by_spaceType_and_utilityType(space_type, utility_type=1)
+                    dict_raw_fossil_fuel = p.get_portfolio_raw_data_by_spaceType_and_utilityType(space_type, utility_type=2)
     
-                # Generate the benchmark stats from the user provided data in the portfolio spreadsheet
-                if df_user_bench_stats_e is None:
-                    df_user_bench_stats_e = p.generate_benchmark_stats_wrapper(dict_raw_electricity, cached_weather)
-                if df_user_bench_stats_f is None:
-                    df_user_bench_stats_f = p.generate_benchmark_stats_wrapper(dict_raw_fossil_fuel, cached_weather)
+                    # Generate the benchmark stats from the user provided data in the portfolio spreadsheet
+                    if df_user_bench_stats_e is None:
+                        df_user_bench_stats_e = p.generate_benchmark_stats_wrapper(dict_raw_electricity, cached_weather,
+                                                                                    model_registry)
+                    if df_user_bench_stats_f is None:
+                        df_user_bench_stats_f = p.generate_benchmark_stats_wrapper(dict_raw_fossil_fuel, cached_weather,
+                                                                                    model_registry)
     
-                building_test.benchmark(use_default=False,
-                                        df_benchmark_stats_electricity=df_user_bench_stats_e,
-                                        df_benchmark_stats_fossil_fuel=df_user_bench_stats_f)
-                building_test.ee_assess(use_default=False,
-                                        df_benchmark_stats_electricity=df_user_bench_stats_e,
-                                        df_benchmark_stats_fossil_fuel=df_user_bench_stats_f)
+                    building_test.benchmark(use_default=False,
+                                            df_benchmark_stats_electricity=df_user_bench_stats_e,
+                                            df_benchmark_stats_fossil_fuel=df_user_bench_stats_f)
+                    building_test.ee_assess(use_default=False,
+                                            df_benchmark_stats_electricity=df_user_bench_stats_e,
+                                            df_benchmark_stats_fossil_fuel=df_user_bench_stats_f)
     
-            building_test.calculate_savings()
-            building_test.plot_savings()
-            building_test.disaggregate_consumption_wrapper()
+                building_test.calculate_savings()
+                building_test.plot_savings()
+                building_test.disaggregate_consumption_wrapper()
     
-            # Output to files
-            # Save FIM to csv
-            if (hasattr(building_test, 'FIM_table_e')):
-                if write_model: building_test.coeff_out_e.to_csv(report_path + 'bldg_' + str(building_test.bldg_id) + "_Electricity Coeffs_out.csv")
-                if write_fim: building_test.FIM_table_e.to_csv(report_path + 'bldg_' + str(building_test.bldg_id) + "_Electricity FIM_recommendations.csv")
-            if (hasattr(building_test, 'FIM_table_f')):
-                if write_model: building_test.coeff_out_f.to_csv(report_path + 'bldg_' + str(building_test.bldg_id) + "_Fossil Fuel Coeffs_out.csv")
-                if write_fim: building_test.FIM_table_f.to_csv(report_path + 'bldg_' + str(building_test.bldg_id) + "_Fossil Fuel FIM_recommendations.csv")
+                # Output to files
+                # Save FIM to csv
+                if (hasattr(building_test, 'FIM_table_e')):
+                    if write_model: building_test.coeff_out_e.to_csv(report_path + 'bldg_' + str(building_test.bldg_id) + "_Electricity Coeffs_out.csv")
+                    if write_fim: building_test.FIM_table_e.to_csv(report_path + 'bldg_' + str(building_test.bldg_id) + "_Electricity FIM_recommendations.csv")
+                if (hasattr(building_test, 'FIM_table_f')):
+                    if write_model: building_test.coeff_out_f.to_csv(report_path + 'bldg_' + str(building_test.bldg_id) + "_Fossil Fuel Coeffs_out.csv")
+                    if write_fim: building_test.FIM_table_f.to_csv(report_path + 'bldg_' + str(building_test.bldg_id) + "_Fossil Fuel FIM_recommendations.csv")
     
-            # Generate static HTML report
-            report_building = report.Report(building = building_test)
-            report_building.generate_building_report_beta(report_path)
-            return True, building_test
-        else:
-            print("No meaningful change-point model was found for the current building.")
-            return False, None
+                # Generate static HTML report
+                report_building = report.Report(building = building_test)
+                report_building.generate_building_report_beta(report_path)
+                return True, building_test
+            else:
+                print("No meaningful change-point model was found for the current building.")
+                return False, None
+    finally:
+        if model_registry is not None:
+            model_registry.close()
 
 
 def summary_html(report_path, start_id, end_id):
@@ -127,25 +147,40 @@ def run_batch(
     saving_target=2, 
     cached_weather=True, 
     batch_report=False,
-    use_default_benchmark_data=True
+    use_default_benchmark_data=True,
+    use_model_registry=True,
+    fit_options=None,
+    weather_source='isd'
     ):
-    
+    weather.Weather.set_weather_source(weather_source)
+
+    # Initialize a portfolio instance
+    s_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    data_path = s_path + '/Data/'
+    p = portfolio.Portfolio('Test')
+    p.read_raw_data_from_xlsx(data_path + 'portfolio.xlsx')
+
     # Conditionally generate the benchmark stats for the porfolio
     if use_default_benchmark_data:
         df_user_bench_stats_e, df_user_bench_stats_f = None, None
     else:
-        # Initialize a portfolio instance
-        s_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-        data_path = s_path + '/Data/'
-        p = portfolio.Portfolio('Test')
-        p.read_raw_data_from_xlsx(data_path + 'portfolio.xlsx')
-
-        # 1 ~ electricity; 2 ~ fossil fuel
-        dict_raw_electricity = p.get_portfolio_raw_data_by_spaceType_and_utilityType(space_type, utility_type=1)
-        dict_raw_fossil_fuel = p.get_portfolio_raw_data_by_spaceType_and_utilityType(space_type, utility_type=2)
-        df_user_bench_stats_e = p.generate_benchmark_stats_wrapper(dict_raw_electricity, cached_weather)
-        df_user_bench_stats_f = p.generate_benchmark_stats_wrapper(dict_raw_fossil_fuel, cached_weather)
+        model_registry = registry.ModelRegistry() if use_model_registry else None
+        try:
+            # 1 ~ electricity; 2 ~ fossil fuel
+            dict_raw_electricity = p.get_portfolio_raw_data_by_spaceType_and_utilityType(space_type, utility_type=1)
+            dict_raw_fossil_fuel = p.get_portfolio_raw_data_by_spaceType_and_utilityType(space_type, utility_type=2)
+            df_user_bench_stats_e = p.generate_benchmark_stats_wrapper(dict_raw_electricity, cached_weather,
+                                                                       model_registry)
+            df_user_bench_stats_f = p.generate_benchmark_stats_wrapper(dict_raw_fossil_fuel, cached_weather,
+                                                                       model_registry)
+        finally:
+            if model_registry is not None:
+                model_registry.close()
         
+    # Load the buildings and fetch the weather of the whole batch once per station-year
+    d_prepared_buildings = {i: load_building(p, i, saving_target) for i in range(start_id, end_id+1)}
+    portfolio.Portfolio.prefetch_weather(list(d_prepared_buildings.values()), cached_weather)
+
     v_single_buildings = []
     v_single_building_reports = []
     for i in range(start_id, end_id+1):
@@ -157,9 +192,14 @@ def run_batch(
             cached_weather=cached_weather,
             use_default_benchmark_data=use_default_benchmark_data, 
             df_user_bench_stats_e=df_user_bench_stats_e,
-            df_user_bench_stats_f=df_user_bench_stats_f
+            df_user_bench_stats_f=df_user_bench_stats_f,
+            use_model_registry=use_model_registry,
+            fit_options=fit_options,
+            prepared_building=d_prepared_buildings[i],
+            weather_source=weather_source
             )[1]
         v_single_buildings.append(single_building)
+    weather.Weather.clear_cache()
 
     if batch_report:
         report_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + '/outputs/'
@@ -175,6 +215,8 @@ def main():
     # run_single(bldg_id = 11, saving_target=2, cached_weather=True)
     # run_single(bldg_id=18, saving_target=3, cached_weather=True)
     # run_single(bldg_id=10, saving_target=2, cached_weather=False)
+    # Several workers can share one weather cache: start 'python weather_service.py' and run with
+    # run_batch(..., cached_weather=False, weather_source='service')
 
     # Uncomment the line below [delete the '#' before run_batch(...)] to run the analysis for buildings between start_id and end_id
     run_batch(start_id = 1, end_id = 3, saving_target=2, cached_weather=False, batch_report=True)
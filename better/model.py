@@ -9,13 +9,59 @@ NOTICE.  This Software was developed under funding from the U.S. Department of E
 '''
 
 from scipy import optimize, stats
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import functools
+import time
 
 import constants
 
 
+class FitBudgetExceeded(Exception):
+    # Raised inside the optimizer when a fit runs past its time budget
+    pass
+
+
+class FitResult:
+    # Predictions and residual metrics of one change-point fit, computed once and read-only afterwards.
+    # The adjusted R-squared counts the non-zero coefficients as parameters (R_Squared used
+    # len(np.nonzero(p)), which is always 1).
+    __slots__ = ('p', 'predictions', 'residuals', 'sse', 'r2', 'adjusted_r2', 'rmse')
+
+    def __init__(self, temperature, eui, p):
+        p = np.array(p, dtype=float)
+        y = np.array(eui, dtype=float)
+        predictions = InverseModel.predict(p, np.asarray(temperature, dtype=float).ravel())[0]
+        residuals = y - predictions
+        n, n_p = len(y), np.count_nonzero(p)
+        sse = np.sum(residuals ** 2)
+        r2 = 1 - sse / np.sum((y - np.mean(y)) ** 2)
+        adjusted_r2 = 1 - (1 - r2) * (n - 1) / (n - n_p - 1) if n - n_p - 1 != 0 else r2
+        for a, v in zip(FitResult.__slots__, (p, predictions, residuals, sse, r2, adjusted_r2,
+                                              np.sqrt(sse / n) if n else np.nan)):
+            if isinstance(v, np.ndarray):
+                v.setflags(write=False)
+            object.__setattr__(self, a, v)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FitResult is read-only')
+
+    def __delattr__(self, name):
+        raise AttributeError('FitResult is read-only')
+
+
 class InverseModel:
-    def __init__(self, temperature, eui, energy_type='Energy type unknown', significance_threshold=0.1):
+    fit_version = 3  # Increase when the fitting procedure changes so stored fit results are not reused
+    # Attributes saved to and restored from the model registry
+    record_attributes = ['p', 'e', 'p_init', 'hcp', 'ccp', 'base', 'hsl', 'csl', 'p_base', 'p_hsl', 'p_csl',
+                         'hsl_insignificant', 'csl_insignificant', 'r2', 'model_type_str', 'cp_txt',
+                         'coeff_validation', 'coeffs', 'model_p', 'loocv_scores', 'fit_path', 'fit_strategy']
+    model_shapes = ['3P Cooling', '3P Heating', '4P', '5P']
+    n_parameters = {'3P Cooling': 3, '3P Heating': 3, '4P': 4, '5P': 5}
+
+    def __init__(self, temperature, eui, energy_type='Energy type unknown', significance_threshold=0.1,
+                 fit_method='exact', model_selection='significance', max_nfev=None, fit_time_budget=None,
+                 time_budget=None, warm_start=False, n_jobs=1, patience=None, deadline=None):
 
         if (np.size(eui) != np.size(temperature)):
             print("Please make sure eui and temperature arrays have the same length")
@@ -42,6 +88,36 @@ class InverseModel:
             self.hsl_insignificant = False  # assume significant heating slope
             self.csl_insignificant = False  # assume significant cooling slope
             self.best_model = None
+            # 'exact' ~ profile least squares over candidate change-points, 'curve_fit' ~ scipy optimizer
+            self.fit_method = fit_method
+            self.n_cp_grid = 20  # Evenly spaced change-point candidates added to the data points
+            # 'significance' ~ slope p-values, 'loocv' ~ smallest leave-one-out prediction error (PRESS)
+            self.model_selection = model_selection
+            # Fitting budgets; a fit that runs out of budget falls back to the coarse change-point grid
+            self.max_nfev = max_nfev  # Function evaluations per curve_fit call
+            self.fit_time_budget = fit_time_budget  # Seconds per curve_fit call
+            self.time_budget = time_budget  # Seconds per fit_model call, after which every fit uses the grid
+            # time.perf_counter() at which the time budget runs out, e.g. shared by the fuels of one building;
+            # None ~ time_budget seconds from the start of each fit_model call
+            self.deadline = deadline
+            self.n_cp_coarse = 6  # Evenly spaced change-point candidates of the coarse grid
+            # Change-point window search of the curve_fit method (see optimize_cp_limit)
+            self.warm_start = warm_start  # Refits within the chosen window start from its solution
+            self.n_jobs = n_jobs  # Windows evaluated concurrently
+            self.patience = patience  # Stop once R-squared has not improved for this many windows
+            self.fit_deadline = None
+            self.fit_path = []  # Strategy used by each fit: 'curve_fit', 'exact' or 'coarse_grid'
+            # Sort the data once for the exact change-point solver, read-only like the fit results
+            order = np.argsort(np.asarray(self.temperature, dtype=float), kind='mergesort')
+            self.x_sorted = np.asarray(self.temperature, dtype=float)[order]
+            self.y_sorted = np.asarray(self.eui, dtype=float)[order]
+            self.x_sorted.setflags(write=False)
+            self.y_sorted.setflags(write=False)
+
+    @property
+    def p(self):
+        # The coefficients of the last fit, held (read-only) by its FitResult
+        return self.fit_result.p
 
     @staticmethod
     def piecewise_linear(x, hcp, ccp, base, hsl, csl):
@@ -49,97 +125,896 @@ class InverseModel:
         #       \            /
         # y0     \__________/
         #        cpL      cpR
+        x_array = np.asarray(x, dtype=float)
+        return InverseModel.predict(np.array([[hcp, ccp, base, hsl, csl]], dtype=float),
+                                    x_array.ravel())[0].reshape(x_array.shape)
 
-        # Handle 3P models when use this function to predict.
-        if np.isnan(hcp) and np.isnan(hsl):
-            hcp = ccp
-            hsl = 0
-        if np.isnan(csl) and np.isnan(csl):
-            ccp = hcp
-            csl = 0
-
-        conds = [x < hcp, (x >= hcp) & (x <= ccp), x > ccp]
+    @staticmethod
+    def predict(m_p, x):
+        # Evaluate piecewise_linear for many coefficient sets in one broadcast operation
+        # m_p: (n_models, 5) array of [hcp, ccp, base, hsl, csl]
+        # x: (n_periods,) temperatures shared by all models, or (n_models, n_periods)
+        # Returns the (n_models, n_periods) predictions
+        m_p = np.atleast_2d(np.asarray(m_p, dtype=float))
+        hcp, ccp, base, hsl, csl = [m_p[:, [i]] for i in range(5)]
+        x = np.atleast_2d(np.asarray(x, dtype=float))
 
-        funcs = [lambda x: hsl * x + base - hsl * hcp,
-                 lambda x: base,
-                 lambda x: csl * x + base - csl * ccp]
+        # Handle 3P models when use this function to predict.
+        heating_missing = np.isnan(hcp) & np.isnan(hsl)
+        hcp = np.where(heating_missing, ccp, hcp)
+        hsl = np.where(heating_missing, 0, hsl)
+        cooling_missing = np.isnan(csl)
+        ccp = np.where(cooling_missing, hcp, ccp)
+        csl = np.where(cooling_missing, 0, csl)
 
-        return np.piecewise(x, conds, funcs)
+        # Same precedence as np.piecewise: later conditions win, 0 where none holds
+        y = np.where(x < hcp, hsl * x + base - hsl * hcp, 0.0)
+        y = np.where((x >= hcp) & (x <= ccp), base, y)
+        return np.where(x > ccp, csl * x + base - csl * ccp, y)
 
     def rmse(self):
-        yp = self.piecewise_linear(self.temperature, *self.p)
-        y = self.eui
-        return np.sqrt(np.mean([(i - j) ** 2 for i, j in zip(y, yp)]))
+        return self.fit_result.rmse
 
     def R_Squared(self, adjusted_r2_calc=False):
-        x = self.temperature
-        y = self.eui
-        residuals = y - self.piecewise_linear(x, *self.p)
-        ss_res = np.sum(residuals ** 2)
-        ss_tot = np.sum((y - np.mean(y)) ** 2)
-        rsquared = 1 - (ss_res / ss_tot)
-        r2_result = rsquared
-        n = len(self.eui)
-        numP = len(np.nonzero(self.p))
-        # If we need to calculate adjusted r-squared
-        if (adjusted_r2_calc and n - numP - 1 != 0):
-            r2_result = 1 - (1 - rsquared) * (n - 1) / (n - numP - 1)
-
+        # The metrics are computed once per fit by FitResult
+        r2_result = self.fit_result.adjusted_r2 if adjusted_r2_calc else self.fit_result.r2
         self.r2 = r2_result
         return (r2_result)
 
-    def fit(self):
+    def bounds(self):
+        # Current (lower, upper) bounds of [hcp, ccp, base, hsl, csl]
+        return ([self.hcp_min, self.ccp_min, self.base_min, self.hsl_min, self.csl_min],
+                [self.hcp_max, self.ccp_max, self.base_max, self.hsl_max, self.csl_max])
+
+    def solve(self, lower, upper, p0=None):
+        # Fit the model within the given bounds without changing the instance; p0 warm-starts curve_fit
+        if self.budget_spent():
+            self.fit_path.append('coarse_grid')
+            return self.fit_exact(lower, upper, coarse=True)
+        if self.fit_method == 'curve_fit':
+            if p0 is not None:
+                p0 = np.clip(p0, lower, upper)
+            try:
+                result = optimize.curve_fit(self.budgeted(self.piecewise_linear), self.temperature, self.eui,
+                                            p0=p0, bounds=(lower, upper), max_nfev=self.max_nfev)
+            except (RuntimeError, FitBudgetExceeded):
+                # Evaluation or time budget exceeded
+                self.fit_path.append('coarse_grid')
+                return self.fit_exact(lower, upper, coarse=True)
+            self.fit_path.append('curve_fit')
+            return result
+        self.fit_path.append('exact')
+        return self.fit_exact(lower, upper)
+
+    def budget_spent(self):
+        return self.fit_deadline is not None and time.perf_counter() > self.fit_deadline
+
+    def budgeted(self, f):
+        # Wrap the model function so the optimizer stops once the per-fit time budget is spent
+        if self.fit_time_budget is None:
+            return f
+        deadline = time.perf_counter() + self.fit_time_budget
+
+        @functools.wraps(f)  # keeps the signature curve_fit uses to count the parameters
+        def f_budgeted(*args):
+            if time.perf_counter() > deadline:
+                raise FitBudgetExceeded()
+            return f(*args)
+        return f_budgeted
+
+    def fit(self, p0=None):
         try:
-            self.p, self.e = optimize.curve_fit(
-                self.piecewise_linear,
-                self.temperature,
-                self.eui,
-                bounds=([self.hcp_min, self.ccp_min, self.base_min, self.hsl_min, self.csl_min],
-                        [self.hcp_max, self.ccp_max, self.base_max, self.hsl_max, self.csl_max]
-                        )
-            )
-            # Model coefficients
-            self.hcp, self.ccp, self.base, self.hsl, self.csl = self.p
-
-            # Get p-value from t-stes for the model coefficients
-            n = len(self.temperature)
-            self.p_base = stats.t.sf(self.base / np.sqrt(np.diag(self.e)[2] / n), df=n - 2)
-            self.p_hsl = stats.t.cdf(self.hsl / np.sqrt(np.diag(self.e)[3] / n), df=n - 2)
-            self.p_csl = stats.t.sf(self.csl / np.sqrt(np.diag(self.e)[4] / n), df=n - 2)
-            # self.p_hcp = stats.t.cdf(abs(self.hcp - self.hcp_min) / np.sqrt(np.diag(self.e)[0]/n), df = n-2)
-            # self.p_ccp = stats.t.cdf(abs(self.ccp - self.ccp_max) / np.sqrt(np.diag(self.e)[1]/n), df = n-2)
+            self.set_fit(*self.solve(*self.bounds(), p0=p0))
         except:
             self.has_fit = False
 
+    def set_fit(self, p, e):
+        self.fit_result = FitResult(self.temperature, self.eui, p)
+        self.e = e
+        # Model coefficients
+        self.hcp, self.ccp, self.base, self.hsl, self.csl = self.p
+
+        # Get p-value from t-stes for the model coefficients
+        n = len(self.temperature)
+        self.p_base = stats.t.sf(self.base / np.sqrt(np.diag(self.e)[2] / n), df=n - 2)
+        self.p_hsl = stats.t.cdf(self.hsl / np.sqrt(np.diag(self.e)[3] / n), df=n - 2)
+        self.p_csl = stats.t.sf(self.csl / np.sqrt(np.diag(self.e)[4] / n), df=n - 2)
+        # self.p_hcp = stats.t.cdf(abs(self.hcp - self.hcp_min) / np.sqrt(np.diag(self.e)[0]/n), df = n-2)
+        # self.p_ccp = stats.t.cdf(abs(self.ccp - self.ccp_max) / np.sqrt(np.diag(self.e)[1]/n), df = n-2)
+
+    def cp_candidates(self, cp_min, cp_max, coarse=False):
+        # Candidate change-points: the observed temperatures inside the bounds, the bounds themselves
+        # and an evenly spaced grid in between (the same as batch_cp_candidates); only a few grid points
+        # for the coarse grid
+        if coarse:
+            return np.linspace(cp_min, cp_max, self.n_cp_coarse)
+        return self.batch_cp_candidates(self.x_sorted[None, :], np.array([cp_min]), np.array([cp_max]),
+                                        self.n_cp_grid)[0]
+
+    @staticmethod
+    def segment_candidates(x, y, hcp_candidates, ccp_candidates,
+                           base_bounds=(0, np.inf), hsl_bounds=(-np.inf, 0), csl_bounds=(0, np.inf)):
+        # Change-points that are optimal strictly between two observed temperatures (Hudson, 1966). Once
+        # the points below hcp and above ccp are fixed, each side is a line with its own intercept, so a
+        # change-point follows in closed form from where that line meets the baseload. Every active set
+        # of the slope and baseload bounds is tried; the solver rejects the combinations that are not
+        # optimal, and a bound that is infinite (or a zero slope) gives no finite change-point.
+        # x, y: (n_models, n_obs) sorted, NaN padded; the candidates (n_models, n_candidates), NaN padded,
+        # span the change-point windows. Bounds are scalars or (n_models,) arrays.
+        # Returns (rows, hcp) and (rows, ccp) extra candidates (baseload at a bound, where the two sides
+        # decouple) and (rows, hcp, ccp) pairs (free baseload), rows being the model of each
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        hcp_candidates = np.asarray(hcp_candidates, dtype=float)
+        ccp_candidates = np.asarray(ccp_candidates, dtype=float)
+        n_models, n_obs = x.shape
+        model = np.arange(n_models)
+        valid = np.isfinite(x) & np.isfinite(y)
+        n = np.sum(valid, axis=1)
+
+        # Centered temperature (NaN padded) and its prefix sums; cumsum keeps the sums independent of the padding
+        x_shift = np.cumsum(np.where(valid, x, 0.0), axis=1)[:, -1] / np.maximum(n, 1)
+        xs = np.where(valid, x - x_shift[:, None], np.nan)
+        x0, y0 = np.where(valid, xs, 0.0), np.where(valid, y, 0.0)
+
+        def prefix_sum(v):
+            return np.concatenate([np.zeros((n_models, 1)), np.cumsum(v, axis=1)], axis=1)
+        c_n, c_x, c_y = prefix_sum(valid.astype(float)), prefix_sum(x0), prefix_sum(y0)
+        c_xx, c_xy = prefix_sum(x0 * x0), prefix_sum(x0 * y0)
+
+        def at(c, idx):
+            # c[model, idx] for an index array whose first axis is the model (or 1)
+            idx = np.asarray(idx)
+            return c[model.reshape((-1,) + (1,) * (idx.ndim - 1)), idx]
+
+        def per_model(v):
+            return np.broadcast_to(np.asarray(v, dtype=float), (n_models,))
+
+        def line(a, b, slope=None):
+            # Least squares line over the sorted points [a, b): (intercept, slope) in centered temperature
+            s_n, s_x, s_y, s_xx, s_xy = [at(c, b) - at(c, a) for c in (c_n, c_x, c_y, c_xx, c_xy)]
+            if slope is None:
+                slope = (s_n * s_xy - s_x * s_y) / (s_n * s_xx - s_x ** 2)
+            else:
+                slope = slope[:, None]
+            return (s_y - slope * s_x) / s_n, np.broadcast_to(slope, s_n.shape)
+
+        def level(s_n, s_r, s_rr, s_ry, s_y, slope=None):
+            # Baseload of the fit base + slope * r given the sums of the regressor r
+            if slope is None:
+                return (s_y * s_rr - s_r * s_ry) / (s_n * s_rr - s_r ** 2)
+            return (s_y - slope[:, None, None] * s_r) / s_n
+
+        def in_segment(cp, k):
+            # Whether cp lies between the k-th and (k + 1)-th observed temperatures of its model
+            return (cp >= at(xs, k - 1)) & (cp <= at(xs, k))
+
+        def slopes(bounds):
+            # Free slope or fixed at one of its bounds
+            return [None] + [per_model(b) for b in bounds]
+
+        def collect(target, keep, *values):
+            shape = np.broadcast(keep, *values).shape
+            keep = np.broadcast_to(keep, shape)
+            rows = np.broadcast_to(model.reshape((-1,) + (1,) * (len(shape) - 1)), shape)
+            target.append([rows[keep]] + [np.broadcast_to(v, shape)[keep] for v in values])
+
+        k = np.arange(1, n_obs)[None, :]
+        start, end = np.zeros_like(k), n[:, None]
+        i, j = k[:, :, None], k[:, None, :]
+        bases = [per_model(b)[:, None] for b in base_bounds]
+        hcp_c = hcp_candidates - x_shift[:, None]
+        ccp_c = ccp_candidates - x_shift[:, None]
+        x_key = np.where(valid, xs, np.inf)
+        hcp_extra, ccp_extra, pairs = [], [], []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for hsl in slopes(hsl_bounds):
+                l_icpt, l_sl = line(start, k, hsl)
+                # Baseload at a bound
+                for base in bases:
+                    hcp = (base - l_icpt) / l_sl
+                    collect(hcp_extra, in_segment(hcp, k), hcp)
+                for csl in slopes(csl_bounds):
+                    r_icpt, r_sl = line(k, end, csl)
+                    # Both change-points inside data segments with points in between
+                    base = (at(c_y, j) - at(c_y, i)) / (j - i)
+                    hcp = (base - l_icpt[:, :, None]) / l_sl[:, :, None]
+                    ccp = (base - r_icpt[:, None, :]) / r_sl[:, None, :]
+                    collect(pairs, (i < j) & in_segment(hcp, i) & in_segment(ccp, j), hcp, ccp)
+                    # Equal change-points, where the two lines cross
+                    cp = (r_icpt - l_icpt) / (l_sl - r_sl)
+                    collect(pairs, in_segment(cp, k), cp, cp)
+            # One change-point at a candidate and the other inside a data segment: (models, candidates, segments)
+            kk = k[:, None, :]
+            m = np.sum(x_key[:, None, :] < hcp_c[:, :, None], axis=2)
+            s_r, s_ry = at(c_x, m) - hcp_c * at(c_n, m), at(c_xy, m) - hcp_c * at(c_y, m)
+            s_rr = np.maximum(at(c_xx, m) - 2 * hcp_c * at(c_x, m) + hcp_c ** 2 * at(c_n, m), 0)
+            for csl in slopes(csl_bounds):
+                r_icpt, r_sl = line(k, end, csl)
+                for base in bases:
+                    ccp = (base - r_icpt) / r_sl
+                    collect(ccp_extra, in_segment(ccp, k), ccp)
+                for hsl in slopes(hsl_bounds):
+                    base = level(at(c_n, kk), s_r[:, :, None], s_rr[:, :, None], s_ry[:, :, None], at(c_y, kk), hsl)
+                    ccp = (base - r_icpt[:, None, :]) / r_sl[:, None, :]
+                    keep = (m[:, :, None] <= kk) & in_segment(ccp, kk) & (ccp >= hcp_c[:, :, None])
+                    collect(pairs, keep, hcp_c[:, :, None], ccp)
+            m = np.sum(x_key[:, None, :] <= ccp_c[:, :, None], axis=2)
+            s_r = (at(c_x, end) - at(c_x, m)) - ccp_c * (at(c_n, end) - at(c_n, m))
+            s_ry = (at(c_xy, end) - at(c_xy, m)) - ccp_c * (at(c_y, end) - at(c_y, m))
+            s_rr = np.maximum((at(c_xx, end) - at(c_xx, m)) - 2 * ccp_c * (at(c_x, end) - at(c_x, m))
+                              + ccp_c ** 2 * (at(c_n, end) - at(c_n, m)), 0)
+            for hsl in slopes(hsl_bounds):
+                l_icpt, l_sl = line(start, k, hsl)
+                for csl in slopes(csl_bounds):
+                    base = level(n[:, None, None] - kk, s_r[:, :, None], s_rr[:, :, None], s_ry[:, :, None],
+                                 at(c_y, n[:, None, None]) - at(c_y, kk), csl)
+                    hcp = (base - l_icpt[:, None, :]) / l_sl[:, None, :]
+                    keep = (m[:, :, None] >= kk) & in_segment(hcp, kk) & (hcp <= ccp_c[:, :, None])
+                    collect(pairs, keep, hcp, ccp_c[:, :, None])
+
+        # Back to temperatures; round-off can move a change-point taken from the bounds just outside them
+        windows = [(np.fmin.reduce(c, axis=1), np.fmax.reduce(c, axis=1)) for c in (hcp_candidates, ccp_candidates)]
+
+        def restore(collected, column, a):
+            rows = np.concatenate([c[0] for c in collected] + [np.zeros(0, dtype=int)])
+            values = np.concatenate([c[column] for c in collected] + [np.zeros(0)]) + x_shift[rows]
+            return rows, np.clip(values, windows[a][0][rows], windows[a][1][rows])
+        hcp_rows, hcp_extra = restore(hcp_extra, 1, 0)
+        ccp_rows, ccp_extra = restore(ccp_extra, 1, 1)
+        pair_rows, pair_hcp = restore(pairs, 1, 0)
+        pairs = np.unique(np.column_stack([pair_rows, pair_hcp, restore(pairs, 2, 1)[1]]), axis=0)
+        return ((hcp_rows, hcp_extra), (ccp_rows, ccp_extra),
+                (pairs[:, 0].astype(int), pairs[:, 1], pairs[:, 2]))
+
+    @staticmethod
+    def add_candidates(candidates, rows, values):
+        # Append values to the NaN padded (n_models, n_candidates) candidates of their rows, keeping each row sorted
+        counts = np.bincount(rows, minlength=len(candidates))
+        order = np.argsort(rows, kind='mergesort')
+        rows, values = rows[order], values[order]
+        cols = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        extra = np.full((len(candidates), counts.max(initial=0)), np.nan)
+        extra[rows, cols] = values
+        return np.sort(np.concatenate([candidates, extra], axis=1), axis=1)
+
+    @staticmethod
+    def exact_least_squares(x, y, hcp_candidates, ccp_candidates,
+                            base_bounds=(0, np.inf), hsl_bounds=(-np.inf, 0), csl_bounds=(0, np.inf),
+                            equal_cp=False):
+        # profile_least_squares over the candidates and the change-points that are optimal inside a data
+        # segment (segment_candidates), which makes the result the least squares optimum within the
+        # change-point windows spanned by the candidates. The one case left to the candidates is a V-shaped
+        # 4P with the baseload at its bound. Same arguments and results as profile_least_squares.
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        n_models = x.shape[0]
+        equal_cp = np.broadcast_to(np.asarray(equal_cp, dtype=bool), (n_models,))
+        bounds = {'base_bounds': base_bounds, 'hsl_bounds': hsl_bounds, 'csl_bounds': csl_bounds}
+        (h_rows, h), (c_rows, c), (rows, p_h, p_c) = InverseModel.segment_candidates(
+            x, y, hcp_candidates, ccp_candidates, **bounds)
+        # With equal change-points both lists take every candidate, and a pair stands for two equal pairs
+        eq_h, eq_c, eq = equal_cp[h_rows], equal_cp[c_rows], equal_cp[rows]
+        hcp_candidates = InverseModel.add_candidates(np.asarray(hcp_candidates, dtype=float),
+                                                     np.concatenate([h_rows, c_rows[eq_c]]), np.concatenate([h, c[eq_c]]))
+        ccp_candidates = InverseModel.add_candidates(np.asarray(ccp_candidates, dtype=float),
+                                                     np.concatenate([c_rows, h_rows[eq_h]]), np.concatenate([c, h[eq_h]]))
+        rows, p_h, p_c = (np.concatenate([rows[~eq], rows[eq], rows[eq]]),
+                          np.concatenate([p_h[~eq], p_h[eq], p_c[eq]]),
+                          np.concatenate([p_c[~eq], p_h[eq], p_c[eq]]))
+        p, sse = InverseModel.profile_least_squares(x, y, hcp_candidates, ccp_candidates, equal_cp=equal_cp, **bounds)
+        if len(rows):
+            # One solver row per pair, so that only the pairs themselves are solved
+            def of_rows(bound):
+                return tuple(np.broadcast_to(np.asarray(b, dtype=float), (n_models,))[rows] for b in bound)
+            p_pairs, sse_pairs = InverseModel.profile_least_squares(
+                x[rows], y[rows], p_h[:, None], p_c[:, None], equal_cp=equal_cp[rows],
+                **{name: of_rows(bound) for name, bound in bounds.items()})
+            # Best pair of each model, kept where it beats the candidate grid
+            order = np.lexsort((sse_pairs, rows))
+            first = order[np.concatenate([[True], rows[order][1:] != rows[order][:-1]])]
+            better = first[sse_pairs[first] < sse[rows[first]]]
+            p[rows[better]], sse[rows[better]] = p_pairs[better], sse_pairs[better]
+        return p, sse
+
+    def fit_exact(self, lower, upper, coarse=False):
+        # Once the change-points are fixed the model is linear, so every candidate (hcp, ccp) pair is
+        # solved in closed form (exact_least_squares); the coarse grid only tries its grid points
+        x, y = self.x_sorted, self.y_sorted
+        if not (np.all(np.isfinite(x)) and np.all(np.isfinite(y))):
+            raise ValueError("Temperature and eui arrays must be finite")
+        hcp_candidates = self.cp_candidates(lower[0], upper[0], coarse)
+        ccp_candidates = self.cp_candidates(lower[1], upper[1], coarse)
+        solver = self.profile_least_squares if coarse else self.exact_least_squares
+        p = solver(x[None, :], y[None, :], hcp_candidates[None, :], ccp_candidates[None, :],
+                   base_bounds=(lower[2], upper[2]), hsl_bounds=(lower[3], upper[3]),
+                   csl_bounds=(lower[4], upper[4]))[0][0]
+        if not np.all(np.isfinite(p)):
+            raise ValueError("No feasible change-point model found")
+        return p, self.covariance(x[None, :], y[None, :], p[None, :])[0]
+
+    @staticmethod
+    def profile_least_squares(x, y, hcp_candidates, ccp_candidates,
+                              base_bounds=(0, np.inf), hsl_bounds=(-np.inf, 0), csl_bounds=(0, np.inf),
+                              equal_cp=False):
+        # x, y: (n_models, n_obs) arrays, each row sorted by temperature with NaN padding at the end
+        # hcp_candidates, ccp_candidates: (n_models, n_candidates) arrays, NaN padded
+        # Bounds are (lower, upper) pairs of scalars or (n_models,) arrays
+        # equal_cp: scalar or (n_models,) bool, only consider hcp == ccp (3P and 4P shapes)
+        # Returns the optimal [hcp, ccp, base, hsl, csl] (n_models, 5) and the SSE (n_models,)
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        n_models = x.shape[0]
+        valid = np.isfinite(x) & np.isfinite(y)
+
+        # Center the temperature to keep the expanded sums well conditioned
+        # (sequential sums, so that the NaN padding of a batch does not change the round-off)
+        n_valid = np.maximum(np.sum(valid, axis=1, keepdims=True), 1)
+        x_shift = np.cumsum(np.where(valid, x, 0.0), axis=1)[:, -1:] / n_valid
+        xs = np.where(valid, x - x_shift, 0.0)
+        ys = np.where(valid, y, 0.0)
+        x_key = np.where(valid, x - x_shift, np.inf)
+
+        # Prefix sums of 1, x, y, x^2 and xy along the sorted temperature
+        def prefix_sum(v):
+            return np.concatenate([np.zeros((n_models, 1)), np.cumsum(v, axis=1)], axis=1)
+        c_n, c_x, c_y = prefix_sum(valid.astype(float)), prefix_sum(xs), prefix_sum(ys)
+        c_xx, c_xy = prefix_sum(xs * xs), prefix_sum(xs * ys)
+        n, s_x, s_y, s_xx, s_xy = c_n[:, -1:], c_x[:, -1:], c_y[:, -1:], c_xx[:, -1:], c_xy[:, -1:]
+        s_yy = np.cumsum(ys * ys, axis=1)[:, -1, None, None]
+
+        hcp_c = np.asarray(hcp_candidates, dtype=float) - x_shift
+        ccp_c = np.asarray(ccp_candidates, dtype=float) - x_shift
+
+        # Heating regressor h = min(x - hcp, 0) summed over the points below each candidate hcp
+        k = np.sum(x_key[:, None, :] < hcp_c[:, :, None], axis=2)
+        l_n, l_x, l_y, l_xx, l_xy = [np.take_along_axis(c, k, axis=1) for c in (c_n, c_x, c_y, c_xx, c_xy)]
+        s_h = (l_x - hcp_c * l_n)[:, :, None]
+        s_hh = np.maximum(l_xx - 2 * hcp_c * l_x + hcp_c ** 2 * l_n, 0)[:, :, None]
+        s_hy = (l_xy - hcp_c * l_y)[:, :, None]
+
+        # Cooling regressor g = max(x - ccp, 0) summed over the points above each candidate ccp
+        k = np.sum(x_key[:, None, :] <= ccp_c[:, :, None], axis=2)
+        r_n, r_x, r_y, r_xx, r_xy = [s - np.take_along_axis(c, k, axis=1)
+                                     for s, c in ((n, c_n), (s_x, c_x), (s_y, c_y), (s_xx, c_xx), (s_xy, c_xy))]
+        s_g = (r_x - ccp_c * r_n)[:, None, :]
+        s_gg = np.maximum(r_xx - 2 * ccp_c * r_x + ccp_c ** 2 * r_n, 0)[:, None, :]
+        s_gy = (r_xy - ccp_c * r_y)[:, None, :]
+
+        # Broadcast to (n_models, n_hcp, n_ccp); h and g do not overlap as long as hcp <= ccp
+        n, s_y = n[:, :, None], s_y[:, :, None]
+        pair_ok = np.where(np.broadcast_to(np.asarray(equal_cp, dtype=bool), (n_models,))[:, None, None],
+                           hcp_c[:, :, None] == ccp_c[:, None, :], hcp_c[:, :, None] <= ccp_c[:, None, :])
+
+        def as_bound(v):
+            return np.broadcast_to(np.asarray(v, dtype=float), (n_models,))[:, None, None]
+        base_lo, base_hi = as_bound(base_bounds[0]), as_bound(base_bounds[1])
+        hsl_lo, hsl_hi = as_bound(hsl_bounds[0]), as_bound(hsl_bounds[1])
+        csl_lo, csl_hi = as_bound(csl_bounds[0]), as_bound(csl_bounds[1])
+
+        bounds = {'hsl': (hsl_lo, hsl_hi), 'csl': (csl_lo, csl_hi)}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # h and g never overlap, so for a given base each slope is optimal at clip(a - c * base)
+            # and the profile SSE in the base is a convex 1-D function
+            a_h = np.where(s_hh > 0, s_hy / s_hh, 0.0)
+            c_h = np.where(s_hh > 0, s_h / s_hh, 0.0)
+            a_g = np.where(s_gg > 0, s_gy / s_gg, 0.0)
+            c_g = np.where(s_gg > 0, s_g / s_gg, 0.0)
+
+            # Find the unconstrained base by trying each slope active set (free, or fixed at one of its
+            # finite bounds) and keeping the one whose slopes are consistent with it
+            base = np.full(np.broadcast(s_h, s_g).shape, np.nan)
+            for hsl_fix in InverseModel.active_sets(*bounds['hsl']):
+                for csl_fix in InverseModel.active_sets(*bounds['csl']):
+                    hsl_v = bounds['hsl'][hsl_fix] if hsl_fix is not None else None
+                    csl_v = bounds['csl'][csl_fix] if csl_fix is not None else None
+                    numer = s_y - (s_h * a_h if hsl_v is None else s_h * hsl_v) \
+                                - (s_g * a_g if csl_v is None else s_g * csl_v)
+                    denom = n - (s_h * c_h if hsl_v is None else 0) \
+                              - (s_g * c_g if csl_v is None else 0)
+                    b = numer / denom
+                    consistent = (InverseModel.consistent(a_h - c_h * b, hsl_fix, *bounds['hsl']) &
+                                  InverseModel.consistent(a_g - c_g * b, csl_fix, *bounds['csl']))
+                    base = np.where(consistent & np.isnan(base), b, base)
+
+            # Bound the base, then re-optimize the slopes for it
+            base = np.clip(base, base_lo, base_hi)
+            hsl = np.clip(a_h - c_h * base, hsl_lo, hsl_hi)
+            csl = np.clip(a_g - c_g * base, csl_lo, csl_hi)
+            sse = (s_yy - 2 * (base * s_y + hsl * s_hy + csl * s_gy)
+                   + n * base ** 2 + hsl ** 2 * s_hh + csl ** 2 * s_gg
+                   + 2 * base * (hsl * s_h + csl * s_g))
+            sse = np.where(pair_ok & np.isfinite(sse), sse, np.inf)
+
+        # Pick the best change-point pair for each model
+        flat = sse.reshape(n_models, -1)
+        idx = np.argmin(flat, axis=1)
+        i_h, i_c = np.unravel_index(idx, sse.shape[1:])
+        rows = np.arange(n_models)
+        sse = flat[rows, idx]
+        p = np.column_stack([hcp_c[rows, i_h] + x_shift[:, 0],
+                             ccp_c[rows, i_c] + x_shift[:, 0],
+                             base[rows, i_h, i_c], hsl[rows, i_h, i_c], csl[rows, i_h, i_c]])
+        p[~np.isfinite(sse)] = np.nan
+        return p, sse
+
+    @staticmethod
+    def active_sets(lo, hi):
+        # A slope is either free or fixed at one of its finite bounds (0 ~ lower, 1 ~ upper)
+        return [None] + [i for i, b in enumerate((lo, hi)) if np.isfinite(b).any()]
+
+    @staticmethod
+    def consistent(v, fix, lo, hi, rtol=1e-9):
+        # Whether the unconstrained slope v agrees with the active set: inside the bounds when free,
+        # beyond the bound it is fixed at otherwise. A small tolerance absorbs round-off.
+        lo_tol, hi_tol = rtol * (1 + np.abs(lo)), rtol * (1 + np.abs(hi))
+        if fix is None:
+            return (v >= lo - lo_tol) & (v <= hi + hi_tol)
+        elif fix == 0:
+            return v <= lo + lo_tol
+        else:
+            return v >= hi - hi_tol
+
+    @staticmethod
+    def covariance(x, y, p):
+        # Same estimate as curve_fit: s^2 * pinv(J'J) with the Jacobian of piecewise_linear at p
+        # x, y: (n_models, n_obs) NaN padded arrays; p: (n_models, 5) coefficients (hcp <= ccp)
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        valid = np.isfinite(x) & np.isfinite(y)
+        x = np.where(valid, x, 0.0)
+        hcp, ccp, base, hsl, csl = [p[:, [i]] for i in range(5)]
+        h, g = np.minimum(x - hcp, 0.0), np.maximum(x - ccp, 0.0)
+        jac = np.stack([np.where(x < hcp, -hsl, 0.0),
+                        np.where(x > ccp, -csl, 0.0),
+                        np.ones_like(x),
+                        h,
+                        g], axis=2) * valid[:, :, None]
+        residuals = np.where(valid, y - (base + hsl * h + csl * g), 0.0)
+        dof = np.sum(valid, axis=1) - p.shape[1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s_sq = np.where(dof > 0, np.sum(residuals ** 2, axis=1) / dof, np.inf)
+            cov = np.linalg.pinv(np.transpose(jac, (0, 2, 1)) @ jac) * s_sq[:, None, None]
+        cov[dof <= 0] = np.inf
+        return cov
+
+    @staticmethod
+    def guideline14_metrics(v_residuals, v_eui, v_days, v_model_type, v_fractional_savings,
+                            n_report=12, confidence=0.9):
+        # ASHRAE Guideline 14 CV(RMSE), NMBE and fractional savings uncertainty of many models in one pass
+        # v_residuals, v_eui, v_days: per model arrays of the billing periods in time order, the residuals
+        # being those of the fit (FitResult.residuals, daily EUI)
+        # v_fractional_savings: expected savings / baseline use
+        # n_report: billing periods in the reporting period; confidence: two-sided level of the uncertainty
+        # The metrics are based on the energy use of each period (daily EUI * days)
+        def pad(rows):
+            out = np.full((len(rows), max([len(r) for r in rows], default=1)), np.nan)
+            for i, r in enumerate(rows):
+                out[i, :len(r)] = np.asarray(r, dtype=float)
+            return out
+        days = pad(v_days)
+        e, residuals = pad(v_eui) * days, pad(v_residuals) * days
+        valid = np.isfinite(e) & np.isfinite(residuals)
+        residuals = np.where(valid, residuals, 0.0)
+        n = np.sum(valid, axis=1)
+        n_p = np.array([InverseModel.n_parameters.get(t, 5) for t in v_model_type])
+        f_savings = np.asarray(v_fractional_savings, dtype=float)
 
-    def optimize_cp_limit(self, point):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.sum(np.where(valid, e, 0.0), axis=1) / n
+            dof = n - n_p
+            cv_rmse = np.sqrt(np.sum(residuals ** 2, axis=1) / dof) / mean
+            nmbe = np.sum(residuals, axis=1) / (dof * mean)
+            # Lag-1 autocorrelation of the residuals and the effective number of periods
+            centered = np.where(valid, residuals - np.sum(residuals, axis=1, keepdims=True) / n[:, None], 0.0)
+            rho = np.sum(centered[:, 1:] * centered[:, :-1], axis=1) / np.sum(centered ** 2, axis=1)
+            rho = np.clip(np.nan_to_num(rho), 0, 0.99)
+            n_effective = n * (1 - rho) / (1 + rho)
+            t = stats.t.ppf((1 + confidence) / 2, np.maximum(n_effective - n_p, 1))
+            # Guideline 14 Annex B approximation for monthly data
+            fsu = t * 1.26 * cv_rmse * np.sqrt(n / n_effective * (1 + 2 / n) / n_report) / f_savings
+        return {'cv_rmse': cv_rmse, 'nmbe': nmbe, 'autocorrelation': rho, 'n_effective': n_effective,
+                'fractional_savings_uncertainty': np.where(dof > 0, fsu, np.nan)}
+
+    vbdd_types = ['Constant', 'VBDD Heating', 'VBDD Cooling', 'VBDD Heating-Cooling']
+
+    @staticmethod
+    def fit_vbdd(eui, hdd, cdd, v_bases):
+        # Variable-base degree-day models of many series at once, by exhaustive search over the base grid:
+        # eui = base + hsl * HDD(heating base) + csl * CDD(cooling base), hsl, csl > 0, heating base <= cooling base
+        # eui: (n_models, n_periods) mean daily EUI, NaN padded
+        # hdd, cdd: (n_models, n_periods, n_bases) mean daily degree-days at the v_bases temperatures
+        # The shape (constant, heating, cooling or both) with the largest adjusted R-squared is kept; the
+        # bases count as parameters like the change-points do. Returns a dict of (n_models,) arrays.
+        y = np.atleast_2d(np.asarray(eui, dtype=float))
+        hdd, cdd = np.asarray(hdd, dtype=float), np.asarray(cdd, dtype=float)
+        if hdd.ndim == 2:
+            hdd, cdd = hdd[None], cdd[None]
+        v_bases = np.asarray(v_bases, dtype=float)
+        w = np.isfinite(y) & np.all(np.isfinite(hdd), axis=2) & np.all(np.isfinite(cdd), axis=2)
+        y = np.where(w, y, 0.0)
+        h, c = np.where(w[:, :, None], hdd, 0.0), np.where(w[:, :, None], cdd, 0.0)
+
+        # Centered sums; every candidate is then solved in closed form
+        n = np.sum(w, axis=1).astype(float)
+        n_safe = np.maximum(n, 1)[:, None]
+        s_y = np.sum(y, axis=1)
+        sst = np.sum(y ** 2, axis=1) - s_y ** 2 / n_safe[:, 0]
+        s_h, s_c = np.sum(h, axis=1), np.sum(c, axis=1)
+        v_h = np.sum(h * h, axis=1) - s_h ** 2 / n_safe
+        v_c = np.sum(c * c, axis=1) - s_c ** 2 / n_safe
+        c_hy = np.einsum('mp,mpb->mb', y, h) - s_h * s_y[:, None] / n_safe
+        c_cy = np.einsum('mp,mpb->mb', y, c) - s_c * s_y[:, None] / n_safe
+        v_hc = np.einsum('mpi,mpj->mij', h, c) - s_h[:, :, None] * s_c[:, None, :] / n_safe[:, :, None]
+        tol = 1e-9
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # One degree-day term: (n_models, n_bases)
+            hsl_1, csl_1 = c_hy / v_h, c_cy / v_c
+            sse_h = np.where((v_h > tol) & (hsl_1 > 0), sst[:, None] - hsl_1 * c_hy, np.inf)
+            sse_c = np.where((v_c > tol) & (csl_1 > 0), sst[:, None] - csl_1 * c_cy, np.inf)
+            # Both terms: (n_models, n_heating_bases, n_cooling_bases)
+            det = v_h[:, :, None] * v_c[:, None, :] - v_hc ** 2
+            hsl_2 = (c_hy[:, :, None] * v_c[:, None, :] - c_cy[:, None, :] * v_hc) / det
+            csl_2 = (c_cy[:, None, :] * v_h[:, :, None] - c_hy[:, :, None] * v_hc) / det
+            ok = ((det > tol * v_h[:, :, None] * v_c[:, None, :]) & (det > tol) & (hsl_2 > 0) & (csl_2 > 0) &
+                  (v_bases[:, None] <= v_bases[None, :])[None])
+            sse_hc = np.where(ok, sst[:, None, None] - hsl_2 * c_hy[:, :, None] - csl_2 * c_cy[:, None, :], np.inf)
+
+        rows = np.arange(len(y))
+        i_h, i_c = np.argmin(sse_h, axis=1), np.argmin(sse_c, axis=1)
+        i_hc = np.argmin(sse_hc.reshape(len(y), -1), axis=1)
+        i_hc_h, i_hc_c = np.unravel_index(i_hc, sse_hc.shape[1:])
+        m_sse = np.stack([sst, sse_h[rows, i_h], sse_c[rows, i_c], sse_hc[rows, i_hc_h, i_hc_c]], axis=1)
+        n_p = np.array([1, 3, 3, 5])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m_adjusted_r2 = np.where(n[:, None] > n_p[None, :] + 1,
+                                     1 - (m_sse / (n[:, None] - n_p)) / (sst / (n - 1))[:, None], -np.inf)
+        m_adjusted_r2[~np.isfinite(m_sse) | (sst <= tol * np.sum(y ** 2, axis=1))[:, None]] = -np.inf
+        m_adjusted_r2[:, 0] = np.where(n > 1, 0.0, -np.inf)
+        best = np.argmax(m_adjusted_r2, axis=1)
+
+        nan = np.full(len(y), np.nan)
+        hsl = np.select([best == 1, best == 3], [hsl_1[rows, i_h], hsl_2[rows, i_hc_h, i_hc_c]], 0.0)
+        csl = np.select([best == 2, best == 3], [csl_1[rows, i_c], csl_2[rows, i_hc_h, i_hc_c]], 0.0)
+        heating_base = np.select([best == 1, best == 3], [v_bases[i_h], v_bases[i_hc_h]], nan)
+        cooling_base = np.select([best == 2, best == 3], [v_bases[i_c], v_bases[i_hc_c]], nan)
+        i_heating = np.where(best == 1, i_h, i_hc_h)
+        i_cooling = np.where(best == 2, i_c, i_hc_c)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            base = (s_y - hsl * s_h[rows, i_heating] - csl * s_c[rows, i_cooling]) / n
+            sse = m_sse[rows, best]
+            rmse = np.sqrt(sse / (n - n_p[best]))
+            return {'model_type': np.array(InverseModel.vbdd_types)[best], 'heating_base': heating_base,
+                    'cooling_base': cooling_base, 'base': base, 'hsl': hsl, 'csl': csl,
+                    'r2': np.where(sst > 0, 1 - sse / sst, nan), 'adjusted_r2': m_adjusted_r2[rows, best],
+                    'rmse': rmse, 'cv_rmse': rmse / (s_y / n)}
+
+    @staticmethod
+    def fit_vbdd_batch(series, v_bases):
+        # fit_vbdd for a dict of {key: (eui, hdd, cdd)} or a list of such tuples with any number of periods
+        # Returns a DataFrame indexed by key
+        import pandas as pd
+        if isinstance(series, dict):
+            keys, series = list(series.keys()), list(series.values())
+        else:
+            keys, series = list(range(len(series))), list(series)
+        n_periods = max([np.size(eui) for eui, _, _ in series] + [1])
+        y = np.full((len(series), n_periods), np.nan)
+        hdd = np.full((len(series), n_periods, len(v_bases)), np.nan)
+        cdd = np.full((len(series), n_periods, len(v_bases)), np.nan)
+        for i, (eui, m_hdd, m_cdd) in enumerate(series):
+            y[i, :np.size(eui)], hdd[i, :np.size(eui)], cdd[i, :np.size(eui)] = eui, m_hdd, m_cdd
+        return pd.DataFrame(InverseModel.fit_vbdd(y, hdd, cdd, v_bases), index=keys)
+
+    def fit_vbdd_model(self, m_hdd, m_cdd, v_bases):
+        # Fit a variable-base degree-day model to the same data, kept in vbdd for comparison with the
+        # change-point model
+        result = InverseModel.fit_vbdd(np.asarray(self.eui, dtype=float)[None], m_hdd, m_cdd, v_bases)
+        self.vbdd = {k: v[0].item() for k, v in result.items()}
+        print(self.energy_type + ' VBDD model: ' + self.vbdd['model_type'] + ', R-squared = ' +
+              str(round(self.vbdd['r2'], 3)) + ' (change-point: ' +
+              (str(round(self.r2, 3)) if getattr(self, 'r2', None) is not None else 'no fit') + ')')
+        return self.vbdd
+
+    @staticmethod
+    def pad_series(series):
+        # Stack a ragged collection of (temperature, eui) series into NaN padded (n_models, n_obs)
+        # arrays, each row sorted by temperature with the padding at the end
+        lengths = np.array([np.size(t) for t, _ in series], dtype=int)
+        n_obs = max(lengths.max(), 1) if len(lengths) else 1
+        x = np.full((len(series), n_obs), np.nan)
+        y = np.full((len(series), n_obs), np.nan)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        if len(series):
+            flat_x = np.concatenate([np.asarray(t, dtype=float) for t, _ in series])
+            flat_y = np.concatenate([np.asarray(e, dtype=float) for _, e in series])
+            rows = np.repeat(np.arange(len(series)), lengths)
+            cols = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+            x[rows, cols], y[rows, cols] = flat_x, flat_y
+        # Drop incomplete observations and sort along the rows (NaN sorts to the end)
+        bad = ~(np.isfinite(x) & np.isfinite(y))
+        x[bad], y[bad] = np.nan, np.nan
+        order = np.argsort(x, axis=1, kind='mergesort')
+        return np.take_along_axis(x, order, axis=1), np.take_along_axis(y, order, axis=1)
+
+    @staticmethod
+    def batch_cp_candidates(x, cp_min, cp_max, n_grid=20):
+        # Batched counterpart of cp_candidates with NaN marking unused slots
+        inside = (x > cp_min[:, None]) & (x < cp_max[:, None])
+        grid = cp_min[:, None] + (cp_max - cp_min)[:, None] * np.linspace(0, 1, n_grid)[None, :]
+        candidates = np.sort(np.concatenate([np.where(inside, x, np.nan), grid], axis=1), axis=1)
+        # Trim the columns that are unused in every row
+        return candidates[:, :max(np.max(np.sum(np.isfinite(candidates), axis=1), initial=0), 1)]
+
+    @staticmethod
+    def fit_batch(series, threshold=0.1, significance=0.05, n_grid=20, chunk_size=256, registry=None,
+                  model_selection='significance'):
+        # Fit change-point models for many buildings at once with the exact solver. This follows
+        # fit_model (initial fit, R-squared threshold, slope significance and the joint change-point
+        # search) and model_type, vectorized over buildings.
+        # series: dict of {key: (temperature, eui)} or a list of (temperature, eui) pairs
+        # registry: optional ModelRegistry; only buildings without a stored result are fitted
+        # model_selection: 'significance' or 'loocv' (adds the PRESS of every shape as loocv_* columns)
+        # Returns a DataFrame indexed by key with the model type, R-squared, coeffs and coeff_validation
+        import pandas as pd
+        if isinstance(series, dict):
+            keys, series = list(series.keys()), list(series.values())
+        else:
+            keys, series = list(range(len(series))), list(series)
+        if registry is not None:
+            settings = {'version': InverseModel.fit_version, 'fit_method': 'batch', 'n_cp_grid': n_grid,
+                        'significance_threshold': significance, 'threshold': threshold,
+                        'model_selection': model_selection}
+            hashes = [registry.series_key(t, eui, settings) for t, eui in series]
+            records = registry.get_many(hashes)
+            missing = [i for i, h in enumerate(hashes) if h not in records]
+            print(str(len(keys) - len(missing)) + '/' + str(len(keys)) +
+                  ' change-point models loaded from the model registry.')
+            if missing:
+                df_new = InverseModel.fit_batch([series[i] for i in missing], threshold, significance,
+                                                n_grid, chunk_size, model_selection=model_selection)
+                new_records = [(hashes[i], r) for i, r in zip(missing, df_new.to_dict('records'))]
+                registry.put_many(new_records)
+                records.update(new_records)
+            df_out = pd.DataFrame([records[h] for h in hashes], index=keys)
+            df_out.index.name = 'building_ID'
+            return df_out
+        x, y = InverseModel.pad_series(series)
+        # Chunk buildings of similar length together to keep the padding small
+        order = np.argsort(np.sum(np.isfinite(x), axis=1), kind='mergesort')
+        if model_selection == 'loocv':
+            results = [InverseModel.fit_batch_chunk_loocv(x[order[i:i + chunk_size]], y[order[i:i + chunk_size]],
+                                                          threshold, n_grid)
+                       for i in range(0, len(series), chunk_size)]
+        else:
+            results = [InverseModel.fit_batch_chunk(x[order[i:i + chunk_size]], y[order[i:i + chunk_size]],
+                                                    threshold, significance, n_grid)
+                       for i in range(0, len(series), chunk_size)]
+        columns = ['model_type', 'r2', 'hcp', 'ccp', 'base', 'hsl', 'csl']
+        if model_selection == 'loocv':
+            columns += ['loocv_' + s for s in InverseModel.model_shapes]
+        df = pd.DataFrame({c: np.concatenate([r[c] for r in results]) if results else []
+                           for c in columns}, index=[keys[i] for i in order]).loc[keys]
+
+        # Assign model types and coefficient validation the same way as model_type()
+        hcp, ccp, base, hsl, csl = [df[c].values for c in ('hcp', 'ccp', 'base', 'hsl', 'csl')]
+        types = np.select([np.isnan(df['r2'].values) | (df['model_type'].values == 'No fit'),
+                           (hcp == ccp) & (hsl == 0),
+                           (hcp == ccp) & (csl == 0),
+                           (hcp == ccp) & (csl != 0) & (hsl != 0),
+                           (hcp != ccp) & (csl != 0) & (hsl != 0)],
+                          ['No fit', '3P Cooling', '3P Heating', '4P', '5P'], default='No fit')
+        validation = {'No fit': (False, False, False, False, False),
+                      '3P Cooling': (True, True, True, False, False),
+                      '3P Heating': (True, False, False, True, True),
+                      '4P': (True, True, True, True, True),
+                      '5P': (True, True, True, True, True)}
+        df_out = pd.DataFrame({'model_type': types, 'has_fit': types != 'No fit', 'r2': df['r2'].values,
+                               'base': base, 'csl': csl, 'ccp': ccp, 'hsl': np.abs(hsl), 'hcp': hcp},
+                              index=keys)
+        for i, coeff in enumerate(['base', 'csl', 'ccp', 'hsl', 'hcp']):
+            df_out['valid_' + coeff] = [validation[t][i] for t in types]
+        for c in columns[7:]:
+            df_out[c] = df[c].values
+        df_out.index.name = 'building_ID'
+        return df_out
+
+    @staticmethod
+    def fit_shapes(x, y, hcp_range, ccp_range, n_grid=20, coarse=False):
+        # Fit the 3P Cooling, 3P Heating, 4P and 5P shapes of every model in one batched solve with the
+        # exact solver (exact_least_squares); coarse ~ only n_grid evenly spaced change-points, as fit_exact
+        # x, y: (n_models, n_obs) sorted, NaN padded; hcp_range, ccp_range: ((n_models,), (n_models,)) windows
+        # Returns p (n_models, 4, 5), PRESS (n_models, 4) and R-squared (n_models, 4) in model_shapes order
+        n_models = x.shape[0]
+        (hcp_lo, hcp_hi), (ccp_lo, ccp_hi) = hcp_range, ccp_range
+        cp_4p = (np.maximum(hcp_lo, ccp_lo), np.minimum(hcp_hi, ccp_hi))
+        windows = [((ccp_lo, ccp_hi), (ccp_lo, ccp_hi)), ((hcp_lo, hcp_hi), (hcp_lo, hcp_hi)),
+                   (cp_4p, cp_4p), ((hcp_lo, hcp_hi), (ccp_lo, ccp_hi))]
+
+        def grid(lo, hi):
+            return lo[:, None] + (hi - lo)[:, None] * np.linspace(0, 1, n_grid)[None, :]
+
+        def candidates(i):
+            c = [grid(*w[i]) if coarse else InverseModel.batch_cp_candidates(x, *w[i], n_grid) for w in windows]
+            width = max(v.shape[1] for v in c)
+            return np.concatenate([np.pad(v, ((0, 0), (0, width - v.shape[1])), constant_values=np.nan)
+                                   for v in c])
+
+        # One row per (shape, model); a 3P shape fixes the other slope at zero
+        shape = np.repeat(np.arange(4), n_models)
+        zero = np.zeros(4 * n_models)
+        solver = InverseModel.profile_least_squares if coarse else InverseModel.exact_least_squares
+        p, sse = solver(
+            np.tile(x, (4, 1)), np.tile(y, (4, 1)), candidates(0), candidates(1),
+            hsl_bounds=(np.where(shape == 0, zero, -np.inf), zero),
+            csl_bounds=(zero, np.where(shape == 1, zero, np.inf)),
+            equal_cp=shape < 3)
+        p = p.reshape(4, n_models, 5).transpose(1, 0, 2)
+        sse = sse.reshape(4, n_models).T
+
+        # The change-points are held at their fitted values, so the model is linear in the base and the
+        # slopes and PRESS follows from the hat matrix diagonal: sum((e_i / (1 - h_ii)) ** 2)
+        xv, yv = x[:, None, :], y[:, None, :]
+        valid = np.isfinite(xv) & np.isfinite(yv)
+        hcp, ccp, base, hsl, csl = [p[:, :, [i]] for i in range(5)]
+        with np.errstate(invalid='ignore'):
+            h, g = np.minimum(xv - hcp, 0.0), np.maximum(xv - ccp, 0.0)
+            design = np.stack([np.ones_like(h), h * (hsl < 0), g * (csl > 0)], axis=3)
+            design = np.where(valid[..., None] & np.isfinite(design), design, 0.0)
+            residuals = np.where(valid, yv - (base + hsl * h + csl * g), 0.0)
+        hat = np.einsum('msoi,msij,msoj->mso', design,
+                        np.linalg.pinv(np.swapaxes(design, 2, 3) @ design), design)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            press = np.sum(np.where(valid, (residuals / (1 - hat)) ** 2, 0.0), axis=2)
+            press = np.where(np.all(~valid | (hat < 1 - 1e-10), axis=2), press, np.inf)
+            ss_tot = np.nansum((y - np.nanmean(y, axis=1, keepdims=True)) ** 2, axis=1)
+            r2 = 1 - sse / ss_tot[:, None]
+        # A shape whose fitted slope ends up at zero duplicates a simpler shape
+        heating, cooling = np.array([False, True, True, True]), np.array([True, False, True, True])
+        degenerate = (heating & ~(p[:, :, 3] < 0)) | (cooling & ~(p[:, :, 4] > 0)) | \
+                     ((np.arange(4) == 3) & ~(p[:, :, 0] < p[:, :, 1]))
+        press = np.where(degenerate | ~np.isfinite(sse), np.inf, press)
+        return p, press, r2
+
+    @staticmethod
+    def fit_batch_chunk_loocv(x, y, threshold, n_grid):
+        n = np.sum(np.isfinite(x), axis=1)
+        x, y = x[:, :max(n.max(initial=0), 1)], y[:, :max(n.max(initial=0), 1)]
+        x_fill = np.where((n > 0)[:, None], x, 0.0)
+        with np.errstate(invalid='ignore'):
+            hcp_range = tuple(np.nanpercentile(x_fill, [10, 70], axis=1))
+            ccp_range = tuple(np.nanpercentile(x_fill, [30, 90], axis=1))
+        p, press, r2 = InverseModel.fit_shapes(x, y, hcp_range, ccp_range, n_grid)
+        rows = np.arange(x.shape[0])
+        best = np.argmin(press, axis=1)
+        r2 = r2[rows, best]
+        no_fit = (n == 0) | ~np.isfinite(press[rows, best]) | ~(r2 >= threshold)
+        result = {'model_type': np.where(no_fit, 'No fit', ''), 'r2': np.where(no_fit, np.nan, r2)}
+        result.update(zip(['hcp', 'ccp', 'base', 'hsl', 'csl'], p[rows, best].T))
+        result.update(('loocv_' + s, press[:, i]) for i, s in enumerate(InverseModel.model_shapes))
+        return result
+
+    @staticmethod
+    def fit_batch_chunk(x, y, threshold, significance, n_grid):
+        n_models = x.shape[0]
+        n = np.sum(np.isfinite(x), axis=1)
+        x, y = x[:, :max(n.max(initial=0), 1)], y[:, :max(n.max(initial=0), 1)]
+        has_data = n > 0
+        x_fill = np.where(has_data[:, None], x, 0.0)
+
+        def fit(cp_windows, hsl_min, csl_max):
+            (hcp_min, hcp_max), (ccp_min, ccp_max) = cp_windows
+            p, sse = InverseModel.exact_least_squares(
+                x, y,
+                InverseModel.batch_cp_candidates(x, hcp_min, hcp_max, n_grid),
+                InverseModel.batch_cp_candidates(x, ccp_min, ccp_max, n_grid),
+                base_bounds=(0, np.inf), hsl_bounds=(hsl_min, 0), csl_bounds=(0, csl_max))
+            cov = InverseModel.covariance(x, y, np.nan_to_num(p))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                se = np.sqrt(np.diagonal(cov, axis1=1, axis2=2) / n[:, None])
+                p_hsl = stats.t.cdf(p[:, 3] / se[:, 3], df=n - 2)
+                p_csl = stats.t.sf(p[:, 4] / se[:, 4], df=n - 2)
+                ss_tot = np.nansum((y - np.nanmean(y, axis=1, keepdims=True)) ** 2, axis=1) if x.size else n
+                r2 = 1 - sse / ss_tot
+            return p, p_hsl, p_csl, r2
+
+        def percentile_window(lo, hi):
+            with np.errstate(invalid='ignore'):
+                return tuple(np.nanpercentile(x_fill, [lo, hi], axis=1))
+
+        # Initial fit with the default change-point bounds and R-squared check
+        window = percentile_window(45, 55)
+        p, p_hsl, p_csl, r2 = fit((window, window), np.full(n_models, -np.inf), np.full(n_models, np.inf))
+        no_fit = ~has_data | np.isnan(p[:, 0]) | ~(r2 >= threshold)
+
+        # Flag insignificant slopes and search both change-points over the optimize_cp_global windows,
+        # then flag again and re-fit with the updated slope bounds (the second optimize_slopes pass)
+        hsl_insignificant = ~(p_hsl < significance)
+        csl_insignificant = ~(p_csl < significance)
+        cp_windows = (percentile_window(10, 70), percentile_window(30, 90))
+        p, p_hsl, p_csl, r2 = fit(cp_windows,
+                                  np.where(hsl_insignificant, -10 ** -3, -np.inf),
+                                  np.where(csl_insignificant, 10 ** -3, np.inf))
+        hsl_insignificant |= ~(p_hsl < significance)
+        csl_insignificant |= ~(p_csl < significance)
+        p, p_hsl, p_csl, r2 = fit(cp_windows,
+                                  np.where(hsl_insignificant, -10 ** -3, -np.inf),
+                                  np.where(csl_insignificant, 10 ** -3, np.inf))
+
+        # Clean up the insignificant slopes the same way as optimize_slopes
+        hcp, ccp, base, hsl, csl = p.T.copy()
+        hcp = np.where(hsl_insignificant, ccp, hcp)
+        hsl = np.where(hsl_insignificant, 0.0, hsl)
+        ccp = np.where(csl_insignificant, hcp, ccp)
+        csl = np.where(csl_insignificant, 0.0, csl)
+        both = hsl_insignificant & csl_insignificant
+        hcp, ccp = np.where(both, 0.0, hcp), np.where(both, 0.0, ccp)
+        no_fit |= np.isnan(base)
+
+        return {'model_type': np.where(no_fit, 'No fit', ''), 'r2': np.where(no_fit, np.nan, r2),
+                'hcp': hcp, 'ccp': ccp, 'base': base, 'hsl': hsl, 'csl': csl}
+
+    def percentile_sorted(self, q):
+        # np.percentile (linear interpolation) from the temperatures sorted once at construction
+        x = self.x_sorted
+        rank = np.asarray(q, dtype=float) / 100 * (len(x) - 1)
+        lo = np.floor(rank).astype(int)
+        hi = np.minimum(lo + 1, len(x) - 1)
+        return x[lo] + (rank - lo) * (x[hi] - x[lo])
+
+    def window_r_squared(self, point, cp_limits):
+        # Fit with the change-point bounds of one window and return (R-squared, p, e);
+        # the instance is left untouched so windows can be evaluated concurrently
+        lower, upper = self.bounds()
+        i = 0 if point == "L" else 1
+        lower[i], upper[i] = cp_limits
+        try:
+            p, e = self.solve(lower, upper)
+        except:
+            return -np.inf, None, None
+        return FitResult(self.temperature, self.eui, p).r2, p, e
+
+    def optimize_cp_limit(self, point, n_jobs=None, patience=None):
         # Finds the optimum range for heating and cooling change-points bounds
+        # n_jobs: number of windows evaluated concurrently (None ~ self.n_jobs)
+        # patience: stop once R-squared has not improved for this many windows (None ~ self.patience,
+        # which tries all windows by default)
+        # Every window is fitted from the same cold start: starting curve_fit from the previous
+        # window's solution can end in another local optimum and change the chosen window
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        patience = self.patience if patience is None else patience
         if point == "R":
             percentiles = [[i, i + 5] for i in np.arange(30, 90, 5)]
         else:
             percentiles = [[i, i + 5] for i in np.arange(10, 70, 5)]
+        # All windows from the sorted temperature at once
+        v_cp_limits = self.percentile_sorted(percentiles)
 
         var = []
-        # print('optimize cp limits')
-        for per in percentiles:
-            cp_limit_min, cp_limit_max = np.percentile(self.temperature, per)
-            # print('Percentile = {}, search range: {:04.2f} - {:04.2f}, rmse = {:04.3f}'.format( per, cp_limit_min, cp_limit_max, self.rmse()))
-
-            if point == "L":
-                self.hcp_min = cp_limit_min  # Heating change-point minimum
-                self.hcp_max = cp_limit_max  # Heating change-point maximum
-            elif point == "R":
-                self.ccp_min = cp_limit_min  # Cooling change-point minimum
-                self.ccp_max = cp_limit_max  # Cooling change-point maximum
-
-            self.fit()
-            # print(self.p)
-            r2 = self.R_Squared()
-            # print('P value: base= {:04.3f}, left= {:04.3f}, right= {:04.3f}, R2 = {:04.2f} '.format(self.p_base, self.p_hsl, self.p_csl, r2 ))
-            var.append(r2)
+        fits = []
+        since_best = 0
+        pool = ThreadPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else None
+        try:
+            for start in range(0, len(percentiles), n_jobs):
+                v_limits = v_cp_limits[start:start + n_jobs]
+                if pool is None:
+                    results = [self.window_r_squared(point, cp_limits) for cp_limits in v_limits]
+                else:
+                    results = list(pool.map(lambda cp_limits: self.window_r_squared(point, cp_limits), v_limits))
+                for r2, p, e in results:
+                    since_best = 0 if (not var or r2 > max(var)) else since_best + 1
+                    var.append(r2)
+                    fits.append((p, e))
+                if patience is not None and since_best >= patience:
+                    break
+        finally:
+            if pool is not None:
+                pool.shutdown()
 
-        optimum_limits = percentiles[var.index(max(var))]
-        cp_limit_min, cp_limit_max = np.percentile(self.temperature, optimum_limits)
+        best = var.index(max(var))
+        optimum_limits = percentiles[best]
+        cp_limit_min, cp_limit_max = v_cp_limits[best]
         if point == "L":
             self.hcp_min = cp_limit_min  # Heating change-point minimum
             self.hcp_max = cp_limit_max  # Heating change-point maximum
@@ -147,11 +1022,28 @@ class InverseModel:
             self.ccp_min = cp_limit_min  # Cooling change-point minimum
             self.ccp_max = cp_limit_max  # Cooling change-point maximum
 
-        self.fit()
+        # Keep the solution of the optimum window rather than fitting it again
+        if fits[best][0] is not None:
+            self.set_fit(*fits[best])
+        else:
+            self.fit()
         return optimum_limits
 
+    def optimize_cp_global(self):
+        # The exact solver searches both change-points jointly over the union of the windows that
+        # optimize_cp_limit("L") and optimize_cp_limit("R") would sweep one at a time
+        self.hcp_min, self.hcp_max = np.percentile(self.temperature, [10, 70])
+        self.ccp_min, self.ccp_max = np.percentile(self.temperature, [30, 90])
+        self.fit()
+
     def fit_model(self, has_fit=False, threshold=0.1):
         ### Handle outliers (TBD)
+        self.fit_deadline = self.deadline
+        if self.fit_deadline is None and self.time_budget is not None:
+            self.fit_deadline = time.perf_counter() + self.time_budget
+        self.fit_path = []
+        if self.model_selection == 'loocv':
+            return self.fit_model_loocv(threshold)
 
         ### Fit change-point model
         self.fit()  # Initial guess
@@ -170,21 +1062,138 @@ class InverseModel:
         # return (has_fit)
 
         if (self.R_Squared() < threshold):
+            self.set_fit_strategy()
             print('No fit found')
             # Cannot accept model immediately. No meaningful correlation found.
             return (has_fit)
         else:
             self.optimize_slopes()
-            self.optimize_cp_limit("L")
-            self.optimize_cp_limit("R")
+            if self.fit_method == 'curve_fit':
+                self.optimize_cp_limit("L")
+                self.optimize_cp_limit("R")
+            else:
+                self.optimize_cp_global()
             self.optimize_slopes()
             self.inverse_cp()
             self.model_type()  # Get model type
+            self.set_fit_strategy()
             has_fit = True
             self.has_fit = has_fit
             # Save final model coefficients
             return (has_fit)
 
+    def set_fit_strategy(self):
+        # 'coarse_grid' if any fit ran out of budget, the configured fit method otherwise
+        self.fit_strategy = 'coarse_grid' if 'coarse_grid' in self.fit_path else self.fit_method
+        if self.fit_strategy == 'coarse_grid':
+            print('Fitting budget exceeded, the coarse change-point grid was used.')
+
+    def fit_model_loocv(self, threshold=0.1):
+        # Fit every model shape at once and keep the one with the smallest PRESS (leave-one-out
+        # prediction error). The scores of all shapes are kept in loocv_scores. Once the time budget is
+        # spent the shapes are fitted on the coarse change-point grid, like solve.
+        x, y = self.x_sorted[None, :], self.y_sorted[None, :]
+        hcp_range = np.percentile(self.temperature, [10, 70])
+        ccp_range = np.percentile(self.temperature, [30, 90])
+        coarse = self.budget_spent()
+        p, press, r2 = self.fit_shapes(x, y, (hcp_range[[0]], hcp_range[[1]]), (ccp_range[[0]], ccp_range[[1]]),
+                                       self.n_cp_coarse if coarse else self.n_cp_grid, coarse)
+        self.loocv_scores = dict(zip(self.model_shapes, press[0]))
+        self.fit_path = ['coarse_grid' if coarse else 'exact']
+        self.fit_strategy = self.fit_path[0]
+        if coarse:
+            print('Fitting budget exceeded, the coarse change-point grid was used.')
+        best = np.argmin(press[0])
+        if not (np.isfinite(press[0, best]) and r2[0, best] >= threshold):
+            print('No fit found')
+            return False
+        self.set_fit(p[0, best], self.covariance(x, y, p[0, [best]])[0])
+        self.model_type()
+        self.has_fit = True
+        return True
+
+    def fit_settings(self, threshold=0.1):
+        # Settings that change the fit result; part of the model registry key
+        return {'version': InverseModel.fit_version, 'fit_method': self.fit_method, 'n_cp_grid': self.n_cp_grid,
+                'significance_threshold': self.significance_threshold, 'threshold': threshold,
+                'model_selection': self.model_selection, 'max_nfev': self.max_nfev,
+                'fit_time_budget': self.fit_time_budget, 'time_budget': self.time_budget,
+                'warm_start': self.warm_start, 'patience': self.patience}
+
+    def to_record(self, has_fit):
+        record = {a: getattr(self, a) for a in InverseModel.record_attributes if hasattr(self, a)}
+        record['has_fit'] = has_fit
+        return record
+
+    def load_record(self, record):
+        for a, v in record.items():
+            if a == 'p':
+                self.fit_result = FitResult(self.temperature, self.eui, v)
+            else:
+                setattr(self, a, np.array(v, dtype=float) if a in ('e', 'p_init', 'model_p') else v)
+
+    def fit_or_load(self, registry=None, threshold=0.1):
+        # Reuse the stored fit result if the same data has been fitted with the same settings before
+        if registry is None:
+            return self.fit_model(threshold=threshold)
+        key = registry.series_key(self.temperature, self.eui, self.fit_settings(threshold))
+        record = registry.get(key)
+        if record is not None:
+            print('Using the stored ' + self.energy_type + ' model fit.')
+            self.load_record(record)
+            return record['has_fit']
+        has_fit = self.fit_model(threshold=threshold)
+        # A fit that ran out of time depends on the machine and its load, so it is not reused
+        if not (self.fit_strategy == 'coarse_grid' and
+                (self.time_budget is not None or self.fit_time_budget is not None)):
+            registry.put(key, self.to_record(has_fit), self.energy_type)
+        return has_fit
+
+    def bootstrap(self, n_boot=1000, confidence=0.95, seed=0, chunk_size=250):
+        # Percentile bootstrap intervals of the model coefficients. The fitted model shape is kept and
+        # every resample is refitted with the exact solver (exact_least_squares, the candidates of fit_exact);
+        # the resample indices are drawn as one matrix from default_rng(seed), so a seed gives the same intervals.
+        if not getattr(self, 'has_fit', False) or getattr(self, 'model_type_str', None) not in self.model_shapes:
+            print('A change-point model has to be fitted before bootstrapping')
+            return None
+        shape = self.model_shapes.index(self.model_type_str)
+        x, y = self.x_sorted, self.y_sorted
+        n = len(x)
+        rng = np.random.default_rng(seed)
+        # The data is sorted by temperature, so sorted indices give sorted resamples
+        idx = np.sort(rng.integers(0, n, size=(n_boot, n)), axis=1)
+
+        # Change-point windows of the joint search, shared by both change-points for 3P and 4P models
+        hcp_window, ccp_window = self.percentile_sorted([10, 70]), self.percentile_sorted([30, 90])
+        if shape == 0:
+            hcp_window = ccp_window
+        elif shape == 1:
+            ccp_window = hcp_window
+        elif shape == 2:
+            hcp_window = ccp_window = (max(hcp_window[0], ccp_window[0]), min(hcp_window[1], ccp_window[1]))
+        hcp_candidates, ccp_candidates = self.cp_candidates(*hcp_window), self.cp_candidates(*ccp_window)
+
+        p = np.empty((n_boot, 5))
+        for i in range(0, n_boot, chunk_size):
+            rows = idx[i:i + chunk_size]
+            p[i:i + chunk_size] = self.exact_least_squares(
+                x[rows], y[rows],
+                np.broadcast_to(hcp_candidates, (len(rows), len(hcp_candidates))),
+                np.broadcast_to(ccp_candidates, (len(rows), len(ccp_candidates))),
+                hsl_bounds=(0 if shape == 0 else -np.inf, 0), csl_bounds=(0, 0 if shape == 1 else np.inf),
+                equal_cp=shape < 3)[0]
+        self.bootstrap_p = p
+
+        # Intervals in the same form as coeffs (absolute heating slope); invalid coefficients get NaN
+        alpha = 1 - confidence
+        with np.errstate(invalid='ignore'):
+            lo, hi = np.nanpercentile(p, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+        intervals = {'base': (lo[2], hi[2]), 'csl': (lo[4], hi[4]), 'ccp': (lo[1], hi[1]),
+                     'hsl': (-hi[3], -lo[3]), 'hcp': (lo[0], hi[0])}
+        self.coeff_intervals = {c: intervals[c] if self.coeff_validation[c] else (np.nan, np.nan)
+                                for c in intervals}
+        return self.coeff_intervals
+
     def optimize_slopes(self):
         import math
         if (not (self.significant(self.p_hsl)) or math.isnan(self.p_hsl)):
@@ -197,7 +1206,8 @@ class InverseModel:
             self.csl_max = 10 ** -3
             self.csl_insignificant = True
 
-        self.fit()
+        # Only the slope bounds change, so the refit stays within the current change-point window
+        self.fit(p0=self.p if self.warm_start and hasattr(self, 'p') else None)
 
         if self.hsl_insignificant:
             self.hcp = self.ccp
@@ -14,6 +14,7 @@ import numpy as np
 from collections import OrderedDict
 
 import constants
+import model
 import building
 import utility
 import weather
@@ -137,21 +138,67 @@ class Portfolio:
         return (dict_raw_utility)
 
     @staticmethod
-    def generate_building_models(dict_raw_utility, cached_weather):
+    def prefetch_weather(v_buildings, cached_weather, n_stations=3):
+        # Assign weather stations to all buildings at once, then load or download every (station, year)
+        # needed by the portfolio exactly once. Weather instances (e.g. in Building.add_weather) read the
+        # prefetched data. A backup station is only fetched for buildings whose closer station failed.
+        # One entry per (building, utility) billing window, ranked like Weather.process ranks its stations
+        v_window = [(b, getattr(b, u).df_periods) for b in v_buildings if b is not None and hasattr(b, 'coord')
+                    for u in ('utility_electricity', 'utility_fossil_fuel')
+                    if hasattr(getattr(b, u, None), 'df_periods')]
+        # Only the current batch is kept in the weather cache
+        weather.Weather.clear_cache()
+        if not v_window:
+            return
+        v_station_ID = constants.Constants.df_us_weather_station['station_ID'].values
+        m_candidates = weather.Weather.nearest_weather_stations(
+            np.array([b.latitude for b, _ in v_window], dtype=float),
+            np.array([b.longitude for b, _ in v_window], dtype=float),
+            max(n_stations, weather.Weather.n_station_candidates))[1]
+        v_years, v_index = [], []
+        for i, (b, df_periods) in enumerate(v_window):
+            start_year, end_year = weather.Weather.period_years(df_periods)
+            v_years.append(range(start_year, end_year + 1))
+            v_index.append(weather.Weather.rank_weather_stations(
+                m_candidates[i], pd.to_datetime(df_periods['start_dates'], utc=True).min(),
+                pd.to_datetime(df_periods['end_dates'], utc=True).max(), n_stations))
+        m_index = np.array(v_index)
+
+        if weather.Weather.blend_stations:
+            # Every window blends its nearest stations, so fetch all of them at once
+            m_nearest = weather.Weather.nearest_weather_stations(
+                np.array([b.latitude for b, _ in v_window], dtype=float),
+                np.array([b.longitude for b, _ in v_window], dtype=float), weather.Weather.n_blend_stations)[1]
+            v_station_year = [(v_station_ID[j], year) for i in range(len(v_window)) for j in m_nearest[i]
+                              for year in v_years[i]]
+            print("Prefetching weather: " + str(len(dict.fromkeys(v_station_year))) + " station-years for " +
+                  str(len(v_window)) + " billing windows.")
+            weather.Weather.prefetch(v_station_year, cached_weather)
+            return
+
+        v_pending = list(range(len(v_window)))
+        for rank in range(m_index.shape[1]):
+            v_station_year = [(v_station_ID[m_index[i, rank]], year) for i in v_pending for year in v_years[i]]
+            print("Prefetching weather: " + str(len(dict.fromkeys(v_station_year))) + " station-years for " +
+                  str(len(v_pending)) + " billing windows.")
+            d_failed = weather.Weather.prefetch(v_station_year, cached_weather)
+            v_pending = [i for i in v_pending
+                         if any((v_station_ID[m_index[i, rank]], year) in d_failed for year in v_years[i])]
+            if not v_pending:
+                break
+
+    @staticmethod
+    def generate_building_models(dict_raw_utility, cached_weather, registry=None):
         # This function may take several minutes, print the progress
         v_building_ID = list(dict_raw_utility.keys())
-        v_EUI = np.empty(0)
-        v_Model = np.empty(0)
-        v_beta_base = np.empty(0)
-        v_beta_betc = np.empty(0)
-        v_beta_beth = np.empty(0)
-        v_beta_cdd = np.empty(0)
-        v_beta_hdd = np.empty(0)
+        # Collect the (temperature, EUI) series of every building, then fit all models in one batch
+        dict_series = {}
+        dict_buildings = {}
         i = 0
         for bldg_id in v_building_ID:
             i += 1
             print('----------------------------------------------------')
-            print("Fitting change-point model for all buildings.")
+            print("Preparing change-point model data for all buildings.")
             print("Building ID: " + str(bldg_id))
 
             bldg_name = str(bldg_id) + '_dummy_name'
@@ -165,30 +212,36 @@ class Portfolio:
             if (hasattr(utility_temp, "df_raw_data")):
                 # Proceed only if there is utility data for the current building
                 building_temp = building.Building(bldg_id, bldg_name, bldg_address, bldg_type, bldg_area, currency)
-                weather_temp = weather.Weather(building_temp.coord)
                 building_temp.add_utility(utility_temp)
-                building_temp.add_weather(cached_weather, weather_temp)
-                has_fit = building_temp.fit_inverse_model()
-                if (has_fit):
-                    v_EUI = np.append(v_EUI, np.nan)
-                    v_Model = np.append(v_Model, str(bldg_id))
-                    v_beta_base = np.append(v_beta_base, building_temp.im_electricity.coeffs['base'])
-                    v_beta_betc = np.append(v_beta_betc, building_temp.im_electricity.coeffs['ccp'])
-                    v_beta_beth = np.append(v_beta_beth, building_temp.im_electricity.coeffs['hcp'])
-                    v_beta_cdd = np.append(v_beta_cdd, building_temp.im_electricity.coeffs['csl'])
-                    v_beta_hdd = np.append(v_beta_hdd, building_temp.im_electricity.coeffs['hsl'])
-                print(str(i) + '/' + str(len(v_building_ID)) + " completed.")
+                dict_buildings[bldg_id] = building_temp
             else:
                 print("No " + utility_type + " utility data found for current building, ",
                       str(i) + '/' + str(len(v_building_ID)) + " completed.")
 
-        d_bench_coeffs = {'EUI': v_EUI,
-                          'Model': v_Model,
-                          'beta_base': v_beta_base,
-                          'beta_betc': v_beta_betc,
-                          'beta_beth': v_beta_beth,
-                          'beta_cdd': v_beta_cdd,
-                          'beta_hdd': v_beta_hdd}
+        # Load the weather of all buildings once per station-year
+        Portfolio.prefetch_weather(list(dict_buildings.values()), cached_weather)
+        i = 0
+        for bldg_id, building_temp in dict_buildings.items():
+            i += 1
+            weather_temp = weather.Weather(building_temp.coord)
+            building_temp.add_weather(cached_weather, weather_temp)
+            building_temp.pre_process()
+            dict_series[bldg_id] = (building_temp.weather_electricity.v_T_C,
+                                    building_temp.eui_daily_electricity)
+            print(str(i) + '/' + str(len(dict_buildings)) + " completed.")
+        weather.Weather.clear_cache()
+
+        print("Fitting change-point models for " + str(len(dict_series)) + " buildings.")
+        df_models = model.InverseModel.fit_batch(dict_series, registry=registry)
+        df_models = df_models.loc[df_models['has_fit']]
+
+        d_bench_coeffs = {'EUI': np.full(len(df_models), np.nan),
+                          'Model': np.array([str(bldg_id) for bldg_id in df_models.index]),
+                          'beta_base': df_models['base'].values,
+                          'beta_betc': df_models['ccp'].values,
+                          'beta_beth': df_models['hcp'].values,
+                          'beta_cdd': df_models['csl'].values,
+                          'beta_hdd': df_models['hsl'].values}
         df_bench_coeffs = pd.DataFrame(d_bench_coeffs)
         return df_bench_coeffs
 
@@ -209,8 +262,8 @@ class Portfolio:
         return df_bench_stats
 
     @staticmethod
-    def generate_benchmark_stats_wrapper(dict_raw_utility, cached_weather):
-        df_building_models = Portfolio.generate_building_models(dict_raw_utility, cached_weather)
+    def generate_benchmark_stats_wrapper(dict_raw_utility, cached_weather, registry=None):
+        df_building_models = Portfolio.generate_building_models(dict_raw_utility, cached_weather, registry)
         df_bench_stats = Portfolio.generate_benchmark_stats(df_building_models)
         return df_bench_stats
 
@@ -339,6 +392,25 @@ class Portfolio:
             "Detail Report": v_rpt_path
         })
 
+        # ASHRAE Guideline 14 metrics of all buildings, evaluated in one batch
+        v_inputs = [(i, *inputs) for i, single_building in enumerate(b for b in v_single_buildings if b != None)
+                    for inputs in single_building.guideline14_inputs()]
+        d_g14 = {}
+        for s, fuel in (('e', 'Electricity'), ('f', 'Fossil Fuel')):
+            for key, name in (('cv_rmse', 'CV(RMSE)'), ('nmbe', 'NMBE'),
+                              ('fractional_savings_uncertainty', 'Savings Uncertainty')):
+                d_g14[(s, key)] = ("Building " + fuel + " Model " + name + " (%)", ['NA'] * count)
+        if v_inputs:
+            v_index, v_fuels, *args = zip(*v_inputs)
+            metrics = model.InverseModel.guideline14_metrics(*args)
+            for j, (i, s) in enumerate(zip(v_index, v_fuels)):
+                for key in ('cv_rmse', 'nmbe', 'fractional_savings_uncertainty'):
+                    value = metrics[key][j]
+                    d_g14[(s, key)][1][i] = round(value * 100, 1) if np.isfinite(value) else 'NA'
+        v_rpt_path = d_bldg_summary.pop("Detail Report")
+        d_bldg_summary.update(OrderedDict(d_g14.values()))
+        d_bldg_summary["Detail Report"] = v_rpt_path
+
         self.df_bldg_summary = pd.DataFrame(d_bldg_summary)
 
         # Explore whether this support JS to enable the sorting function
@@ -0,0 +1,82 @@
+'''
+
+Building Efficiency Targeting Tool for Energy Retrofits (BETTER) Copyright (c) 2018, The Regents of the University of California, through Lawrence Berkeley National Laboratory (subject to receipt of any required approvals from the U.S. Dept. of Energy). All rights reserved.
+
+If you have questions about your rights to use or distribute this software, please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+
+NOTICE.  This Software was developed under funding from the U.S. Department of Energy and the U.S. Government consequently retains certain rights. As such, the U.S. Government has been granted for itself and others acting on its behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software to reproduce, distribute copies to the public, prepare derivative works, and perform publicly and display publicly, and to permit other to do so.
+
+'''
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import numpy as np
+
+
+class ModelRegistry:
+    # On-disk store of change-point model fit results, keyed by a hash of the input data and fit settings
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            s_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+            db_path = s_path + '/outputs/model_registry.sqlite'
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.exists(db_dir): os.makedirs(db_dir)
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS fit_results ('
+                                    'key TEXT PRIMARY KEY, energy_type TEXT, model_type TEXT, r2 REAL, '
+                                    'record TEXT, updated REAL)')
+
+    @staticmethod
+    def series_key(temperature, eui, settings):
+        # Hash the temperature and EUI values (as float64) together with the fit settings
+        h = hashlib.sha256()
+        for v in (temperature, eui):
+            v = np.ascontiguousarray(np.asarray(v, dtype=float).ravel())
+            h.update(str(v.size).encode())
+            h.update(v.tobytes())
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def dumps(record):
+        # numpy arrays and scalars are stored as lists and Python numbers
+        return json.dumps(record, default=lambda o: o.tolist())
+
+    def get(self, key):
+        row = self.connection.execute('SELECT record FROM fit_results WHERE key = ?', (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_many(self, keys, chunk_size=500):
+        records = {}
+        keys = list(keys)
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            rows = self.connection.execute('SELECT key, record FROM fit_results WHERE key IN (' +
+                                           ','.join('?' * len(chunk)) + ')', chunk).fetchall()
+            records.update({key: json.loads(record) for key, record in rows})
+        return records
+
+    def put(self, key, record, energy_type=None):
+        self.put_many([(key, record)], energy_type)
+
+    def put_many(self, items, energy_type=None):
+        now = time.time()
+        rows = [(key, energy_type, record.get('model_type_str', record.get('model_type')),
+                 record.get('r2'), self.dumps(record), now) for key, record in items]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO fit_results VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
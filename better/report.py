@@ -929,6 +929,10 @@ class Report:
                 tbstr += '            <td>' + self.format_number(self.portfolio.df_bldg_summary['Building Annual Fossil Fuel EUI (kWh/m2)'][n]) + '</td>\n'
                 tbstr += '            <td>' + self.format_number(self.portfolio.df_bldg_summary['Building Annual Energy Cost Savings ($)'][n]) + '</td>\n'
                 tbstr += '            <td>' + self.format_number(self.portfolio.df_bldg_summary['Building Annual Energy Saving (%)'][n]) + '</td>\n'
+                # Columns after the twelve above, e.g. the Guideline 14 model metrics, in header order
+                for col_name in self.portfolio.df_bldg_summary.columns[12:]:
+                    if col_name != 'Detail Report' and not col_name.startswith('Bubble Size'):
+                        tbstr += '            <td>' + self.format_number(self.portfolio.df_bldg_summary[col_name][n]) + '</td>\n'
                 tbstr += '        </tr>\n'
             tbstr += '    </tbody>\n'
             tbstr += '</table>\n'
@@ -0,0 +1,336 @@
+'''
+
+Building Efficiency Targeting Tool for Energy Retrofits (BETTER) Copyright (c) 2018, The Regents of the University of California, through Lawrence Berkeley National Laboratory (subject to receipt of any required approvals from the U.S. Dept. of Energy). All rights reserved.
+
+If you have questions about your rights to use or distribute this software, please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+
+NOTICE.  This Software was developed under funding from the U.S. Department of Energy and the U.S. Government consequently retains certain rights. As such, the U.S. Government has been granted for itself and others acting on its behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software to reproduce, distribute copies to the public, prepare derivative works, and perform publicly and display publicly, and to permit other to do so.
+
+'''
+
+import os
+import io
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    # Advisory lock on a file, held by one process (and one thread) at a time, e.g. to populate a cache entry once
+    # remove: delete the lock file on release, e.g. when it guards a temporary file
+
+    def __init__(self, file_name, remove=False):
+        self.file_name = file_name
+        self.remove = remove
+        self.file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.file_name)), exist_ok=True)
+        while True:
+            self.file = open(self.file_name, 'a+b')
+            self.lock()
+            # A previous holder may have removed the file while this one waited for it
+            try:
+                if os.path.samestat(os.fstat(self.file.fileno()), os.stat(self.file_name)):
+                    return self
+            except OSError:
+                pass
+            self.unlock()
+            self.file.close()
+
+    def __exit__(self, *args):
+        if self.remove and fcntl is not None:
+            # Removed while still locked, so a waiting process notices and locks a new file
+            os.remove(self.file_name)
+        self.unlock()
+        self.file.close()
+        self.file = None
+        if self.remove and fcntl is None:
+            try:
+                os.remove(self.file_name)
+            except OSError:  # Windows keeps a file open in another process (waiting for the lock)
+                pass
+
+    def lock(self):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after 10 seconds
+                    pass
+
+    def unlock(self):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def atomic_write(file_name, data):
+    # Write bytes to a temporary file next to file_name, then rename it over file_name, so that readers see
+    # either the old or the complete new file
+    directory = os.path.dirname(os.path.abspath(file_name))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file_name) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, file_name)
+    except:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+# Weather store directory, relative to the repository root
+WEATHER_STORE_PATH = '/Data/WeatherStore'
+
+
+class WeatherStore:
+    # Local store of station-year weather observations as typed arrays, kept apart per weather source
+    # ('cached' ~ the local Data/Weather CSV files, or a source name of weather.WEATHER_SOURCES such as 'isd'):
+    # <root>/<source>/<station_ID>/<year>_hours.npy ~ int32 hours since 1970-01-01 (UTC), sorted
+    # <root>/<source>/<station_ID>/<year>_temperature.npy ~ float32 temperature [F]
+    # <root>/<source>/<station_ID>/<year>.sha256 ~ checksums of both files, written last (a station-year without
+    # it is incomplete); every file is written atomically and <year>.lock serializes the writers of a station-year
+
+    def __init__(self, root=None, source='cached'):
+        if root is None:
+            root = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + WEATHER_STORE_PATH
+        self.root = root
+        self.source = source
+        self.path = os.path.join(root, source)
+
+    def file_names(self, station_ID, year):
+        prefix = os.path.join(self.path, str(station_ID), str(year))
+        return prefix + '_hours.npy', prefix + '_temperature.npy'
+
+    def checksum_file_name(self, station_ID, year):
+        return os.path.join(self.path, str(station_ID), str(year) + '.sha256')
+
+    def lock(self, station_ID, year):
+        return FileLock(os.path.join(self.path, str(station_ID), str(year) + '.lock'))
+
+    def has(self, station_ID, year):
+        return all(os.path.exists(f) for f in self.file_names(station_ID, year) +
+                   (self.checksum_file_name(station_ID, year),))
+
+    @staticmethod
+    def npy_bytes(v):
+        buffer = io.BytesIO()
+        np.save(buffer, v)
+        return buffer.getvalue()
+
+    def write(self, station_ID, year, v_datetime, v_temperature_F):
+        # Store one station-year; v_datetime: datetime64-like (naive UTC), v_temperature_F: temperatures [F]
+        with self.lock(station_ID, year):
+            self.write_locked(station_ID, year, v_datetime, v_temperature_F)
+
+    def write_locked(self, station_ID, year, v_datetime, v_temperature_F):
+        # write, for a caller that holds the lock of the station-year
+        v_hours = np.array(pd.to_datetime(v_datetime), dtype='datetime64[h]').astype(np.int64)
+        v_temperature_F = np.asarray(v_temperature_F, dtype=np.float32)
+        keep = v_hours > np.iinfo(np.int64).min  # Drop missing date-times (NaT)
+        order = np.argsort(v_hours[keep], kind='mergesort')
+        v_data = [self.npy_bytes(v_hours[keep][order].astype(np.int32)),
+                  self.npy_bytes(v_temperature_F[keep][order])]
+        v_file_name = self.file_names(station_ID, year)
+        # Readers skip the station-year while it is being replaced
+        if os.path.exists(self.checksum_file_name(station_ID, year)):
+            os.remove(self.checksum_file_name(station_ID, year))
+        for file_name, data in zip(v_file_name, v_data):
+            atomic_write(file_name, data)
+        atomic_write(self.checksum_file_name(station_ID, year),
+                     ''.join(hashlib.sha256(data).hexdigest() + '  ' + os.path.basename(file_name) + '\n'
+                             for file_name, data in zip(v_file_name, v_data)).encode())
+
+    def populate(self, station_ID, year, fetch):
+        # Store the (datetime, temperature [F]) returned by fetch() unless the station-year is stored already;
+        # with many processes, only the first one to take the lock calls fetch. Returns True if it was fetched.
+        if self.has(station_ID, year):
+            return False
+        with self.lock(station_ID, year):
+            if self.has(station_ID, year):
+                return False
+            self.write_locked(station_ID, year, *fetch())
+            return True
+
+    def verify(self, station_ID, year):
+        # True if both files of the station-year match their checksums
+        with open(self.checksum_file_name(station_ID, year)) as f:
+            checksums = dict(line.split()[::-1] for line in f if line.strip())
+        for file_name in self.file_names(station_ID, year):
+            with open(file_name, 'rb') as f:
+                if hashlib.sha256(f.read()).hexdigest() != checksums.get(os.path.basename(file_name)):
+                    return False
+        return True
+
+    def read(self, station_ID, year, mmap=True, verify=False):
+        # Memory-mapped (hours, temperature) arrays of one station-year
+        if verify and not self.verify(station_ID, year):
+            raise ValueError("Weather store checksum mismatch: " + str(station_ID) + " " + str(year))
+        file_hours, file_temperature = self.file_names(station_ID, year)
+        mmap_mode = 'r' if mmap else None
+        return np.load(file_hours, mmap_mode=mmap_mode), np.load(file_temperature, mmap_mode=mmap_mode)
+
+    def read_years(self, station_ID, start_year, end_year, verify=False):
+        # (datetime64[h], temperature [F]) of a station over a range of years; a single year is not copied
+        v_data = [self.read(station_ID, year, verify=verify) for year in range(start_year, end_year + 1)]
+        if len(v_data) == 1:
+            v_hours, v_temperature = v_data[0]
+        else:
+            v_hours = np.concatenate([h for h, _ in v_data])
+            v_temperature = np.concatenate([t for _, t in v_data])
+        return v_hours.astype('datetime64[h]'), v_temperature
+
+    @staticmethod
+    def encode(v_hours, v_temperature_F):
+        # Compact binary form of one station-year: n little-endian int32 hours followed by n float32 temperatures
+        return (np.asarray(v_hours, dtype='<i4').tobytes() + np.asarray(v_temperature_F, dtype='<f4').tobytes())
+
+    @staticmethod
+    def decode(raw):
+        n = len(raw) // 8
+        return np.frombuffer(raw, dtype='<i4', count=n), np.frombuffer(raw, dtype='<f4', count=n, offset=4 * n)
+
+    @staticmethod
+    def read_csv(file_name):
+        df = pd.read_csv(file_name, usecols=['Datetime', 'Temperature'])
+        return df['Datetime'], pd.to_numeric(df['Temperature'], errors='coerce')
+
+    def import_csv(self, file_name, station_ID, year):
+        self.write(station_ID, year, *self.read_csv(file_name))
+
+    def import_csv_tree(self, csv_root=None, overwrite=False):
+        # Convert the cached weather CSV files (<csv_root>/<year>/<year>_<station_ID>.csv) into the store
+        if csv_root is None:
+            csv_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + '/Data/Weather'
+        n_imported = 0
+        for year in sorted(os.listdir(csv_root)):
+            year_path = os.path.join(csv_root, year)
+            if not (year.isdigit() and os.path.isdir(year_path)):
+                continue
+            for file_name in sorted(os.listdir(year_path)):
+                if not (file_name.startswith(year + '_') and file_name.endswith('.csv')):
+                    continue
+                station_ID = file_name[len(year) + 1:-len('.csv')]
+                if overwrite or not self.has(station_ID, year):
+                    try:
+                        if overwrite:
+                            self.import_csv(os.path.join(year_path, file_name), station_ID, year)
+                            n_imported += 1
+                        else:
+                            csv_file_name = os.path.join(year_path, file_name)
+                            n_imported += self.populate(station_ID, year, lambda: self.read_csv(csv_file_name))
+                    except:
+                        print("Failed to import weather file: " + file_name)
+        print(str(n_imported) + " station-year weather files imported.")
+        return n_imported
+
+
+class StationManifest:
+    # Number of observations of each station per month, used to choose stations that cover a billing window
+    # before downloading or reading any weather data. Stored as <station_ID>,<year>,<1>..<12> rows in a CSV file.
+    min_observations = 200  # Observations for a month to count as covered (hourly data has ~720)
+
+    def __init__(self, file_name=None):
+        if file_name is None:
+            s_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+            file_name = s_path + WEATHER_STORE_PATH + '/station_manifest.csv'
+        self.file_name = file_name
+        self.counts = {}  # {(station_ID, year): (12,) monthly observation counts}
+        self.stations = set()
+        if os.path.exists(file_name):
+            df = pd.read_csv(file_name, dtype={'station_ID': str})
+            self.update(df['station_ID'], df['year'], df[[str(m) for m in range(1, 13)]].values)
+
+    def update(self, v_station_ID, v_year, m_counts):
+        for station_ID, year, counts in zip(v_station_ID, v_year, np.asarray(m_counts, dtype=np.int64)):
+            self.counts[(station_ID, int(year))] = counts
+            self.stations.add(station_ID)
+
+    def save(self):
+        keys = sorted(self.counts)
+        df = pd.DataFrame(np.array([self.counts[k] for k in keys]).reshape(-1, 12),
+                          columns=[str(m) for m in range(1, 13)])
+        df.insert(0, 'year', [k[1] for k in keys])
+        df.insert(0, 'station_ID', [k[0] for k in keys])
+        atomic_write(self.file_name, df.to_csv(index=False).encode())
+
+    @staticmethod
+    def isd_station_ID(df):
+        return df['USAF'].astype(str).str.zfill(6) + '-' + df['WBAN'].astype(str).str.zfill(5)
+
+    def add_isd_inventory(self, file_name):
+        # NOAA isd-inventory.csv: USAF, WBAN, YEAR and the observation counts of JAN..DEC
+        df = pd.read_csv(file_name, dtype={'USAF': str, 'WBAN': str})
+        months = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+        self.update(self.isd_station_ID(df), df['YEAR'], df[months].fillna(0).values)
+
+    def add_isd_history(self, file_name, observations_per_month=720):
+        # NOAA isd-history.csv: USAF, WBAN, BEGIN and END (YYYYMMDD); every month in the period of record
+        # is assumed to be covered
+        df = pd.read_csv(file_name, dtype={'USAF': str, 'WBAN': str})
+        df = df.dropna(subset=['BEGIN', 'END'])
+        begin = pd.to_datetime(df['BEGIN'].astype(np.int64).astype(str), format='%Y%m%d')
+        end = pd.to_datetime(df['END'].astype(np.int64).astype(str), format='%Y%m%d')
+        for station_ID, b, e in zip(self.isd_station_ID(df), begin, end):
+            for year in range(b.year, e.year + 1):
+                v_month = np.arange(1, 13)
+                covered = ((year > b.year) | (v_month >= b.month)) & ((year < e.year) | (v_month <= e.month))
+                counts = self.counts.get((station_ID, year), np.zeros(12, dtype=np.int64))
+                self.counts[(station_ID, year)] = np.maximum(counts, covered * observations_per_month)
+            self.stations.add(station_ID)
+
+    def add_weather_store(self, weather_store):
+        # Count the observations of every station-year in a WeatherStore
+        if not os.path.isdir(weather_store.path):
+            return
+        for station_ID in sorted(os.listdir(weather_store.path)):
+            station_path = os.path.join(weather_store.path, station_ID)
+            if not os.path.isdir(station_path):
+                continue
+            for file_name in sorted(os.listdir(station_path)):
+                year = file_name[:-len('_hours.npy')]
+                if file_name.endswith('_hours.npy') and year.isdigit() and weather_store.has(station_ID, year):
+                    v_hours, v_temperature = weather_store.read(station_ID, year)
+                    v_month = (np.asarray(v_hours).astype('datetime64[h]').astype('datetime64[M]').astype(np.int64)
+                               % 12)
+                    counts = np.bincount(v_month[np.isfinite(v_temperature)], minlength=12)
+                    self.update([station_ID], [int(year)], [counts])
+
+    def coverage(self, station_ID, start_date, end_date):
+        # Fraction of the months from start_date to end_date with enough observations, None if unknown
+        if station_ID not in self.stations:
+            return None
+        start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        if start_date.tzinfo is not None:
+            start_date, end_date = start_date.tz_convert(None), end_date.tz_convert(None)
+        v_month = pd.period_range(start_date.to_period('M'), end_date.to_period('M'), freq='M')
+        if len(v_month) == 0:
+            return None
+        empty = np.zeros(12, dtype=np.int64)
+        covered = [self.counts.get((station_ID, m.year), empty)[m.month - 1] >= self.min_observations
+                   for m in v_month]
+        return float(np.mean(covered))
+
+    def order_stations(self, v_station_ID, start_date, end_date, min_coverage=1.0):
+        # Keep the candidate order (nearest first) but move stations known to cover the window ahead of
+        # unknown ones and drop the stations known not to cover it
+        v_coverage = [self.coverage(station_ID, start_date, end_date) for station_ID in v_station_ID]
+        covered = [i for i, c in enumerate(v_coverage) if c is not None and c >= min_coverage]
+        unknown = [i for i, c in enumerate(v_coverage) if c is None]
+        return covered + unknown
@@ -10,15 +10,248 @@ under funding from the U.S. Department of Energy and the U.S. Government consequ
 '''
 
 from constants import Constants
+from store import WeatherStore, StationManifest, FileLock, WEATHER_STORE_PATH
 import pandas as pd
 import numpy as np
 import os
-from ish_parser import ish_report, ish_reportException
-from ftplib import FTP
-import gzip
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
+from ftplib import FTP, error_perm
+import io
+import hashlib
+import queue
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+
+class GzipStreamDecoder:
+    # Decompress a gzip stream block by block as it arrives, e.g. as the callback of FTP.retrbinary
+
+    def __init__(self):
+        self.chunks = []
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def write(self, block):
+        while block:
+            self.chunks.append(self.decompressor.decompress(block))
+            block = b''
+            if self.decompressor.eof and self.decompressor.unused_data:
+                # Concatenated gzip members
+                block = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def getvalue(self):
+        # zlib checks the CRC-32 and length in the gzip trailer; a stream that ends before it is truncated
+        data = b''.join(self.chunks + [self.decompressor.flush()])
+        if not self.decompressor.eof:
+            raise EOFError("Truncated gzip download")
+        return data
+
+
+class FTPConnectionPool:
+    # Logged-in FTP sessions to one server, kept open and reused across downloads. At most max_connections
+    # sessions are open at a time; a session that fails is dropped and the transfer retried on a new one.
+
+    def __init__(self, host, port=21, max_connections=4, retries=1, timeout=60):
+        self.host, self.port = host, port
+        self.retries = retries
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def connect(self):
+        ftp = FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login()
+        return ftp
+
+    @staticmethod
+    def close_quietly(ftp):
+        try:
+            ftp.close()
+        except:
+            pass
+
+    def idle_session(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return None
+
+    def download(self, directory, file_name, decoder_class=GzipStreamDecoder):
+        # Retrieve directory/file_name through a pooled session and return the decoded content
+        with self.slots:
+            attempt = 0
+            while True:
+                ftp = self.idle_session()
+                pooled = ftp is not None
+                try:
+                    if ftp is None:
+                        ftp = self.connect()
+                    ftp.cwd(directory)
+                    decoder = decoder_class()
+                    ftp.retrbinary('RETR ' + file_name, decoder.write)
+                except error_perm:
+                    # The server answered (e.g. file not found), so the session is still usable
+                    if ftp is not None:
+                        self.idle.put(ftp)
+                    raise
+                except Exception:
+                    if ftp is not None:
+                        self.close_quietly(ftp)
+                    # A stale pooled session does not count as an attempt, only failures on new connections do
+                    if not pooled:
+                        if attempt >= self.retries:
+                            raise
+                        attempt += 1
+                    continue
+                self.idle.put(ftp)
+                return decoder.getvalue()
+
+    def download_resumable(self, directory, file_name, partial_file, decoder_class=GzipStreamDecoder):
+        # download, keeping the bytes received so far in partial_file; a failed transfer, in this or a later run,
+        # resumes from the end of partial_file with the FTP REST command. Attempts that receive new bytes don't
+        # count as retries, and neither do stale pooled sessions. The partial file is locked so that one process
+        # appends to it at a time; the lock file is removed with it.
+        with FileLock(partial_file + '.lock', remove=True), self.slots:
+            attempt = 0
+            while True:
+                offset = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+                ftp = self.idle_session()
+                pooled = ftp is not None
+                try:
+                    if ftp is None:
+                        ftp = self.connect()
+                    ftp.cwd(directory)
+                    ftp.voidcmd('TYPE I')
+                    try:
+                        size = ftp.size(file_name)
+                    except error_perm:
+                        size = None
+                    if size is not None and offset > size:
+                        # The file changed on the server
+                        offset = 0
+                        os.remove(partial_file)
+                    if size is None or offset < size:
+                        if offset:
+                            print("Resuming " + file_name + " at " + str(offset) + " bytes...")
+                        with open(partial_file, 'ab') as f:
+                            ftp.retrbinary('RETR ' + file_name, f.write, rest=offset or None)
+                    if size is not None and os.path.getsize(partial_file) < size:
+                        raise EOFError("Incomplete transfer of " + file_name)
+                except error_perm:
+                    if ftp is not None:
+                        self.idle.put(ftp)
+                    if os.path.exists(partial_file) and (offset or os.path.getsize(partial_file) == 0):
+                        os.remove(partial_file)
+                    if offset:
+                        # Resuming is not supported here; start over
+                        continue
+                    raise
+                except Exception:
+                    if ftp is not None:
+                        self.close_quietly(ftp)
+                    progressed = os.path.exists(partial_file) and os.path.getsize(partial_file) > offset
+                    if not (progressed or pooled):
+                        if attempt >= self.retries:
+                            raise
+                        attempt += 1
+                    continue
+                self.idle.put(ftp)
+                return Weather.decode_partial_file(partial_file, decoder_class)
+
+    def close(self):
+        while True:
+            try:
+                self.close_quietly(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+class DegreeDayTable:
+    # Daily mean temperatures of a station and cumulative heating and cooling degree-days [C-day] over a grid
+    # of base temperatures. Degree-days of any period at any base of the grid are the difference of two rows.
+    v_bases_C = np.arange(-5, 35.5, 0.5)
+
+    def __init__(self, v_datetime, v_temperature_F, v_bases_C=None):
+        self.v_bases_C = DegreeDayTable.v_bases_C if v_bases_C is None else np.asarray(v_bases_C, dtype=float)
+        v_day = np.asarray(v_datetime).astype('datetime64[D]')
+        v_temperature_C = (np.asarray(v_temperature_F, dtype=float) - 32) / 1.8
+        valid = ~np.isnat(v_day) & np.isfinite(v_temperature_C)
+        v_day, v_temperature_C = v_day[valid], v_temperature_C[valid]
+        self.first_day = v_day.min() if len(v_day) else np.datetime64('1970-01-01', 'D')
+        v_index = (v_day - self.first_day).astype(np.int64)
+        n_days = int(v_index.max()) + 1 if len(v_index) else 0
+
+        # Daily means; days without readings are NaN and add no degree-days
+        v_count = np.bincount(v_index, minlength=n_days)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.v_T_C = np.bincount(v_index, v_temperature_C, minlength=n_days) / v_count
+        has_data = v_count > 0
+        v_T_C = np.where(has_data, self.v_T_C, 0.0)[:, None]
+        m_hdd = np.where(has_data[:, None], np.maximum(self.v_bases_C[None, :] - v_T_C, 0), 0.0)
+        m_cdd = np.where(has_data[:, None], np.maximum(v_T_C - self.v_bases_C[None, :], 0), 0.0)
+        zeros = np.zeros((1, len(self.v_bases_C)))
+        self.m_cum_hdd = np.concatenate([zeros, np.cumsum(m_hdd, axis=0)])
+        self.m_cum_cdd = np.concatenate([zeros, np.cumsum(m_cdd, axis=0)])
+        self.v_cum_days = np.concatenate([[0], np.cumsum(has_data)])
+
+    def day_index(self, v_dates):
+        v_dates = np.asarray(pd.to_datetime(v_dates, utc=True).tz_convert(None), dtype='datetime64[D]')
+        return np.clip((v_dates - self.first_day).astype(np.int64), 0, len(self.v_cum_days) - 1)
+
+    def period_degree_days(self, v_start_dates, v_end_dates):
+        # Mean daily HDD and CDD (n_periods, n_bases) over the days with data in [start date, end date)
+        v_start, v_end = self.day_index(v_start_dates), self.day_index(v_end_dates)
+        v_end = np.maximum(v_end, v_start)
+        v_days = (self.v_cum_days[v_end] - self.v_cum_days[v_start])[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return ((self.m_cum_hdd[v_end] - self.m_cum_hdd[v_start]) / v_days,
+                    (self.m_cum_cdd[v_end] - self.m_cum_cdd[v_start]) / v_days)
 
 
 class Weather:
+    # NOAA ISD FTP server; point these at a local FTP server to run without network access
+    noaa_ftp_host = 'ftp.ncdc.noaa.gov'
+    noaa_ftp_port = 21
+    noaa_ftp_path = '/pub/data/noaa/'
+    gsod_ftp_path = '/pub/data/gsod/'
+    max_download_workers = 8  # Concurrent station-year downloads
+    max_connections_per_host = 4  # Concurrent connections to one FTP server
+    ftp_pools = {}
+    ftp_pools_lock = threading.Lock()
+    # Prefetched or downloaded {(station_ID, year): (datetime, temperature [F])}; failures are not kept, so
+    # they are tried again. Both caches hold one batch of buildings (see clear_cache).
+    station_year_data = {}
+    # Degree-day tables {(station_ID, start_year, end_year): DegreeDayTable}
+    degree_day_tables = {}
+    # Station availability manifest, loaded once per process; stations are ranked by coverage of the billing
+    # window among the n_station_candidates closest ones
+    station_manifest = None
+    n_station_candidates = 10
+    min_station_coverage = 1.0
+
+    # Online weather source: 'isd' (full hourly records), 'isd-lite' (hourly temperature subset, ~10x smaller)
+    # or 'gsod' (daily means); all of them are aggregated to the billing periods the same way.
+    # 'service' reads from a shared weather service (weather_service.py) at weather_service_url instead.
+    weather_source = 'isd'
+    weather_service_url = 'http://127.0.0.1:8765'
+    # Downloads are streamed and decoded in memory. With resumable_downloads, partial downloads are kept in
+    # download_path (default: Data/Downloads) instead and resumed after a failure, in this or a later run.
+    resumable_downloads = False
+    download_path = None
+    download_retries = 3  # Failed attempts in a row without new bytes before a download gives up
+    noaa_http_url = None  # HTTP mirror of the NOAA server to use instead of FTP, e.g. 'https://www.ncei.noaa.gov'
+    download_timeout = 60
+    # Blend the daily temperatures of the n_blend_stations nearest stations with inverse-distance weights
+    # (1 / distance ** blend_power) instead of using one station and falling back to the next on failure
+    blend_stations = False
+    n_blend_stations = 3
+    blend_power = 2
+    weather_service_timeout = 300  # Seconds; the service may be downloading the station-year upstream
 
     def __init__(self, coord):
         self.coord = coord
@@ -31,8 +264,9 @@ class Weather:
         self.df_periods = df_periods
         self.v_start_dates = self.df_periods.loc[:, 'start_dates']
         self.v_end_dates = self.df_periods.loc[:, 'end_dates']
-        self.start_year = pd.DatetimeIndex(np.sort(self.v_start_dates)).year[0]
-        self.end_year = pd.DatetimeIndex(np.sort(self.v_end_dates)).year[-1]
+        self.start_year, self.end_year = Weather.period_years(self.df_periods)
+        # Choose the stations that cover the billing window before any weather is read or downloaded
+        self.find_closest_weather_station(start_date=self.v_start_dates.min(), end_date=self.v_end_dates.max())
 
     @staticmethod
     def haversine_distance(lat1, lon1, lat2, lon2):
@@ -44,14 +278,85 @@ class Weather:
         distance = 2 * Constants.earth_radius * np.arcsin(np.sqrt(temp))
         return (distance)
 
-    def find_closest_weather_station(self, df_weather_station_list=Constants.df_us_weather_station):
-        self.v_coord = np.asarray(df_weather_station_list[['latitude', 'longitude']].values)
-        # Find the closest and second closest weather station (backup if the closest doesn't work)
-        v_distance = [Weather.haversine_distance(self.latitude, self.longitude, coord[0], coord[1])
-                      for coord in self.v_coord]
-        closest_index = np.argmin(v_distance)
-        second_closest_index = np.argpartition(v_distance, 2)[2]
-        third_closest_index = np.argpartition(v_distance, 3)[2]
+    # Spatial indexes of station lists, built once per process
+    station_indexes = {}
+
+    @staticmethod
+    def unit_sphere_xyz(latitude, longitude):
+        r_lat, r_lon = np.radians(latitude), np.radians(longitude)
+        return np.stack([np.cos(r_lat) * np.cos(r_lon), np.cos(r_lat) * np.sin(r_lon), np.sin(r_lat)], axis=-1)
+
+    @staticmethod
+    def get_station_index(df_weather_station_list=Constants.df_us_weather_station):
+        # k-d tree over the unit-sphere coordinates of the stations
+        key = id(df_weather_station_list)
+        if key not in Weather.station_indexes:
+            xyz = Weather.unit_sphere_xyz(np.asarray(df_weather_station_list['latitude'], dtype=float),
+                                          np.asarray(df_weather_station_list['longitude'], dtype=float))
+            Weather.station_indexes[key] = (df_weather_station_list, cKDTree(xyz))
+        return Weather.station_indexes[key][1]
+
+    @staticmethod
+    def nearest_weather_stations(latitude, longitude, k=3, df_weather_station_list=Constants.df_us_weather_station):
+        # Great-circle distances [km] and row positions of the k closest stations to each coordinate
+        # Scalar coordinates return (k,) arrays, arrays of n coordinates return (n, k) arrays
+        tree = Weather.get_station_index(df_weather_station_list)
+        k = min(k, tree.n)
+        chord, index = tree.query(Weather.unit_sphere_xyz(np.asarray(latitude, dtype=float),
+                                                          np.asarray(longitude, dtype=float)), k=k)
+        chord, index = np.reshape(chord, np.shape(latitude) + (k,)), np.reshape(index, np.shape(latitude) + (k,))
+        distance = 2 * Constants.earth_radius * np.arcsin(np.minimum(chord / 2, 1))
+        return distance, index
+
+    @staticmethod
+    def get_station_manifest():
+        if Weather.station_manifest is None:
+            Weather.station_manifest = StationManifest()
+        return Weather.station_manifest
+
+    @staticmethod
+    def build_station_manifest(use_inventory=True, use_history=False, use_store=True):
+        # Build and save the station availability manifest from the NOAA ISD inventory (observations per
+        # station-month), the ISD station history (periods of record) and/or the local weather store
+        manifest = StationManifest()
+        for use, file_name, add in ((use_history, 'isd-history.csv', manifest.add_isd_history),
+                                    (use_inventory, 'isd-inventory.csv', manifest.add_isd_inventory)):
+            if use:
+                print("Downloading " + file_name + "...")
+                add(io.BytesIO(Weather.ftp_pool().download(Weather.noaa_ftp_path, file_name, io.BytesIO)))
+        if use_store:
+            s_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+            for source in ['cached'] + [s for s in WEATHER_SOURCES if s != 'service']:
+                manifest.add_weather_store(WeatherStore(s_path + WEATHER_STORE_PATH, source))
+        manifest.save()
+        Weather.station_manifest = manifest
+        return manifest
+
+    @staticmethod
+    def rank_weather_stations(v_index, start_date, end_date, k=3,
+                              df_weather_station_list=Constants.df_us_weather_station):
+        # Reorder candidate station positions (nearest first) so that the k returned stations cover the window
+        # according to the manifest; nearest stations fill in when too few are known to cover it
+        v_station_ID = df_weather_station_list['station_ID'].values[v_index]
+        v_order = Weather.get_station_manifest().order_stations(v_station_ID, start_date, end_date,
+                                                                Weather.min_station_coverage)
+        v_order += [i for i in range(len(v_index)) if i not in v_order]
+        return np.asarray(v_index)[v_order[:k]]
+
+    def find_closest_weather_station(self, df_weather_station_list=Constants.df_us_weather_station,
+                                     start_date=None, end_date=None):
+        # Find the closest, second and third closest weather stations (backups if the closest doesn't work);
+        # with a billing window, the closest stations that have data for it
+        if start_date is None:
+            v_distance, v_index = Weather.nearest_weather_stations(self.latitude, self.longitude, 3,
+                                                                   df_weather_station_list)
+        else:
+            v_distance, v_index = Weather.nearest_weather_stations(self.latitude, self.longitude,
+                                                                   Weather.n_station_candidates,
+                                                                   df_weather_station_list)
+            v_index = Weather.rank_weather_stations(v_index, start_date, end_date, 3, df_weather_station_list)
+        v_index = np.append(v_index, [v_index[-1]] * (3 - len(v_index)))
+        closest_index, second_closest_index, third_closest_index = df_weather_station_list.index[v_index]
 
         self.closest_weather_station_ID = df_weather_station_list.loc[closest_index, 'station_ID']
         self.closest_weather_station_name = df_weather_station_list.loc[closest_index, 'station_name']
@@ -62,20 +367,32 @@ class Weather:
 
     def download_weather_NOAA(self):
         print("Downloading weather data...")
+        if Weather.blend_stations:
+            self.v_T_F, self.v_T_C = self.process_blended_weather(cached=False)
+            return
+        # The years of all candidate stations go to the download pool at once, so a backup station is ready
+        # when a closer one fails; this downloads up to three times the files when the closest one is complete
+        v_station_ID = [self.closest_weather_station_ID, self.second_closest_weather_station_ID,
+                        self.third_closest_weather_station_ID]
+        Weather.prefetch([(station_ID, year) for station_ID in v_station_ID
+                          for year in range(self.start_year, self.end_year + 1)], cached=False)
         try:
             self.v_T_F, self.v_T_C = self.process_downloaded_weather(self.closest_weather_station_ID)
         except:
             try:
                 print("Weather from the closest weather station not available...")
-                print("Trying to download the third second data from the third closest weather station.")
+                print("Trying the weather data from the second closest weather station.")
                 self.v_T_F, self.v_T_C = self.process_downloaded_weather(self.second_closest_weather_station_ID)
             except:
                 print("Weather from the second closest weather station not available...")
-                print("Trying to download the third weather data from the third closest weather station.")
+                print("Trying the weather data from the third closest weather station.")
                 self.v_T_F, self.v_T_C = self.process_downloaded_weather(self.third_closest_weather_station_ID)
 
     def use_downloaded_weather(self):
         s_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        if Weather.blend_stations:
+            self.v_T_F, self.v_T_C = self.process_blended_weather(cached=True)
+            return
         try:
             self.v_T_F, self.v_T_C = self.process_cached_weather(self.closest_weather_station_ID, s_path)
         except:
@@ -88,97 +405,497 @@ class Weather:
                 print("Trying to process the third weather data from the third closest weather station.")
                 self.v_T_F, self.v_T_C = self.process_cached_weather(self.third_closest_weather_station_ID, s_path)
     
+    def process_blended_weather(self, cached=True, k=None, power=None):
+        # Daily mean temperatures of the k nearest stations, loaded in one batch, blended per day with
+        # inverse-distance weights; a day missing at one station is covered by the others
+        k = Weather.n_blend_stations if k is None else k
+        power = Weather.blend_power if power is None else power
+        v_distance, v_index = Weather.nearest_weather_stations(self.latitude, self.longitude, k)
+        v_station_ID = Constants.df_us_weather_station['station_ID'].values[v_index]
+        v_year = range(self.start_year, self.end_year + 1)
+        Weather.prefetch([(station_ID, year) for station_ID in v_station_ID for year in v_year], cached)
+
+        # All readings of all stations with their station row, then the (k, n_days) daily means in one bincount
+        first_day = np.datetime64(str(self.start_year) + '-01-01', 'D')
+        n_days = int((np.datetime64(str(self.end_year + 1) + '-01-01', 'D') - first_day).astype(np.int64))
+        v_row, v_day, v_temperature_F = [], [], []
+        for i, station_ID in enumerate(v_station_ID):
+            for year in v_year:
+                data = Weather.station_year_data.get((station_ID, year))
+                if data is None:
+                    continue
+                v_day.append((np.asarray(data[0]).astype('datetime64[D]') - first_day).astype(np.int64))
+                v_temperature_F.append(np.asarray(data[1], dtype=float))
+                v_row.append(np.full(len(v_day[-1]), i))
+        if not v_day:
+            raise ValueError("No weather available from the " + str(k) + " nearest weather stations.")
+        v_day, v_temperature_F, v_row = np.concatenate(v_day), np.concatenate(v_temperature_F), np.concatenate(v_row)
+        valid = np.isfinite(v_temperature_F) & (v_day >= 0) & (v_day < n_days)
+        v_cell = v_row[valid] * n_days + v_day[valid]
+        m_count = np.bincount(v_cell, minlength=k * n_days).reshape(k, n_days)
+        m_sum = np.bincount(v_cell, v_temperature_F[valid], minlength=k * n_days).reshape(k, n_days)
+
+        # Stations closer than 1 km weigh as much as one at 1 km
+        v_weight = 1 / np.maximum(v_distance, 1.0) ** power
+        m_weight = np.where(m_count > 0, v_weight[:, None], 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            v_daily_T_F = np.sum(m_weight * m_sum / np.maximum(m_count, 1), axis=0) / np.sum(m_weight, axis=0)
+
+        self.blend_station_IDs = list(v_station_ID)
+        self.blend_weights = v_weight / np.sum(v_weight)
+        self.weather_station_ID = '+'.join(v_station_ID)
+        print("Blended daily weather of " + ', '.join(v_station_ID) + ": " +
+              str(int(np.sum(np.isfinite(v_daily_T_F)))) + "/" + str(n_days) + " days covered.")
+        v_datetime = first_day + np.arange(n_days).astype('timedelta64[D]') + np.timedelta64(12, 'h')
+        return self.aggregate_weather_arrays(v_datetime, v_daily_T_F)
+
+    @staticmethod
+    def period_years(df_periods):
+        # First and last calendar years of the billing periods
+        v_start_dates = pd.to_datetime(df_periods['start_dates'], utc=True)
+        v_end_dates = pd.to_datetime(df_periods['end_dates'], utc=True)
+        return pd.DatetimeIndex(np.sort(v_start_dates)).year[0], pd.DatetimeIndex(np.sort(v_end_dates)).year[-1]
+
+    @staticmethod
+    def load_cached_station_year(weather_station_ID, year, s_path):
+        # (datetime, temperature [F]) of one station-year from the weather store or the cached CSV file
+        weather_store = WeatherStore(s_path + WEATHER_STORE_PATH, 'cached')
+        if weather_store.has(weather_station_ID, year):
+            try:
+                return weather_store.read_years(weather_station_ID, year, year, verify=True)
+            except (ValueError, OSError) as e:
+                # A checksum mismatch, or files removed by a concurrent rewrite of the station-year
+                print(str(e) + ", reading the CSV file instead.")
+        file_name = (s_path + "/Data/Weather/" + str(year) + "/" + str(year) + "_" + weather_station_ID + '.csv')
+        df = pd.read_csv(file_name)
+        return (np.array(df['Datetime'].astype('datetime64[ns]')),
+                np.array(pd.to_numeric(df['Temperature'], errors='coerce'), dtype=float))
+
+    @staticmethod
+    def prefetch(v_station_year, cached=True):
+        # Load or download each (station_ID, year) once and keep it for every Weather instance in the process.
+        # Returns {(station_ID, year): exception} of the station-years that failed; these are not kept, so
+        # the normal load or download path tries them again.
+        s_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        v_station_year = [k for k in dict.fromkeys(v_station_year) if k not in Weather.station_year_data]
+        d_failed = {}
+        if cached:
+            for station_year in v_station_year:
+                try:
+                    Weather.station_year_data[station_year] = Weather.load_cached_station_year(*station_year, s_path)
+                except Exception as e:
+                    d_failed[station_year] = e
+        else:
+            for station_year, raw in Weather.download_station_years(v_station_year).items():
+                if isinstance(raw, Exception):
+                    d_failed[station_year] = raw
+                else:
+                    Weather.station_year_data[station_year] = Weather.get_weather_source().parse(raw)
+        if d_failed:
+            print(str(len(d_failed)) + "/" + str(len(v_station_year)) + " station-years could not be prefetched.")
+        return d_failed
+
+    @staticmethod
+    def clear_cache():
+        # Drop the prefetched station-years and degree-day tables, e.g. once a batch of buildings is done
+        Weather.station_year_data.clear()
+        Weather.degree_day_tables.clear()
+
+    def process_prefetched_weather(self, weather_station_ID):
+        # Aggregate prefetched station-years; None if any of the years has not been prefetched
+        v_key = [(weather_station_ID, year) for year in range(self.start_year, self.end_year + 1)]
+        if not all(key in Weather.station_year_data for key in v_key):
+            return None
+        return self.aggregate_station_years([Weather.station_year_data[key] for key in v_key])
+
+    def aggregate_station_years(self, v_data):
+        # Aggregate consecutive (datetime, temperature [F]) station-years to the billing periods
+        return self.aggregate_weather_arrays(np.concatenate([d[0].astype('datetime64[ns]') for d in v_data]),
+                                             np.concatenate([d[1] for d in v_data]))
+
     def process_cached_weather(self, weather_station_ID, s_path):
+        self.weather_station_ID = weather_station_ID
+        prefetched = self.process_prefetched_weather(weather_station_ID)
+        if prefetched is not None:
+            return prefetched
+        v_data = []
         for year in range(self.start_year, self.end_year + 1):
             print("Process weather data for year: " + str(year))
-            # Read pre-processed weather files from weather file folders
-            file_name = (s_path + "/Data/Weather/" + str(year) + "/" +
-                         str(year) + "_" + weather_station_ID + '.csv')
-    
-            if (year == self.start_year):
-                df_new = pd.read_csv(file_name)
-            else:
-                df_new = df_new.append(pd.read_csv(file_name), ignore_index=True)
-        df_new['Datetime'] = df_new['Datetime'].astype('datetime64[ns]')
-        df_new['Date'] = df_new['Datetime'].dt.date
-        v_T_F, v_T_C = self.aggregate_weather(df_new)
-        return(v_T_F, v_T_C)
+            v_data.append(Weather.load_cached_station_year(weather_station_ID, year, s_path))
+        return self.aggregate_station_years(v_data)
 
-    def process_downloaded_weather(self, weather_station_ID):
+    @staticmethod
+    def ftp_pool():
+        # Connection pool of the configured FTP server, shared by all Weather instances in the process
+        key = (Weather.noaa_ftp_host, Weather.noaa_ftp_port)
+        with Weather.ftp_pools_lock:
+            if key not in Weather.ftp_pools:
+                Weather.ftp_pools[key] = FTPConnectionPool(*key, max_connections=Weather.max_connections_per_host,
+                                                           retries=Weather.download_retries)
+            return Weather.ftp_pools[key]
 
-        # Helper functions
-        def download_sub_hourly_weather(station_ID, year):
-            ftp = FTP('ftp.ncdc.noaa.gov')
-            ftp.login()
-            ftp_path = '/pub/data/noaa/' + str(year)  # Hourly
-            ftp.cwd(ftp_path)
-            # Save gz files locally
-            file_name_noaa = 'RETR ' + station_ID + '-' + str(year) + '.gz'
-            file_name_local = station_ID + '-' + str(year) + '.gz'
-            ftp.retrbinary(file_name_noaa, open(file_name_local, 'wb').write)
-
-        def save_as_csv(stationID, year):
-            file_name_gz = stationID + '-' + str(year) + '.gz'
-            file_name_csv = stationID + '-' + str(year) + '.csv'
-            with gzip.open(file_name_gz, 'rb') as infile:
-                with open(file_name_csv, 'wb') as outfile:
-                    for line in infile:
-                        outfile.write(line)
-            os.remove(file_name_gz)
-
-        def get_ish_report_helper(raw_rpt):
-            return (ish_report().loads(raw_rpt))
-
-        def get_ish_report_datetime_helper(raw_rpt):
-            return (raw_rpt.datetime)
-
-        def get_ish_report_temperature_helper(raw_rpt):
-            return (raw_rpt.air_temperature.get_fahrenheit())
-        
-        for year in range(self.start_year, self.end_year + 1):
-            print("--->" + str(year))
-            download_sub_hourly_weather(weather_station_ID, year)
-            save_as_csv(weather_station_ID, year)
-            raw_csv = weather_station_ID + '-' + str(year) + '.csv'
-            if (year == self.start_year):
-                df_raw = pd.read_csv(raw_csv, names=['Old'])
-            else:
-                df_raw = df_raw.append(pd.read_csv(raw_csv, names=['Old']),
-                                       ignore_index=True)
-            # Cleaning up
-            os.remove(raw_csv)
-        # Parse ish text data to readable weather data
+    @staticmethod
+    def set_weather_source(source):
+        if source not in WEATHER_SOURCES:
+            raise ValueError("Unknown weather source: " + str(source) + " (" + ', '.join(WEATHER_SOURCES) + ")")
+        if source != Weather.weather_source:
+            # Prefetched downloads came from the previous source
+            Weather.clear_cache()
+        Weather.weather_source = source
+
+    @staticmethod
+    def get_weather_source():
+        return WEATHER_SOURCES[Weather.weather_source]
+
+    @staticmethod
+    def download_sub_hourly_weather(station_ID, year):
+        # Stream the gzip file of one station-year from the NOAA FTP server and decompress it on the fly;
+        # returns the raw ISD records without writing any files
+        return Weather.download_station_year(station_ID, year, ISDSource)
+
+    @staticmethod
+    def download_station_year(station_ID, year, source=None):
+        # Raw records of one station-year from the given weather source (default: the selected one)
+        source = Weather.get_weather_source() if source is None else source
+        return source.download(station_ID, year)
+
+    @staticmethod
+    def partial_file_name(directory, file_name):
+        download_path = Weather.download_path
+        if download_path is None:
+            download_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + '/Data/Downloads'
+        return os.path.join(download_path, directory.strip('/'), file_name + '.part')
+
+    @staticmethod
+    def decode_partial_file(partial_file, decoder_class=GzipStreamDecoder):
+        # Decode a completed partial file and remove it; a corrupt file is removed too, so the next attempt
+        # starts over
+        with open(partial_file, 'rb') as f:
+            data = f.read()
+        os.remove(partial_file)
+        decoder = decoder_class()
+        decoder.write(data)
+        return decoder.getvalue()
+
+    @staticmethod
+    def http_stream(url, decoder_class=GzipStreamDecoder):
+        # Download url and decode it in memory as it arrives, starting over after a failed transfer
+        attempt = 0
+        while True:
+            decoder = decoder_class()
+            try:
+                with urllib.request.urlopen(url, timeout=Weather.download_timeout) as response:
+                    while True:
+                        block = response.read(1 << 16)
+                        if not block:
+                            break
+                        decoder.write(block)
+                return decoder.getvalue()
+            except urllib.error.HTTPError:
+                raise
+            except Exception:
+                if attempt >= Weather.download_retries:
+                    raise
+                attempt += 1
+
+    @staticmethod
+    def http_download(url, partial_file, decoder_class=GzipStreamDecoder):
+        # Download url into partial_file, resuming from its end with HTTP Range requests
+        with FileLock(partial_file + '.lock', remove=True):
+            attempt = 0
+            while True:
+                offset = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+                headers = {'Range': 'bytes=' + str(offset) + '-'} if offset else {}
+                try:
+                    with urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                                timeout=Weather.download_timeout) as response:
+                        if offset and response.status != 206:
+                            # The server sent the whole file
+                            offset = 0
+                        elif offset:
+                            print("Resuming " + os.path.basename(url) + " at " + str(offset) + " bytes...")
+                        length = response.headers.get('Content-Length')
+                        size = offset + int(length) if length is not None else None
+                        with open(partial_file, 'ab' if offset else 'wb') as f:
+                            while True:
+                                block = response.read(1 << 16)
+                                if not block:
+                                    break
+                                f.write(block)
+                    if size is not None and os.path.getsize(partial_file) < size:
+                        raise EOFError("Incomplete transfer of " + url)
+                except urllib.error.HTTPError as e:
+                    if e.code == 416 and offset:
+                        # Nothing left to fetch
+                        return Weather.decode_partial_file(partial_file, decoder_class)
+                    raise
+                except Exception:
+                    progressed = os.path.exists(partial_file) and os.path.getsize(partial_file) > offset
+                    if not progressed:
+                        if attempt >= Weather.download_retries:
+                            raise
+                        attempt += 1
+                    continue
+                return Weather.decode_partial_file(partial_file, decoder_class)
+
+    @staticmethod
+    def download_station_years(v_station_year):
+        # Download many (station_ID, year) files concurrently with a bounded thread pool
+        # Returns {(station_ID, year): raw ISD records}, or the exception raised for that file
+        def download(station_year):
+            try:
+                return Weather.download_station_year(*station_year)
+            except Exception as e:
+                return e
+        v_station_year = list(dict.fromkeys(v_station_year))
+        if not v_station_year:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(Weather.max_download_workers, len(v_station_year))) as executor:
+            return dict(zip(v_station_year, executor.map(download, v_station_year)))
+
+    def process_downloaded_weather(self, weather_station_ID):
+        self.weather_station_ID = weather_station_ID
+        prefetched = self.process_prefetched_weather(weather_station_ID)
+        if prefetched is not None:
+            return prefetched
+        v_year = list(range(self.start_year, self.end_year + 1))
+        print("---> " + ', '.join(str(year) for year in v_year))
+        v_key = [(weather_station_ID, year) for year in v_year]
+        d_raw = Weather.download_station_years([key for key in v_key if key not in Weather.station_year_data])
+        for key, raw in d_raw.items():
+            # Keep every completed station-year, so that a retry after a failed year only downloads the rest
+            if not isinstance(raw, Exception):
+                Weather.station_year_data[key] = Weather.get_weather_source().parse(raw)
+        for key in v_key:
+            if key not in Weather.station_year_data:
+                raise d_raw[key]
         print("Processing downloaded data...")
-        v_rpt = list(map(get_ish_report_helper, df_raw['Old']))
-        v_noaa_datetime = np.array(list(map(get_ish_report_datetime_helper, v_rpt)))
-        v_noaa_temperature_F = np.array(list(map(get_ish_report_temperature_helper, v_rpt)))
-        # Sanitize the array
-        v_noaa_temperature_F = pd.to_numeric(v_noaa_temperature_F, errors='coerce')
-        df_new = pd.DataFrame({'Datetime': v_noaa_datetime, 'Temperature': v_noaa_temperature_F})
-        df_new['Date'] = df_new['Datetime'].dt.date
-        v_T_F, v_T_C = self.aggregate_weather(df_new)
-        return(v_T_F, v_T_C)
+        return self.process_prefetched_weather(weather_station_ID)
+
+    @staticmethod
+    def fixed_width_records(raw, min_length):
+        # Accessor of fixed-width text records: field(first, last) ~ (n_records, last - first + 1) bytes of the
+        # 1-based columns first..last of every line with at least min_length characters
+        data = np.frombuffer(raw, dtype=np.uint8)
+        v_end = np.flatnonzero(data == ord('\n'))
+        if len(data) and data[-1] != ord('\n'):
+            v_end = np.append(v_end, len(data))
+        v_start = np.concatenate([[0], v_end[:-1] + 1]).astype(np.int64)
+        v_start = v_start[v_end - v_start >= min_length]
+
+        def field(first, last):
+            return data[v_start[:, None] + np.arange(first - 1, last)]
+        return field
+
+    @staticmethod
+    def field_digits(m_bytes):
+        # Unsigned integers of zero-padded fields and whether each field only holds digits
+        d = m_bytes.astype(np.int64) - ord('0')
+        ok = np.all((d >= 0) & (d <= 9), axis=1)
+        return d @ (10 ** np.arange(m_bytes.shape[1] - 1, -1, -1)), ok
+
+    @staticmethod
+    def field_integers(m_bytes):
+        # Signed integers of right-justified, space-padded fields (e.g. '  -11') and whether each is valid
+        is_digit = (m_bytes >= ord('0')) & (m_bytes <= ord('9'))
+        is_minus = m_bytes == ord('-')
+        ok = np.all(is_digit | is_minus | (m_bytes == ord(' ')), axis=1) & is_digit[:, -1]
+        value = np.where(is_digit, m_bytes.astype(np.int64) - ord('0'), 0) @ \
+            (10 ** np.arange(m_bytes.shape[1] - 1, -1, -1))
+        return np.where(np.any(is_minus, axis=1), -value, value), ok
+
+    @staticmethod
+    def date_time(date, minutes=0):
+        # datetime64[m] of YYYYMMDD integers plus minutes
+        return ((date // 10000 - 1970).astype('datetime64[Y]') +
+                (date // 100 % 100 - 1).astype('timedelta64[M]')).astype('datetime64[D]') + \
+            (date % 100 - 1).astype('timedelta64[D]') + np.asarray(minutes).astype('timedelta64[m]')
+
+    @staticmethod
+    def parse_isd(raw, bad_quality=b'2367'):
+        # Parse the mandatory section of ISD records (NOAA Integrated Surface Database, fixed width):
+        # date YYYYMMDD at columns 16-23, time HHMM at 24-27, air temperature at 88-92 (signed, Celsius x 10,
+        # +9999 ~ missing) and its quality code at 93. Suspect and erroneous readings (quality codes
+        # 2, 3, 6 and 7) are dropped along with the missing ones.
+        # Returns the UTC date-times (datetime64[m]) and temperatures [F]
+        field = Weather.fixed_width_records(raw, 93)
+
+        def digits(first, last):
+            return Weather.field_digits(field(first, last))
+
+        date, ok_date = digits(16, 23)
+        hour_minute, ok_time = digits(24, 27)
+        value, ok_value = digits(89, 92)
+        sign = field(88, 88)[:, 0]
+        quality = field(93, 93)[:, 0]
+        keep = (ok_date & ok_time & ok_value & (value != 9999) & ((sign == ord('+')) | (sign == ord('-'))) &
+                ~np.isin(quality, np.frombuffer(bad_quality, dtype=np.uint8)))
+
+        date, hour_minute = date[keep], hour_minute[keep]
+        v_datetime = Weather.date_time(date, hour_minute // 100 * 60 + hour_minute % 100)
+        v_temperature_C = np.where(sign[keep] == ord('-'), -1, 1) * value[keep] / 10
+        return v_datetime, v_temperature_C * 1.8 + 32
+
+    @staticmethod
+    def parse_isd_lite(raw):
+        # Parse ISD-Lite records (hourly subset of ISD, fixed width): year at columns 1-4, month 6-7, day 9-10,
+        # hour 12-13 and air temperature at 14-19 (Celsius x 10, -9999 ~ missing)
+        # Returns the UTC date-times (datetime64[m]) and temperatures [F]
+        field = Weather.fixed_width_records(raw, 19)
+        year, ok_year = Weather.field_digits(field(1, 4))
+        month, ok_month = Weather.field_digits(field(6, 7))
+        day, ok_day = Weather.field_digits(field(9, 10))
+        hour, ok_hour = Weather.field_digits(field(12, 13))
+        value, ok_value = Weather.field_integers(field(14, 19))
+        keep = ok_year & ok_month & ok_day & ok_hour & ok_value & (value != -9999)
+        v_datetime = Weather.date_time((year * 10000 + month * 100 + day)[keep], hour[keep] * 60)
+        return v_datetime, value[keep] / 10 * 1.8 + 32
+
+    @staticmethod
+    def parse_gsod(raw):
+        # Parse GSOD records (daily summaries, fixed width): date YYYYMMDD at columns 15-22 and mean temperature
+        # at 25-30 (Fahrenheit with one decimal, 9999.9 ~ missing); the header line is skipped.
+        # Each daily mean is placed at noon so that it falls inside the billing periods containing the day.
+        # Returns the date-times (datetime64[m]) and temperatures [F]
+        field = Weather.fixed_width_records(raw, 30)
+        date, ok_date = Weather.field_digits(field(15, 22))
+        whole, ok_whole = Weather.field_integers(field(25, 28))
+        tenth, ok_tenth = Weather.field_digits(field(30, 30))
+        keep = ok_date & ok_whole & ok_tenth & (field(29, 29)[:, 0] == ord('.')) & (whole != 9999)
+        negative = np.any(field(25, 28) == ord('-'), axis=1)[keep]
+        v_temperature_F = np.where(negative, -1, 1) * (np.abs(whole[keep]) + tenth[keep] / 10)
+        return Weather.date_time(date[keep], 12 * 60), v_temperature_F
 
     def aggregate_weather(self, df_daily):
         # Get daily weather data
+        return self.aggregate_weather_arrays(np.array(df_daily['Datetime'], dtype=np.datetime64),
+                                             np.array(df_daily['Temperature'], dtype=float))
 
+    def aggregate_weather_arrays(self, v_datetime, v_temperature):
         # Remove time zone information
         self.v_start_dates = np.array(self.v_start_dates, dtype=np.datetime64)
         self.v_end_dates = np.array(self.v_end_dates, dtype=np.datetime64)
-        df_daily['Datetime'] = np.array(df_daily['Datetime'], dtype=np.datetime64)
-
-        df_daily = df_daily.loc[(df_daily['Datetime'] >=min(self.v_start_dates)) &
-                                (df_daily['Datetime'] <= max(self.v_end_dates))]
-
-        # Aggregate the weather data to the billing periods level.
-        v_avg_period_T_F = np.empty(0, dtype=float)
-        v_start_dates = np.array(self.v_start_dates)
-        v_end_dates = np.array(self.v_end_dates)
-        v_temp_datetime = np.array(df_daily['Datetime'], dtype=np.datetime64)
-        for i in range(len(self.v_start_dates)):
-            df_temp = df_daily.loc[(v_temp_datetime >= v_start_dates[i]) &
-                                   (v_temp_datetime <= v_end_dates[i])]
-            v_avg_period_T_F = np.append(v_avg_period_T_F, df_temp['Temperature'].mean())
+        v_datetime = np.asarray(v_datetime).astype('datetime64[ns]')
+        v_temperature = np.asarray(v_temperature, dtype=float)
+
+        # Aggregate the weather data to the billing periods level with prefix sums of the temperature and
+        # the number of readings in time order; each period is a slice found with two binary searches.
+        # Readings at the start and end date-times are included, missing temperatures are skipped.
+        order = np.argsort(v_datetime, kind='mergesort')
+        v_datetime, v_temperature = v_datetime[order], v_temperature[order]
+        valid = ~np.isnan(v_temperature)
+        v_cum_T = np.concatenate([[0.0], np.cumsum(np.where(valid, v_temperature, 0.0))])
+        v_cum_count = np.concatenate([[0], np.cumsum(valid)])
+        v_start = np.searchsorted(v_datetime, self.v_start_dates.astype('datetime64[ns]'), side='left')
+        v_end = np.searchsorted(v_datetime, self.v_end_dates.astype('datetime64[ns]'), side='right')
+        v_end = np.maximum(v_end, v_start)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            v_avg_period_T_F = (v_cum_T[v_end] - v_cum_T[v_start]) / (v_cum_count[v_end] - v_cum_count[v_start])
         v_avg_period_T_C = (v_avg_period_T_F - 32) / 1.8
 
-        return (v_avg_period_T_F, v_avg_period_T_C)
\ No newline at end of file
+        # The degree-day table for VBDD models is only built when degree_days is called
+        self.degree_day_table = None
+        self.v_daily_weather = (v_datetime, v_temperature)
+
+        return (v_avg_period_T_F, v_avg_period_T_C)
+
+    def degree_days(self):
+        # Mean daily heating and cooling degree-days of the billing periods over the base temperature grid,
+        # for VBDD models: (m_HDD, m_CDD) (n_periods, n_bases) and the bases [C]. The degree-day table is built
+        # on first use and shared by the Weather instances of the same station and years.
+        if self.degree_day_table is None:
+            key = (getattr(self, 'weather_station_ID', None), self.start_year, self.end_year)
+            self.degree_day_table = Weather.degree_day_tables.get(key) if key[0] is not None else None
+            if self.degree_day_table is None:
+                self.degree_day_table = DegreeDayTable(*self.v_daily_weather)
+                if key[0] is not None:
+                    Weather.degree_day_tables[key] = self.degree_day_table
+            self.v_daily_weather = None
+        m_HDD, m_CDD = self.degree_day_table.period_degree_days(self.v_start_dates, self.v_end_dates)
+        return m_HDD, m_CDD, self.degree_day_table.v_bases_C
+
+
+class NOAASource:
+    # Weather files of one station-year on the NOAA server, downloaded through the shared FTP connection pool
+    # or from the HTTP mirror at Weather.noaa_http_url; in memory, or through a resumable partial file with
+    # Weather.resumable_downloads
+    @classmethod
+    def download(cls, station_ID, year):
+        directory, file_name = cls.ftp_path(year), cls.file_name(station_ID, year)
+        url = Weather.noaa_http_url.rstrip('/') + directory + '/' + file_name if Weather.noaa_http_url else None
+        if Weather.resumable_downloads:
+            partial_file = Weather.partial_file_name(directory, file_name)
+            if url is not None:
+                return Weather.http_download(url, partial_file)
+            return Weather.ftp_pool().download_resumable(directory, file_name, partial_file)
+        if url is not None:
+            return Weather.http_stream(url)
+        return Weather.ftp_pool().download(directory, file_name)
+
+
+class ISDSource(NOAASource):
+    # Full ISD records: /pub/data/noaa/<year>/<station_ID>-<year>.gz
+    @staticmethod
+    def ftp_path(year):
+        return Weather.noaa_ftp_path + str(year)
+
+    @staticmethod
+    def file_name(station_ID, year):
+        return station_ID + '-' + str(year) + '.gz'
+
+    @staticmethod
+    def parse(raw):
+        return Weather.parse_isd(raw)
+
+
+class ISDLiteSource(NOAASource):
+    # ISD-Lite records: /pub/data/noaa/isd-lite/<year>/<station_ID>-<year>.gz
+    @staticmethod
+    def ftp_path(year):
+        return Weather.noaa_ftp_path + 'isd-lite/' + str(year)
+
+    @staticmethod
+    def file_name(station_ID, year):
+        return station_ID + '-' + str(year) + '.gz'
+
+    @staticmethod
+    def parse(raw):
+        return Weather.parse_isd_lite(raw)
+
+
+class GSODSource(NOAASource):
+    # GSOD daily summaries: /pub/data/gsod/<year>/<station_ID>-<year>.op.gz
+    @staticmethod
+    def ftp_path(year):
+        return Weather.gsod_ftp_path + str(year)
+
+    @staticmethod
+    def file_name(station_ID, year):
+        return station_ID + '-' + str(year) + '.op.gz'
+
+    @staticmethod
+    def parse(raw):
+        return Weather.parse_gsod(raw)
+
+
+class ServiceSource:
+    # Station-year arrays from a weather service (weather_service.py) shared by many workers:
+    # GET <Weather.weather_service_url>/weather/<station_ID>/<year>
+    @staticmethod
+    def download(station_ID, year):
+        url = (Weather.weather_service_url.rstrip('/') + '/weather/' + urllib.parse.quote(str(station_ID)) + '/' +
+               str(year))
+        with urllib.request.urlopen(url, timeout=Weather.weather_service_timeout) as response:
+            raw = response.read()
+            checksum = response.headers.get('X-Content-SHA256')
+        if checksum is not None and hashlib.sha256(raw).hexdigest() != checksum:
+            raise IOError("Truncated or corrupted weather from the service: " + str(station_ID) + " " + str(year))
+        return raw
+
+    @staticmethod
+    def parse(raw):
+        v_hours, v_temperature_F = WeatherStore.decode(raw)
+        return v_hours.astype('datetime64[h]'), v_temperature_F.astype(float)
+
+
+WEATHER_SOURCES = {'isd': ISDSource, 'isd-lite': ISDLiteSource, 'gsod': GSODSource, 'service': ServiceSource}
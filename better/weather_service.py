@@ -0,0 +1,148 @@
+'''
+
+Building Efficiency Targeting Tool for Energy Retrofits (BETTER) Copyright (c) 2018, The Regents of the University of California, through Lawrence Berkeley National Laboratory (subject to receipt of any required approvals from the U.S. Dept. of Energy). All rights reserved.
+
+If you have questions about your rights to use or distribute this software, please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+
+NOTICE.  This Software was developed under funding from the U.S. Department of Energy and the U.S. Government consequently retains certain rights. As such, the U.S. Government has been granted for itself and others acting on its behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software to reproduce, distribute copies to the public, prepare derivative works, and perform publicly and display publicly, and to permit other to do so.
+
+'''
+
+import os
+import re
+import hashlib
+import argparse
+import time
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from store import WeatherStore
+from weather import Weather, WEATHER_SOURCES
+
+
+class WeatherService:
+    # Local HTTP service that owns a WeatherStore and serves station-years to many workers:
+    # GET /weather/<station_ID>/<year> ~ WeatherStore.encode(hours, temperature [F])
+    # A station-year missing from the store is fetched from upstream once, however many clients ask for it.
+    # upstream: a weather source name ('isd', 'isd-lite' or 'gsod') or 'cached' for the local Data/Weather files
+
+    def __init__(self, store=None, upstream='isd', host='127.0.0.1', port=8765):
+        if upstream != 'cached' and (upstream not in WEATHER_SOURCES or upstream == 'service'):
+            raise ValueError("Unknown upstream weather source: " + str(upstream))
+        # Stored per upstream source, so that station-years of different sources are not mixed up
+        self.store = WeatherStore(source=upstream) if store is None else store
+        self.upstream = upstream
+        self.host, self.port = host, port
+        self.locks = {}  # {(station_ID, year): lock}, so that each station-year is fetched once
+        self.locks_lock = threading.Lock()
+        self.failures = {}  # {(station_ID, year): (error message, time)} of failed upstream fetches
+        self.failure_ttl = 3600  # Seconds before a failed station-year is fetched again
+        self.server = None
+        self.thread = None
+
+    def lock(self, key):
+        with self.locks_lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def fetch_upstream(self, station_ID, year):
+        # (datetime, temperature [F]) of one station-year from the upstream source
+        if self.upstream == 'cached':
+            s_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+            return Weather.load_cached_station_year(station_ID, year, s_path)
+        source = WEATHER_SOURCES[self.upstream]
+        return source.parse(Weather.download_station_year(station_ID, year, source))
+
+    station_ID_pattern = re.compile(r'[0-9A-Z]{6}-\d{5}')  # USAF-WBAN; a few USAF IDs contain letters
+
+    def station_year(self, station_ID, year):
+        # Encoded station-year from the store, fetching and storing it first if needed
+        # The station ID becomes part of the store's file names, so anything else is rejected first
+        if not self.station_ID_pattern.fullmatch(station_ID):
+            raise ValueError("Invalid station ID: " + repr(station_ID))
+        key = (station_ID, year)
+        with self.lock(key):
+            if key in self.failures and time.time() - self.failures[key][1] < self.failure_ttl:
+                raise LookupError(self.failures[key][0])
+            def fetch():
+                print("Fetching weather " + station_ID + " " + str(year) + " from " + self.upstream + "...")
+                return self.fetch_upstream(station_ID, year)
+            # The store's file lock also keeps other services and workers on the host from fetching it again
+            try:
+                self.store.populate(station_ID, year, fetch)
+            except Exception as e:
+                self.failures[key] = (str(e) or type(e).__name__, time.time())
+                raise LookupError(self.failures[key][0])
+            return WeatherStore.encode(*self.store.read(station_ID, year, verify=True))
+
+    def handler_class(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = [urllib.parse.unquote(p) for p in urllib.parse.urlparse(self.path).path.split('/') if p]
+                if len(parts) != 3 or parts[0] != 'weather' or not parts[2].isdigit():
+                    self.send_error(404, "Use /weather/<station_ID>/<year>")
+                    return
+                if not service.station_ID_pattern.fullmatch(parts[1]):
+                    self.send_error(400, "Invalid station ID")
+                    return
+                try:
+                    body = service.station_year(parts[1], int(parts[2]))
+                except LookupError as e:
+                    self.send_error(404, "Weather not available: " + str(e))
+                    return
+                except Exception as e:
+                    self.send_error(500, str(e))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('X-Content-SHA256', hashlib.sha256(body).hexdigest())
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        # Serve in a background thread; returns the service URL
+        self.server = ThreadingHTTPServer((self.host, self.port), self.handler_class())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return 'http://' + self.host + ':' + str(self.port)
+
+    def serve_forever(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), self.handler_class())
+        self.server.daemon_threads = True
+        print("Serving weather on http://" + self.host + ":" + str(self.server.server_address[1]))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        self.server.server_close()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def main():
+    # Workers use the service with Weather.set_weather_source('service') (and Weather.weather_service_url)
+    parser = argparse.ArgumentParser(description='Shared station-year weather cache')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--upstream', default='isd', help="'isd', 'isd-lite', 'gsod' or 'cached'")
+    parser.add_argument('--store', default=None, help='WeatherStore directory (default: Data/WeatherStore)')
+    args = parser.parse_args()
+    WeatherService(WeatherStore(args.store, args.upstream), args.upstream, args.host, args.port).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
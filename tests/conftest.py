@@ -0,0 +1,146 @@
+import os
+import sys
+import socket
+import threading
+import socketserver
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'better'))
+
+
+class StubFTPServer(socketserver.ThreadingTCPServer):
+    # Minimal passive-mode FTP server over in-memory files. drops: bytes to send before dropping the
+    # connection, one entry per RETR (None ~ send everything).
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, files):
+        self.files = files
+        self.drops = []
+        self.connections = 0
+        self.rest_offsets = []
+        super().__init__(('127.0.0.1', 0), StubFTPHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class StubFTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+        self.wfile.flush()
+
+    def handle(self):
+        self.server.connections += 1
+        cwd, rest, pasv = '/', 0, None
+        self.reply('220 stub')
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            command, _, argument = line.partition(' ')
+            command = command.upper()
+            path = cwd.rstrip('/') + '/' + argument
+            if command == 'USER':
+                self.reply('331 ok')
+            elif command in ('PASS', 'TYPE'):
+                self.reply('230 ok' if command == 'PASS' else '200 ok')
+            elif command == 'CWD':
+                cwd = argument
+                self.reply('250 ok')
+            elif command == 'SIZE':
+                self.reply('213 ' + str(len(self.server.files[path])) if path in self.server.files else '550 no file')
+            elif command == 'PASV':
+                pasv = socket.socket()
+                pasv.bind(('127.0.0.1', 0))
+                pasv.listen(1)
+                port = pasv.getsockname()[1]
+                self.reply('227 Entering Passive Mode (127,0,0,1,%d,%d)' % (port // 256, port % 256))
+            elif command == 'REST':
+                rest = int(argument)
+                self.reply('350 ok')
+            elif command == 'RETR':
+                if path not in self.server.files:
+                    self.reply('550 no file')
+                    continue
+                data_connection, _ = pasv.accept()
+                self.reply('150 sending')
+                self.server.rest_offsets.append(rest)
+                data = self.server.files[path][rest:]
+                drop = self.server.drops.pop(0) if self.server.drops else None
+                if drop is not None:
+                    data_connection.sendall(data[:drop])
+                    data_connection.close()
+                    pasv.close()
+                    return  # Drops the control connection too
+                data_connection.sendall(data)
+                data_connection.close()
+                pasv.close()
+                rest = 0
+                self.reply('226 done')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+@pytest.fixture
+def ftp_server():
+    server = StubFTPServer({})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # HTTP server over in-memory files with Range support. drops: bytes to send before dropping the
+    # connection, one entry per GET (None ~ send everything).
+    daemon_threads = True
+
+    def __init__(self, files):
+        self.files = files
+        self.drops = []
+        self.ranges = []
+        super().__init__(('127.0.0.1', 0), StubHTTPHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class StubHTTPHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        data = self.server.files[self.path]
+        offset = int(self.headers['Range'][len('bytes='):].rstrip('-')) if 'Range' in self.headers else 0
+        self.server.ranges.append(offset)
+        if offset >= len(data):
+            self.send_error(416)
+            return
+        self.send_response(206 if offset else 200)
+        self.send_header('Content-Length', str(len(data) - offset))
+        self.end_headers()
+        drop = self.server.drops.pop(0) if self.server.drops else None
+        self.wfile.write(data[offset:] if drop is None else data[offset:offset + drop])
+        self.wfile.flush()
+        if drop is not None:
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = StubHTTPServer({})
+    yield server
+    server.shutdown()
+    server.server_close()
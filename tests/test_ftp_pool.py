@@ -0,0 +1,95 @@
+import gzip
+import threading
+import time
+from ftplib import error_perm
+
+import pytest
+
+from weather import FTPConnectionPool
+
+
+def test_sessions_are_reused(ftp_server):
+    for i in range(5):
+        ftp_server.files['/data/f%d.gz' % i] = gzip.compress(b'x' * 1000 * (i + 1))
+    pool = FTPConnectionPool('127.0.0.1', ftp_server.port, max_connections=4)
+    for i in range(5):
+        assert pool.download('/data', 'f%d.gz' % i) == b'x' * 1000 * (i + 1)
+    assert ftp_server.connections == 1
+    pool.close()
+
+
+class StubSession:
+    def __init__(self, stale=False, delay=0, active=None):
+        self.stale, self.delay, self.active = stale, delay, active
+
+    def cwd(self, directory):
+        if self.stale:
+            raise ConnectionResetError('stale session')
+
+    def retrbinary(self, command, callback, rest=None):
+        if self.active is not None:
+            with self.active['lock']:
+                self.active['now'] += 1
+                self.active['max'] = max(self.active['max'], self.active['now'])
+        time.sleep(self.delay)
+        callback(gzip.compress(b'data'))
+        if self.active is not None:
+            with self.active['lock']:
+                self.active['now'] -= 1
+
+    def close(self):
+        pass
+
+
+def test_stale_sessions_do_not_count_as_retries():
+    pool = FTPConnectionPool('stub', retries=3)
+    for _ in range(4):
+        pool.idle.put(StubSession(stale=True))
+    connects = []
+    pool.connect = lambda: connects.append(1) or StubSession()
+    assert pool.download('/data', 'f.gz') == b'data'
+    assert len(connects) == 1
+
+
+def test_failed_new_connections_count_as_retries():
+    pool = FTPConnectionPool('stub', retries=2)
+    connects = []
+    pool.connect = lambda: connects.append(1) or StubSession(stale=True)
+    with pytest.raises(ConnectionResetError):
+        pool.download('/data', 'f.gz')
+    assert len(connects) == 3
+
+
+def test_login_refused_leaves_no_session_in_pool():
+    pool = FTPConnectionPool('stub')
+
+    def refuse():
+        raise error_perm('530 login incorrect')
+    pool.connect = refuse
+    with pytest.raises(error_perm):
+        pool.download('/data', 'f.gz')
+    assert pool.idle.empty()
+
+
+def test_reconnects_after_server_closes_idle_session(ftp_server):
+    ftp_server.files['/data/f.gz'] = gzip.compress(b'abc')
+    pool = FTPConnectionPool('127.0.0.1', ftp_server.port, retries=0)
+    assert pool.download('/data', 'f.gz') == b'abc'
+    # The server drops the idle session, e.g. after its idle timeout
+    pool.idle.queue[0].sock.shutdown(2)
+    assert pool.download('/data', 'f.gz') == b'abc'
+    assert ftp_server.connections == 2
+    pool.close()
+
+
+def test_connections_per_host_are_capped():
+    pool = FTPConnectionPool('stub', max_connections=3)
+    active = {'lock': threading.Lock(), 'now': 0, 'max': 0}
+    pool.connect = lambda: StubSession(delay=0.05, active=active)
+    threads = [threading.Thread(target=pool.download, args=('/data', 'f%d.gz' % i)) for i in range(12)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert active['max'] == 3
+    assert pool.idle.qsize() <= 3
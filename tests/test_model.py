@@ -0,0 +1,234 @@
+import time
+
+import numpy as np
+import pytest
+
+from model import InverseModel
+from registry import ModelRegistry
+
+
+@pytest.mark.parametrize('seed', range(12))
+def test_exact_fit_is_not_beaten_by_a_dense_grid(seed):
+    rng = np.random.default_rng(seed)
+    n = rng.integers(8, 40)
+    x = np.sort(rng.uniform(10, 95, n))
+    y = np.maximum(InverseModel.piecewise_linear(x, rng.uniform(35, 55), rng.uniform(55, 75), rng.uniform(0, 5),
+                                                 -rng.uniform(0, 0.2), rng.uniform(0, 0.2))
+                   + rng.normal(0, 1, n), 0)
+    model = InverseModel(x, y)
+    lower = [np.percentile(x, 10), np.percentile(x, 30), 0, -np.inf, 0]
+    upper = [np.percentile(x, 70), np.percentile(x, 90), np.inf, 0, np.inf]
+    p, _ = model.fit_exact(lower, upper)
+    sse = np.sum((y - InverseModel.piecewise_linear(x, *p)) ** 2)
+    _, sse_grid = InverseModel.profile_least_squares(x[None, :], y[None, :],
+                                                     np.linspace(lower[0], upper[0], 500)[None, :],
+                                                     np.linspace(lower[1], upper[1], 500)[None, :])
+    assert sse <= sse_grid[0] * (1 + 1e-9) + 1e-12
+
+
+def test_window_search_options_do_not_change_the_chosen_window():
+    rng = np.random.default_rng(3)
+    x = rng.uniform(10, 95, 36)
+    y = InverseModel.piecewise_linear(x, 45, 65, 2, -0.1, 0.12) + rng.normal(0, 0.5, 36)
+    chosen = []
+    for options in ({}, {'warm_start': True}, {'warm_start': True, 'n_jobs': 4}):
+        model = InverseModel(x, y, fit_method='curve_fit', **options)
+        model.fit()
+        chosen.append((model.optimize_cp_limit('L'), model.optimize_cp_limit('R'), tuple(model.p)))
+    assert chosen[1] == chosen[0]
+    assert chosen[2] == chosen[0]
+
+
+def test_fits_out_of_time_are_not_stored_in_the_registry(tmp_path):
+    rng = np.random.default_rng(4)
+    x = rng.uniform(10, 95, 24)
+    y = InverseModel.piecewise_linear(x, 45, 65, 2, -0.1, 0.12) + rng.normal(0, 0.5, 24)
+    model_registry = ModelRegistry(str(tmp_path / 'registry.sqlite'))
+    # The deadline shared with another model has already passed
+    model = InverseModel(x, y, time_budget=60, deadline=time.perf_counter() - 1)
+    model.fit_or_load(model_registry)
+    assert model.fit_strategy == 'coarse_grid'
+    key = model_registry.series_key(x, y, model.fit_settings())
+    assert model_registry.get(key) is None
+    model = InverseModel(x, y, time_budget=60)
+    model.fit_or_load(model_registry)
+    assert model.fit_strategy == 'exact'
+    assert model_registry.get(key) is not None
+    model_registry.close()
+
+
+def test_batch_fit_matches_single_building_fits():
+    rng = np.random.default_rng(5)
+    series = []
+    for _ in range(60):
+        n = rng.integers(12, 37)
+        x = rng.uniform(10, 95, n)
+        slopes = -rng.uniform(0, 0.2) * rng.integers(0, 2), rng.uniform(0, 0.2) * rng.integers(0, 2)
+        y = np.maximum(InverseModel.piecewise_linear(x, rng.uniform(35, 55), rng.uniform(55, 75),
+                                                     rng.uniform(0, 5), *slopes) + rng.normal(0, 1, n), 0)
+        series.append((x, y))
+    df = InverseModel.fit_batch(series)
+    for i, (x, y) in enumerate(series):
+        model = InverseModel(x, y)
+        if not model.fit_model():
+            assert df.loc[i, 'model_type'] == 'No fit'
+            continue
+        assert df.loc[i, 'model_type'] == model.model_type_str
+        np.testing.assert_allclose(df.loc[i, ['hcp', 'ccp', 'base', 'hsl', 'csl']].astype(float),
+                                   [model.hcp, model.ccp, model.base, abs(model.hsl), model.csl],
+                                   rtol=1e-7, atol=1e-9)
+
+
+def test_fit_result_is_read_only():
+    rng = np.random.default_rng(6)
+    x = rng.uniform(10, 95, 24)
+    y = InverseModel.piecewise_linear(x, 45, 65, 2, -0.1, 0.12) + rng.normal(0, 0.5, 24)
+    model = InverseModel(x, y)
+    model.fit_model()
+    result = model.fit_result
+    np.testing.assert_allclose(result.predictions, InverseModel.predict(model.p, x)[0])
+    np.testing.assert_allclose(result.residuals, y - result.predictions)
+    for array in (model.p, result.predictions, result.residuals, model.x_sorted, model.y_sorted):
+        with pytest.raises(ValueError):
+            array[0] = 0
+    with pytest.raises(AttributeError):
+        result.r2 = 1
+
+
+def test_press_matches_brute_force_leave_one_out():
+    rng = np.random.default_rng(7)
+    x = np.sort(rng.uniform(10, 95, 30))
+    y = InverseModel.piecewise_linear(x, 45, 65, 2, -0.1, 0.12) + rng.normal(0, 0.5, 30)
+    model = InverseModel(x, y, model_selection='loocv')
+    assert model.fit_model()
+    p, press, _ = InverseModel.fit_shapes(x[None, :], y[None, :], tuple(np.percentile(x, [[10], [70]])),
+                                          tuple(np.percentile(x, [[30], [90]])))
+    assert np.all(np.isfinite(press))
+    for i, shape in enumerate(InverseModel.model_shapes):
+        hcp, ccp, base, hsl, csl = p[0, i]
+        # Refit the linear coefficients without each point, holding the change-points
+        columns = [np.ones_like(x)] + ([np.minimum(x - hcp, 0)] if hsl < 0 else []) + \
+                  ([np.maximum(x - ccp, 0)] if csl > 0 else [])
+        design = np.column_stack(columns)
+        errors = []
+        for j in range(len(x)):
+            keep = np.arange(len(x)) != j
+            beta = np.linalg.lstsq(design[keep], y[keep], rcond=None)[0]
+            errors.append(y[j] - design[j] @ beta)
+        np.testing.assert_allclose(press[0, i], np.sum(np.square(errors)), rtol=1e-8)
+        assert model.loocv_scores[shape] == pytest.approx(press[0, i])
+
+
+def test_loocv_fit_uses_the_coarse_grid_after_the_deadline():
+    rng = np.random.default_rng(8)
+    x = rng.uniform(10, 95, 24)
+    y = InverseModel.piecewise_linear(x, 45, 65, 2, -0.1, 0.12) + rng.normal(0, 0.5, 24)
+    model = InverseModel(x, y, model_selection='loocv', time_budget=60, deadline=time.perf_counter() - 1)
+    model.fit_model()
+    assert model.fit_strategy == 'coarse_grid'
+    model = InverseModel(x, y, model_selection='loocv', time_budget=60)
+    model.fit_model()
+    assert model.fit_strategy == 'exact'
+
+
+def test_bootstrap_is_reproducible_and_refits_exactly():
+    rng = np.random.default_rng(9)
+    x = rng.uniform(10, 95, 30)
+    y = InverseModel.piecewise_linear(x, 45, 65, 2, -0.1, 0.12) + rng.normal(0, 0.5, 30)
+    model = InverseModel(x, y)
+    assert model.fit_model()
+    intervals = model.bootstrap(n_boot=50, seed=1)
+    p = model.bootstrap_p.copy()
+    assert model.bootstrap(n_boot=50, seed=1) == intervals
+    np.testing.assert_array_equal(model.bootstrap_p, p)
+    # The first resample refitted on its own with fit_exact
+    idx = np.sort(np.random.default_rng(1).integers(0, len(x), size=(50, len(x))), axis=1)[0]
+    resample = InverseModel(model.x_sorted[idx], model.y_sorted[idx])
+    lower = [np.percentile(x, 10), np.percentile(x, 30), 0, -np.inf, 0]
+    upper = [np.percentile(x, 70), np.percentile(x, 90), np.inf, 0, np.inf]
+    assert model.model_type_str == '5P'
+    np.testing.assert_allclose(p[0], resample.fit_exact(lower, upper)[0], rtol=1e-9, atol=1e-12)
+
+
+def test_guideline14_metrics_from_fit_residuals():
+    # Energy use 300, 360, 330, 270 (mean 315) with residuals 30, -30, 15, 0 and 3 parameters (1 dof)
+    metrics = InverseModel.guideline14_metrics([[1, -1, 0.5, 0]], [[10, 12, 11, 9]], [[30, 30, 30, 30]],
+                                               ['3P Cooling'], [0.1])
+    assert metrics['cv_rmse'][0] == pytest.approx(45 / 315)
+    assert metrics['nmbe'][0] == pytest.approx(15 / 315)
+    # The residuals alternate in sign, so the autocorrelation is clipped to zero
+    assert metrics['autocorrelation'][0] == 0
+    assert metrics['n_effective'][0] == 4
+    assert metrics['fractional_savings_uncertainty'][0] == pytest.approx(
+        6.313751514675 * 1.26 * 45 / 315 * np.sqrt(1.5 / 12) / 0.1)
+
+
+def piecewise_reference(x, hcp, ccp, base, hsl, csl):
+    # The np.piecewise implementation that predict replaced
+    if np.isnan(hcp) and np.isnan(hsl):
+        hcp = ccp
+        hsl = 0
+    if np.isnan(csl) and np.isnan(csl):
+        ccp = hcp
+        csl = 0
+    conds = [x < hcp, (x >= hcp) & (x <= ccp), x > ccp]
+    funcs = [lambda x: hsl * x + base - hsl * hcp, lambda x: base, lambda x: csl * x + base - csl * ccp]
+    return np.piecewise(x, conds, funcs)
+
+
+def test_predict_matches_np_piecewise():
+    rng = np.random.default_rng(11)
+    x = np.concatenate([rng.uniform(0, 100, 200), [40, 45, 60, 65]])
+    m_p = np.column_stack([rng.uniform(35, 55, 40), rng.uniform(45, 75, 40), rng.uniform(0, 5, 40),
+                           -rng.uniform(0, 0.2, 40), rng.uniform(0, 0.2, 40)])
+    # Change-points on data points, crossed change-points (hcp > ccp) and 3P models with NaN coefficients
+    m_p[0, :2] = 45, 65
+    m_p[1, :2] = 60, 40
+    m_p[2, [0, 3]] = np.nan
+    m_p[3, 4] = np.nan
+    expected = np.array([piecewise_reference(x, *p) for p in m_p])
+    np.testing.assert_array_equal(InverseModel.predict(m_p, x), expected)
+    np.testing.assert_array_equal(InverseModel.predict(m_p, np.tile(x, (len(m_p), 1))), expected)
+    for p, y in zip(m_p, expected):
+        np.testing.assert_array_equal(InverseModel.piecewise_linear(x, *p), y)
+
+
+def vbdd_reference(eui, hdd, cdd, v_bases):
+    # Least squares of every shape at every base (pair), keeping positive slopes and heating base <= cooling base
+    n = len(eui)
+    best = {'Constant': (np.sum((eui - eui.mean()) ** 2), np.nan, np.nan)}
+    for shape, pairs in (('VBDD Heating', [(i, None) for i in range(len(v_bases))]),
+                         ('VBDD Cooling', [(None, j) for j in range(len(v_bases))]),
+                         ('VBDD Heating-Cooling', [(i, j) for i in range(len(v_bases))
+                                                   for j in range(i, len(v_bases))])):
+        best[shape] = (np.inf, np.nan, np.nan)
+        for i, j in pairs:
+            design = np.column_stack([np.ones(n)] + ([hdd[:, i]] if i is not None else []) +
+                                     ([cdd[:, j]] if j is not None else []))
+            beta = np.linalg.lstsq(design, eui, rcond=None)[0]
+            sse = np.sum((eui - design @ beta) ** 2)
+            if np.all(beta[1:] > 0) and sse < best[shape][0]:
+                best[shape] = (sse, v_bases[i] if i is not None else np.nan, v_bases[j] if j is not None else np.nan)
+    sst = best['Constant'][0]
+    n_p = {'Constant': 1, 'VBDD Heating': 3, 'VBDD Cooling': 3, 'VBDD Heating-Cooling': 5}
+    adjusted_r2 = {shape: 0.0 if shape == 'Constant' else 1 - (sse / (n - n_p[shape])) / (sst / (n - 1))
+                   for shape, (sse, _, _) in best.items()}
+    shape = max(adjusted_r2, key=adjusted_r2.get)
+    return shape, best[shape]
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_vbdd_fit_matches_least_squares_at_every_base(seed):
+    rng = np.random.default_rng(seed)
+    v_bases = np.arange(8, 26, 1.5)
+    v_T_C = rng.uniform(-5, 35, (24, 30))
+    hdd = np.mean(np.maximum(v_bases[None, None, :] - v_T_C[:, :, None], 0), axis=1)
+    cdd = np.mean(np.maximum(v_T_C[:, :, None] - v_bases[None, None, :], 0), axis=1)
+    i_h, i_c = sorted(rng.integers(0, len(v_bases), 2))
+    eui = 2 + rng.uniform(0, 0.3) * hdd[:, i_h] * (seed % 3 != 1) + rng.uniform(0, 0.3) * cdd[:, i_c] * \
+        (seed % 3 != 2) + rng.normal(0, 0.2, 24)
+    result = InverseModel.fit_vbdd(eui[None], hdd, cdd, v_bases)
+    shape, (sse, heating_base, cooling_base) = vbdd_reference(eui, hdd, cdd, v_bases)
+    assert result['model_type'][0] == shape
+    np.testing.assert_array_equal([result['heating_base'][0], result['cooling_base'][0]], [heating_base, cooling_base])
+    assert result['r2'][0] == pytest.approx(1 - sse / np.sum((eui - eui.mean()) ** 2), rel=1e-8, abs=1e-10)
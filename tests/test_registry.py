@@ -0,0 +1,43 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from model import InverseModel
+from registry import ModelRegistry
+
+
+def test_registry_round_trip(tmp_path, monkeypatch):
+    rng = np.random.default_rng(10)
+    x = rng.uniform(10, 95, 24)
+    y = InverseModel.piecewise_linear(x, 45, 65, 2, -0.1, 0.12) + rng.normal(0, 0.5, 24)
+    fits = []
+    fit_model = InverseModel.fit_model
+
+    def counted_fit_model(self, *args, **kwargs):
+        fits.append(self.n_cp_grid)
+        return fit_model(self, *args, **kwargs)
+    monkeypatch.setattr(InverseModel, 'fit_model', counted_fit_model)
+    with ModelRegistry(str(tmp_path / 'registry.sqlite')) as model_registry:
+        # Miss: fitted and stored
+        fitted = InverseModel(x, y)
+        assert fitted.fit_or_load(model_registry)
+        assert fits == [20]
+    with ModelRegistry(str(tmp_path / 'registry.sqlite')) as model_registry:
+        # Hit: the same data and settings load the stored fit
+        loaded = InverseModel(x, y)
+        assert loaded.fit_or_load(model_registry)
+        assert fits == [20]
+        assert loaded.model_type_str == fitted.model_type_str
+        np.testing.assert_array_equal(loaded.p, fitted.p)
+        assert loaded.fit_result.r2 == fitted.fit_result.r2
+        # A changed setting changes the key
+        changed = InverseModel(x, y)
+        changed.n_cp_grid = 10
+        assert (model_registry.series_key(x, y, changed.fit_settings()) !=
+                model_registry.series_key(x, y, fitted.fit_settings()))
+        changed.fit_or_load(model_registry)
+        assert fits == [20, 10]
+    # The context manager closed the connection
+    with pytest.raises(sqlite3.ProgrammingError):
+        model_registry.get('key')
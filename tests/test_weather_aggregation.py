@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import weather
+from weather import Weather, DegreeDayTable
+
+
+def make_weather(station_ID='722950-23174'):
+    w = Weather.__new__(Weather)
+    w.weather_station_ID = station_ID
+    w.start_year, w.end_year = 2017, 2017
+    w.v_start_dates = np.array(['2017-01-01', '2017-02-01', '2017-03-01'], dtype='datetime64[D]')
+    w.v_end_dates = np.array(['2017-01-31', '2017-02-28', '2017-03-31'], dtype='datetime64[D]')
+    return w
+
+
+def hourly_weather(seed=0):
+    rng = np.random.default_rng(seed)
+    v_datetime = np.arange('2017-01-01T00', '2017-04-01T00', dtype='datetime64[h]')
+    v_temperature = 50 + 20 * np.sin(np.arange(len(v_datetime)) / 200) + rng.normal(0, 3, len(v_datetime))
+    v_temperature[rng.random(len(v_datetime)) < 0.05] = np.nan
+    return v_datetime, v_temperature
+
+
+def test_degree_day_table_is_only_built_for_vbdd(monkeypatch):
+    monkeypatch.setattr(Weather, 'degree_day_tables', {})
+    built = []
+
+    class CountedTable(DegreeDayTable):
+        def __init__(self, *args, **kwargs):
+            built.append(1)
+            DegreeDayTable.__init__(self, *args, **kwargs)
+    monkeypatch.setattr(weather, 'DegreeDayTable', CountedTable)
+    v_datetime, v_temperature = hourly_weather()
+    w = make_weather()
+    w.aggregate_weather_arrays(v_datetime, v_temperature)
+    assert built == []
+    m_hdd, m_cdd, v_bases = w.degree_days()
+    expected = DegreeDayTable(v_datetime, v_temperature).period_degree_days(w.v_start_dates, w.v_end_dates)
+    np.testing.assert_array_equal(m_hdd, expected[0])
+    np.testing.assert_array_equal(m_cdd, expected[1])
+    # Shared by another instance of the same station and years
+    other = make_weather()
+    other.aggregate_weather_arrays(v_datetime, v_temperature)
+    other.degree_days()
+    assert built == [1]
+
+
+def aggregate_reference(v_start_dates, v_end_dates, v_datetime, v_temperature):
+    # The per-period loop that the prefix-sum aggregation replaced
+    df_daily = pd.DataFrame({'Datetime': v_datetime, 'Temperature': v_temperature})
+    df_daily = df_daily.loc[(df_daily['Datetime'] >= min(v_start_dates)) &
+                            (df_daily['Datetime'] <= max(v_end_dates))]
+    v_avg_period_T_F = np.empty(0, dtype=float)
+    v_temp_datetime = np.array(df_daily['Datetime'], dtype=np.datetime64)
+    for i in range(len(v_start_dates)):
+        df_temp = df_daily.loc[(v_temp_datetime >= v_start_dates[i]) & (v_temp_datetime <= v_end_dates[i])]
+        v_avg_period_T_F = np.append(v_avg_period_T_F, df_temp['Temperature'].mean())
+    return v_avg_period_T_F, (v_avg_period_T_F - 32) / 1.8
+
+
+def test_prefix_sum_aggregation_matches_the_period_loop():
+    v_datetime, v_temperature = hourly_weather(2)
+    # Readings out of order, and overlapping, touching and empty billing periods
+    order = np.random.default_rng(3).permutation(len(v_datetime))
+    v_datetime, v_temperature = v_datetime[order], v_temperature[order]
+    w = make_weather()
+    w.v_start_dates = np.array(['2017-01-01', '2017-01-15T06', '2017-02-01', '2017-03-01', '2017-05-01'],
+                               dtype='datetime64[h]')
+    w.v_end_dates = np.array(['2017-01-31', '2017-02-15T18', '2017-03-01', '2017-03-31', '2017-05-31'],
+                             dtype='datetime64[h]')
+    expected = aggregate_reference(w.v_start_dates, w.v_end_dates, v_datetime.astype('datetime64[ns]'),
+                                   v_temperature)
+    for actual, reference in zip(w.aggregate_weather_arrays(v_datetime, v_temperature), expected):
+        np.testing.assert_allclose(actual, reference, rtol=1e-12)
+    assert np.isnan(expected[0][-1])
+
+
+def test_blended_weather_matches_per_day_inverse_distance_weights(monkeypatch):
+    v_station_ID = ['722950-23174', '722956-03167', '722970-23129']
+    v_distance = np.array([0.4, 12.0, 25.0])
+    monkeypatch.setattr(Weather, 'nearest_weather_stations',
+                        staticmethod(lambda latitude, longitude, k: (v_distance, np.array([0, 1, 2]))))
+    monkeypatch.setattr(weather.Constants, 'df_us_weather_station', pd.DataFrame({'station_ID': v_station_ID}))
+    d_data = {}
+    for i, station_ID in enumerate(v_station_ID):
+        v_datetime, v_temperature = hourly_weather(10 + i)
+        keep = np.ones(len(v_datetime), dtype=bool)
+        # The farthest station misses February, the second one a day in March
+        keep &= ~((i == 2) & (v_datetime >= np.datetime64('2017-02-01T00')) &
+                  (v_datetime < np.datetime64('2017-03-01T00')))
+        keep &= ~((i == 1) & (v_datetime.astype('datetime64[D]') == np.datetime64('2017-03-10')))
+        d_data[(station_ID, 2017)] = (v_datetime[keep], v_temperature[keep] + 2 * i)
+    monkeypatch.setattr(Weather, 'station_year_data', d_data)
+    w = make_weather()
+    w.latitude, w.longitude = 33.9, -118.4
+    v_T_F, v_T_C = w.process_blended_weather(cached=True, k=3, power=2)
+
+    # Daily means of each station, weighted per day among the stations reporting that day
+    df = pd.concat([pd.DataFrame({'station': i, 'Date': d_data[(station_ID, 2017)][0].astype('datetime64[D]'),
+                                  'Temperature': d_data[(station_ID, 2017)][1]})
+                    for i, station_ID in enumerate(v_station_ID)])
+    df = df.dropna().groupby(['Date', 'station'])['Temperature'].mean().reset_index()
+    df['weight'] = 1 / np.maximum(v_distance[df['station']], 1.0) ** 2
+    df['weighted'] = df['weight'] * df['Temperature']
+    df_daily = df.groupby('Date')[['weighted', 'weight']].sum()
+    v_daily_T_F = (df_daily['weighted'] / df_daily['weight']).values
+    v_noon = df_daily.index.values.astype('datetime64[D]') + np.timedelta64(12, 'h')
+    expected = aggregate_reference(w.v_start_dates, w.v_end_dates, v_noon.astype('datetime64[ns]'), v_daily_T_F)
+    np.testing.assert_allclose(v_T_F, expected[0], rtol=1e-12)
+    np.testing.assert_allclose(v_T_C, expected[1], rtol=1e-12)
+    np.testing.assert_allclose(w.blend_weights, [1, 1 / 144, 1 / 625] / np.sum([1, 1 / 144, 1 / 625]))
+
+
+def test_period_degree_days_match_a_daily_loop():
+    v_datetime, v_temperature = hourly_weather(4)
+    # A day without any reading
+    v_temperature[v_datetime.astype('datetime64[D]') == np.datetime64('2017-02-10')] = np.nan
+    v_bases = np.array([5.0, 12.5, 18.0, 24.0])
+    v_start_dates = ['2017-01-01', '2017-01-20', '2017-02-05', '2017-03-31']
+    v_end_dates = ['2017-02-01', '2017-03-01', '2017-02-15', '2017-04-01']
+    m_hdd, m_cdd = DegreeDayTable(v_datetime, v_temperature, v_bases).period_degree_days(v_start_dates, v_end_dates)
+
+    df = pd.DataFrame({'Date': v_datetime.astype('datetime64[D]'), 'T_C': (v_temperature - 32) / 1.8})
+    s_daily = df.dropna().groupby('Date')['T_C'].mean()
+    for i, (start, end) in enumerate(zip(v_start_dates, v_end_dates)):
+        # Mean over the days with readings in [start, end)
+        v_T_C = s_daily[(s_daily.index >= start) & (s_daily.index < end)].values
+        for j, base in enumerate(v_bases):
+            assert m_hdd[i, j] == pytest.approx(np.mean([max(base - t, 0) for t in v_T_C]), rel=1e-9, abs=1e-12)
+            assert m_cdd[i, j] == pytest.approx(np.mean([max(t - base, 0) for t in v_T_C]), rel=1e-9, abs=1e-12)
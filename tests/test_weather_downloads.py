@@ -0,0 +1,139 @@
+import os
+import gzip
+
+import numpy as np
+import pytest
+
+from weather import Weather, FTPConnectionPool, ISDSource
+
+
+def test_station_years_download_concurrently_within_the_host_cap(ftp_server, tmp_path, monkeypatch):
+    for station in ('A', 'B', 'C'):
+        for year in (2016, 2017):
+            ftp_server.files['/pub/data/noaa/%d/%s-%d.gz' % (year, station, year)] = \
+                gzip.compress((station + str(year)).encode())
+    monkeypatch.setattr(Weather, 'noaa_ftp_host', '127.0.0.1')
+    monkeypatch.setattr(Weather, 'noaa_ftp_port', ftp_server.port)
+    monkeypatch.setattr(Weather, 'max_connections_per_host', 2)
+    monkeypatch.setattr(Weather, 'ftp_pools', {})
+    monkeypatch.setattr(Weather, 'download_path', str(tmp_path))
+    v_station_year = [(s, y) for s in ('A', 'B', 'C', 'missing') for y in (2016, 2017)]
+    d_raw = Weather.download_station_years(v_station_year)
+    for (station, year), raw in d_raw.items():
+        if station == 'missing':
+            assert isinstance(raw, Exception)
+        else:
+            assert raw == (station + str(year)).encode()
+    assert ftp_server.connections <= 2
+    Weather.ftp_pool().close()
+
+
+def test_ftp_download_resumes_after_a_dropped_transfer(ftp_server, tmp_path):
+    raw = os.urandom(50000)
+    ftp_server.files['/data/f.gz'] = gzip.compress(raw)
+    ftp_server.drops = [10000, 5000]
+    partial_file = str(tmp_path / 'data' / 'f.gz.part')
+    pool = FTPConnectionPool('127.0.0.1', ftp_server.port, retries=0)
+    assert pool.download_resumable('/data', 'f.gz', partial_file) == raw
+    assert ftp_server.rest_offsets == [0, 10000, 15000]
+    assert os.listdir(str(tmp_path / 'data')) == []
+    pool.close()
+
+
+def test_http_download_resumes_after_a_dropped_transfer(http_server, tmp_path, monkeypatch):
+    raw = os.urandom(50000)
+    http_server.files['/f.gz'] = gzip.compress(raw)
+    http_server.drops = [10000, 5000]
+    monkeypatch.setattr(Weather, 'download_retries', 0)
+    partial_file = str(tmp_path / 'f.gz.part')
+    assert Weather.http_download(http_server.url + '/f.gz', partial_file) == raw
+    assert http_server.ranges == [0, 10000, 15000]
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_completed_years_are_kept_when_a_later_year_fails(monkeypatch):
+    monkeypatch.setattr(Weather, 'station_year_data', {})
+    downloads, failing = [], {2017}
+
+    def download_station_year(station_ID, year, source=None):
+        downloads.append(year)
+        if year in failing:
+            raise EOFError('connection lost')
+        hours = np.arange(str(year) + '-01-01T00', str(year) + '-01-01T03', dtype='datetime64[h]')
+        return hours, np.full(len(hours), float(year))
+    monkeypatch.setattr(Weather, 'download_station_year', staticmethod(download_station_year))
+    monkeypatch.setattr(Weather.get_weather_source(), 'parse', staticmethod(lambda raw: raw))
+    weather = Weather.__new__(Weather)
+    weather.start_year, weather.end_year = 2015, 2017
+    weather.aggregate_weather_arrays = lambda v_datetime, v_temperature_F: v_temperature_F
+    with pytest.raises(EOFError):
+        weather.process_downloaded_weather('722950-23174')
+    failing.clear()
+    assert list(weather.process_downloaded_weather('722950-23174')) == [2015.0] * 3 + [2016.0] * 3 + [2017.0] * 3
+    assert sorted(downloads) == [2015, 2016, 2017, 2017]
+
+
+def test_failed_prefetch_is_retried_by_the_download_path(monkeypatch):
+    monkeypatch.setattr(Weather, 'station_year_data', {})
+    monkeypatch.setattr(Weather, 'degree_day_tables', {})
+    downloads, failing = [], {2016}
+
+    def download_station_year(station_ID, year, source=None):
+        downloads.append(year)
+        if year in failing:
+            raise EOFError('connection lost')
+        return np.array([str(year) + '-01-01T00'], dtype='datetime64[h]'), np.array([float(year)])
+    monkeypatch.setattr(Weather, 'download_station_year', staticmethod(download_station_year))
+    monkeypatch.setattr(Weather.get_weather_source(), 'parse', staticmethod(lambda raw: raw))
+    d_failed = Weather.prefetch([('722950-23174', 2015), ('722950-23174', 2016)], cached=False)
+    assert list(d_failed) == [('722950-23174', 2016)]
+    assert ('722950-23174', 2016) not in Weather.station_year_data
+    failing.clear()
+    weather = Weather.__new__(Weather)
+    weather.start_year, weather.end_year = 2015, 2016
+    weather.aggregate_weather_arrays = lambda v_datetime, v_temperature_F: v_temperature_F
+    assert list(weather.process_downloaded_weather('722950-23174')) == [2015.0, 2016.0]
+    assert sorted(downloads) == [2015, 2016, 2016]
+    Weather.clear_cache()
+    assert Weather.station_year_data == {} and Weather.degree_day_tables == {}
+
+
+def test_downloads_stream_in_memory_unless_resumable(http_server, tmp_path, monkeypatch):
+    raw = os.urandom(50000)
+    http_server.files['/pub/data/noaa/2016/A-2016.gz'] = gzip.compress(raw)
+    http_server.drops = [10000]
+    monkeypatch.setattr(Weather, 'noaa_http_url', http_server.url)
+    monkeypatch.setattr(Weather, 'download_path', str(tmp_path))
+    assert ISDSource.download('A', 2016) == raw
+    # The dropped transfer starts over, and nothing is written to the download path
+    assert http_server.ranges == [0, 0]
+    assert os.listdir(str(tmp_path)) == []
+    monkeypatch.setattr(Weather, 'resumable_downloads', True)
+    http_server.drops = [10000]
+    assert ISDSource.download('A', 2016) == raw
+    assert http_server.ranges == [0, 0, 0, 10000]
+
+
+def test_candidate_stations_download_together(monkeypatch):
+    monkeypatch.setattr(Weather, 'station_year_data', {})
+    monkeypatch.setattr(Weather, 'blend_stations', False)
+    batches = []
+
+    def download_station_years(v_station_year):
+        batches.append(sorted(v_station_year))
+        return {(station_ID, year): EOFError('missing') if station_ID == 'A' else
+                (np.array([str(year) + '-01-01T00'], dtype='datetime64[h]'), np.array([float(year)]))
+                for station_ID, year in v_station_year}
+    monkeypatch.setattr(Weather, 'download_station_years', staticmethod(download_station_years))
+    monkeypatch.setattr(Weather.get_weather_source(), 'parse', staticmethod(lambda raw: raw))
+    weather = Weather.__new__(Weather)
+    weather.start_year, weather.end_year = 2016, 2017
+    weather.closest_weather_station_ID, weather.second_closest_weather_station_ID = 'A', 'B'
+    weather.third_closest_weather_station_ID = 'C'
+    weather.aggregate_weather_arrays = lambda v_datetime, v_temperature_F: (v_temperature_F, v_temperature_F)
+    weather.download_weather_NOAA()
+    assert batches[0] == [(s, y) for s in 'ABC' for y in (2016, 2017)]
+    assert weather.weather_station_ID == 'B'
+    assert list(weather.v_T_F) == [2016.0, 2017.0]
+    # Only the failed station is tried again
+    assert all(station_ID == 'A' for batch in batches[1:] for station_ID, _ in batch)
@@ -0,0 +1,65 @@
+import numpy as np
+
+from weather import Weather
+
+# Mandatory section of an ISD record of Los Angeles International Airport, 2017-01-01 00:53 UTC, 15.0 C
+ISD_RECORD = ('0081722950231742017010100535+33938-118389FM-15+0030KLAX V0203301N00461220001CN0160931N5'
+              '+01501+00561102071ADDAA101000091')
+
+
+def isd_line(date_time, temperature, quality='1'):
+    return ISD_RECORD[:15] + date_time + ISD_RECORD[27:87] + temperature + quality + ISD_RECORD[93:]
+
+
+def test_isd_records_are_parsed_field_by_field():
+    raw = '\n'.join([
+        isd_line('201701010053', '+0150'),
+        isd_line('201701010153', '-0011'),
+        isd_line('201701010253', '+9999', '9'),  # missing
+        isd_line('201701010353', '+0200', '3'),  # erroneous
+        isd_line('201701010453', '+0200', '7'),  # erroneous, from the original report
+        isd_line('201701010553', '+0000', '9'),
+        isd_line('201701010653', '0+200'),  # malformed sign
+        ISD_RECORD[:80],  # truncated record
+        isd_line('201712312359', '+0322', '5'),  # last record without a newline
+    ]).encode()
+    v_datetime, v_temperature_F = Weather.parse_isd(raw)
+    np.testing.assert_array_equal(v_datetime, np.array(['2017-01-01T00:53', '2017-01-01T01:53', '2017-01-01T05:53',
+                                                        '2017-12-31T23:59'], dtype='datetime64[m]'))
+    np.testing.assert_allclose(v_temperature_F, [59, 30.02, 32, 89.96])
+
+
+def test_isd_parsing_of_empty_data():
+    v_datetime, v_temperature_F = Weather.parse_isd(b'')
+    assert len(v_datetime) == 0 and len(v_temperature_F) == 0
+
+
+def test_isd_lite_records_are_parsed_field_by_field():
+    raw = b'\n'.join([
+        b'2017 01 01 00   144    67 10200   270    36     7     0 -9999',
+        b'2017 01 01 01   -11    67 10200   270    36     7     0 -9999',
+        b'2017 01 01 02 -9999    67 10200   270    36     7     0 -9999',  # missing
+        b'2017 01 01 03     0    67 10200   270    36     7     0 -9999',
+        b'2017 01 01 0',  # truncated record
+        b'2017 12 31 23  -205',
+    ]) + b'\n'
+    v_datetime, v_temperature_F = Weather.parse_isd_lite(raw)
+    np.testing.assert_array_equal(v_datetime, np.array(['2017-01-01T00:00', '2017-01-01T01:00', '2017-01-01T03:00',
+                                                        '2017-12-31T23:00'], dtype='datetime64[m]'))
+    np.testing.assert_allclose(v_temperature_F, [57.92, 30.02, 32, -4.9])
+
+
+def test_gsod_records_are_parsed_field_by_field():
+    raw = b'\n'.join([
+        b'STN--- WBAN   YEARMODA    TEMP       DEWP      SLP        STP       VISIB      WDSP     MXSPD   GUST',
+        b'722950 23174  20170101    56.7 24    39.5 24  1021.3 24  1020.2 24    9.8 24    3.9 24    8.0  999.9',
+        b'722950 23174  20170102   -12.3 24    39.5 24  1021.3 24  1020.2 24    9.8 24    3.9 24    8.0  999.9',
+        b'722950 23174  20170103  9999.9  0    39.5 24  1021.3 24  1020.2 24    9.8 24    3.9 24    8.0  999.9',
+        b'722950 23174  20170104     0.0 24',
+        b'722950 23174  20171231   100.4 24',
+    ])
+    v_datetime, v_temperature_F = Weather.parse_gsod(raw)
+    # Daily means are placed at noon of their day
+    np.testing.assert_array_equal(v_datetime, np.array(['2017-01-01T12:00', '2017-01-02T12:00', '2017-01-04T12:00',
+                                                        '2017-12-31T12:00'], dtype='datetime64[m]'))
+    np.testing.assert_allclose(v_temperature_F, [56.7, -12.3, 0, 100.4])
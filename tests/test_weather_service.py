@@ -0,0 +1,107 @@
+import hashlib
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+
+from store import WeatherStore
+from weather_service import WeatherService
+
+
+@pytest.mark.parametrize('station_ID', ['..%2F..%2Fetc', '%2E%2E', '722950-23174%2F..', 'abc'])
+def test_invalid_station_IDs_are_rejected_before_the_store(tmp_path, station_ID):
+    service = WeatherService(WeatherStore(str(tmp_path / 'store')), upstream='cached', port=0)
+    url = service.start()
+    try:
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url + '/weather/' + station_ID + '/2017')
+        assert e.value.code == 400
+    finally:
+        service.stop()
+    assert not (tmp_path / 'store').exists() or not any((tmp_path / 'store').iterdir())
+
+
+def test_station_year_rejects_path_separators(tmp_path):
+    service = WeatherService(WeatherStore(str(tmp_path)), upstream='cached')
+    with pytest.raises(ValueError):
+        service.station_year('../722950-23174', 2017)
+
+
+def station_year_data():
+    hours = np.arange('2017-01-01T00', '2017-01-08T00', dtype='datetime64[h]')
+    return hours, 50 + np.arange(len(hours)) % 24
+
+
+def test_concurrent_requests_fetch_the_station_year_once(tmp_path):
+    service = WeatherService(WeatherStore(str(tmp_path)), upstream='cached', port=0)
+    calls = []
+
+    def fetch_upstream(station_ID, year):
+        calls.append((station_ID, year))
+        time.sleep(0.2)
+        return station_year_data()
+    service.fetch_upstream = fetch_upstream
+    url = service.start()
+    bodies = []
+    try:
+        threads = [threading.Thread(target=lambda: bodies.append(
+            urllib.request.urlopen(url + '/weather/722950-23174/2017').read())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        service.stop()
+    assert calls == [('722950-23174', 2017)]
+    assert len(bodies) == 8 and all(body == bodies[0] for body in bodies)
+    np.testing.assert_array_equal(WeatherStore.decode(bodies[0])[1], station_year_data()[1])
+
+
+def test_failed_fetches_are_retried_after_the_failure_ttl(tmp_path):
+    service = WeatherService(WeatherStore(str(tmp_path)), upstream='cached', port=0)
+    calls = []
+
+    def fetch_upstream(station_ID, year):
+        calls.append((station_ID, year))
+        if len(calls) < 3:
+            raise IOError("upstream unavailable")
+        return station_year_data()
+    service.fetch_upstream = fetch_upstream
+    url = service.start() + '/weather/722950-23174/2017'
+    try:
+        for _ in range(2):
+            with pytest.raises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(url)
+            assert e.value.code == 404
+        # The failure is remembered within the TTL
+        assert len(calls) == 1
+        service.failures[('722950-23174', 2017)] = ('upstream unavailable', time.time() - service.failure_ttl - 1)
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url)
+        assert len(calls) == 2
+        service.failure_ttl = 0
+        assert urllib.request.urlopen(url).status == 200
+        assert len(calls) == 3
+    finally:
+        service.stop()
+
+
+def test_stored_station_years_are_served_without_fetching(tmp_path):
+    store = WeatherStore(str(tmp_path))
+    store.write('722950-23174', 2017, *station_year_data())
+    service = WeatherService(store, upstream='cached', port=0)
+
+    def fetch_upstream(station_ID, year):
+        raise AssertionError("fetched a stored station-year")
+    service.fetch_upstream = fetch_upstream
+    url = service.start()
+    try:
+        response = urllib.request.urlopen(url + '/weather/722950-23174/2017')
+        body = response.read()
+    finally:
+        service.stop()
+    assert body == WeatherStore.encode(*store.read('722950-23174', 2017))
+    assert response.headers['X-Content-SHA256'] == hashlib.sha256(body).hexdigest()
@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+
+from weather import Weather
+
+
+def station_list(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'station_ID': ['%06d-%05d' % (i, i) for i in range(n)],
+                         'station_name': ['Station ' + str(i) for i in range(n)],
+                         'latitude': rng.uniform(20, 65, n), 'longitude': rng.uniform(-170, -60, n)})
+
+
+def test_kd_tree_matches_brute_force_haversine():
+    df_stations = station_list()
+    rng = np.random.default_rng(1)
+    latitude, longitude = rng.uniform(20, 65, 50), rng.uniform(-170, -60, 50)
+    v_distance, v_index = Weather.nearest_weather_stations(latitude, longitude, 3, df_stations)
+    for i in range(len(latitude)):
+        # The loop over all stations that the spatial index replaced
+        v_brute = np.array([Weather.haversine_distance(latitude[i], longitude[i], lat, lon)
+                            for lat, lon in df_stations[['latitude', 'longitude']].values])
+        np.testing.assert_array_equal(v_index[i], np.argsort(v_brute, kind='stable')[:3])
+        np.testing.assert_allclose(v_distance[i], np.sort(v_brute)[:3], rtol=1e-9)
+    # Scalar coordinates give one row
+    distance, index = Weather.nearest_weather_stations(latitude[0], longitude[0], 3, df_stations)
+    np.testing.assert_array_equal(index, v_index[0])
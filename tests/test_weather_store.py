@@ -0,0 +1,93 @@
+import os
+import time
+import threading
+
+import numpy as np
+import pandas as pd
+
+from store import FileLock, StationManifest, WeatherStore
+from weather import Weather
+
+
+def test_cached_station_year_falls_back_to_csv_during_a_rewrite(tmp_path, monkeypatch):
+    hours = np.arange('2017-01-01T00', '2017-01-02T00', dtype='datetime64[h]')
+    store = WeatherStore(str(tmp_path / 'Data' / 'WeatherStore'))
+    store.write('722950-23174', 2017, hours, np.full(len(hours), 50.0))
+    os.makedirs(str(tmp_path / 'Data' / 'Weather' / '2017'))
+    pd.DataFrame({'Datetime': hours.astype(str), 'Temperature': 60.0}).to_csv(
+        str(tmp_path / 'Data' / 'Weather' / '2017' / '2017_722950-23174.csv'), index=False)
+    # Another process removes the files between has() and the checksum check
+    has = WeatherStore.has
+
+    def has_then_removed(self, station_ID, year):
+        found = has(self, station_ID, year)
+        for file_name in self.file_names(station_ID, year):
+            os.remove(file_name)
+        return found
+    monkeypatch.setattr(WeatherStore, 'has', has_then_removed)
+    _, v_temperature = Weather.load_cached_station_year('722950-23174', 2017, str(tmp_path))
+    assert np.all(v_temperature == 60.0)
+
+
+def test_removed_lock_files_still_exclude_waiting_holders(tmp_path):
+    lock_file = str(tmp_path / 'f.part.lock')
+    active = {'now': 0, 'max': 0}
+
+    def hold():
+        with FileLock(lock_file, remove=True):
+            active['now'] += 1
+            active['max'] = max(active['max'], active['now'])
+            time.sleep(0.01)
+            active['now'] -= 1
+    threads = [threading.Thread(target=hold) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert active['max'] == 1
+    assert not os.path.exists(lock_file)
+
+
+def test_store_entries_are_kept_apart_per_source(tmp_path):
+    hours = np.arange('2017-01-01T00', '2017-01-02T00', dtype='datetime64[h]')
+    WeatherStore(str(tmp_path), 'isd').write('722950-23174', 2017, hours, np.full(len(hours), 50.0))
+    assert WeatherStore(str(tmp_path), 'isd').has('722950-23174', 2017)
+    assert not WeatherStore(str(tmp_path), 'gsod').has('722950-23174', 2017)
+    assert not WeatherStore(str(tmp_path)).has('722950-23174', 2017)
+
+
+def test_station_manifest_coverage_matches_counted_observations(tmp_path, monkeypatch):
+    store = WeatherStore(str(tmp_path / 'store'))
+    rng = np.random.default_rng(0)
+    hours = np.arange('2017-01-01T00', '2018-01-01T00', dtype='datetime64[h]')
+    d_temperature = {}
+    for station_ID, missing in (('722950-23174', 0.02), ('722956-03167', 0.02), ('722970-23129', 0.9)):
+        v_temperature = rng.normal(60, 10, len(hours))
+        v_temperature[rng.random(len(hours)) < missing] = np.nan
+        if station_ID == '722956-03167':
+            # A station that stops reporting in March
+            v_temperature[(hours >= np.datetime64('2017-03-05T00')) & (hours < np.datetime64('2017-04-01T00'))] = np.nan
+        store.write(station_ID, 2017, hours, v_temperature)
+        d_temperature[station_ID] = v_temperature
+    manifest = StationManifest(str(tmp_path / 'station_manifest.csv'))
+    manifest.add_weather_store(store)
+    manifest.save()
+    manifest = StationManifest(str(tmp_path / 'station_manifest.csv'))
+
+    v_month = hours.astype('datetime64[M]')
+    for station_ID, v_temperature in d_temperature.items():
+        counts = [np.sum(np.isfinite(v_temperature[v_month == m])) for m in np.unique(v_month)]
+        np.testing.assert_array_equal(manifest.counts[(station_ID, 2017)], counts)
+        for start_date, end_date in (('2017-01-15', '2017-02-14'), ('2017-02-01', '2017-04-30'),
+                                     ('2017-06-01', '2018-01-31')):
+            months = pd.period_range(start_date, end_date, freq='M')
+            covered = [m.year == 2017 and counts[m.month - 1] >= StationManifest.min_observations for m in months]
+            assert manifest.coverage(station_ID, start_date, end_date) == np.mean(covered)
+    assert manifest.coverage('999999-99999', '2017-01-01', '2017-02-01') is None
+
+    # The station missing March and the sparse one move behind the unknown station
+    monkeypatch.setattr(Weather, 'station_manifest', manifest)
+    df_weather_station_list = pd.DataFrame({'station_ID': ['722956-03167', '722970-23129', '999999-99999',
+                                                           '722950-23174']})
+    v_index = Weather.rank_weather_stations([0, 1, 2, 3], '2017-02-01', '2017-04-30', 3, df_weather_station_list)
+    np.testing.assert_array_equal(v_index, [3, 2, 0])